@@ -0,0 +1,60 @@
+# -*- coding: utf-8 -*-
+"""
+Compares building an APNs frame with a Frame.add_item loop against the bulk
+Frame.from_tokens encoder.
+
+    python benchmarks/bench_frame.py --tokens 200000
+"""
+import argparse
+import os
+import time
+from binascii import b2a_hex
+
+from cuckoo.model.messages import DataPayload, Frame
+
+
+def random_tokens(count):
+    return [b2a_hex(os.urandom(32)).decode('ascii') for _ in range(count)]
+
+
+def build_with_add_item(tokens, payload):
+    frame = Frame()
+    for identifier, token in enumerate(tokens):
+        frame.add_item(token, payload, identifier, 0, 10)
+    return frame
+
+
+def build_with_from_tokens(tokens, payload):
+    return Frame.from_tokens(tokens, payload, 0, 0, 10)
+
+
+def best_of(repeat, func, *args):
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = func(*args)
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best, result
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--tokens', type=int, default=100000)
+    parser.add_argument('--repeat', type=int, default=3)
+    args = parser.parse_args()
+
+    tokens = random_tokens(args.tokens)
+    payload = DataPayload(alert="Campaign message", badge=1, sound="default").compile()
+
+    slow, slow_frame = best_of(args.repeat, build_with_add_item, tokens, payload)
+    fast, fast_frame = best_of(args.repeat, build_with_from_tokens, tokens, payload)
+    assert slow_frame.get_frame() == fast_frame.get_frame()
+
+    for name, elapsed in (("add_item loop", slow), ("from_tokens", fast)):
+        print("%-14s %8.3f s  %12.0f notifications/s" % (name, elapsed, args.tokens / elapsed))
+    print("speed-up       %8.1fx" % (slow / fast))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,64 @@
+# -*- coding: utf-8 -*-
+"""
+Measures the memory taken per entry by payload models, frame items and the
+resend buffer of a gateway connection.
+
+    python benchmarks/bench_memory.py --entries 100000
+"""
+import argparse
+import os
+import tracemalloc
+from binascii import b2a_hex
+
+from cuckoo.model.buffers import SentNotificationBuffer
+from cuckoo.model.messages import DataPayload, NotificationPayload, FCMMessage, Frame
+
+
+def allocated(build):
+    """Returns the bytes still allocated by what build() returns, and that result"""
+    tracemalloc.start()
+    before = tracemalloc.get_traced_memory()[0]
+    result = build()
+    used = tracemalloc.get_traced_memory()[0] - before
+    tracemalloc.stop()
+    return used, result
+
+
+def per_entry(name, entries, build):
+    used, _ = allocated(build)
+    print("%-34s %10.1f bytes per entry" % (name, used / float(entries)))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--entries', type=int, default=100000)
+    args = parser.parse_args()
+    n = args.entries
+
+    tokens = [b2a_hex(os.urandom(32)).decode('ascii') for _ in range(n)]
+    payload = DataPayload(alert="Campaign message", badge=1, sound="default").compile()
+
+    per_entry("DataPayload", n, lambda: [DataPayload(alert=u"Hi", badge=i) for i in range(n)])
+    per_entry("NotificationPayload", n, lambda: [NotificationPayload(title=u"Hi", body=u"there") for _ in range(n)])
+    per_entry("FCMMessage", n, lambda: [FCMMessage("apikey", data={}) for _ in range(n)])
+
+    def build_frame():
+        frame = Frame()
+        for identifier, token in enumerate(tokens):
+            frame.add_item(token, payload, identifier, 0, 10)
+        return frame
+    frame_bytes, frame = allocated(build_frame)
+    item_size = len(frame.get_frame()) // n
+    print("%-34s %10.1f bytes per entry (%d of them wire data)" % ("Frame.add_item", frame_bytes / float(n), item_size))
+
+    records = list(frame.records())
+
+    def build_buffer():
+        buff = SentNotificationBuffer(n)
+        buff.extend(records)
+        return buff
+    per_entry("SentNotificationBuffer overhead", n, build_buffer)
+
+
+if __name__ == '__main__':
+    main()
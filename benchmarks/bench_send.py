@@ -0,0 +1,190 @@
+# -*- coding: utf-8 -*-
+"""
+Measures sending through GatewayConnection and FCMMessage against local mock
+APNs and FCM servers.
+
+    python benchmarks/bench_send.py --notifications 20000
+    python benchmarks/bench_send.py --scenario recovery --fail-every 5000
+
+Reports notifications per second, p50/p99 latency from the send call to the
+arrival at the server, the time the gateway took to recover from injected
+error-responses and the memory taken per notification in the resend buffer.
+The certificate of the mock gateway is generated with openssl.
+"""
+import argparse
+import logging
+import os
+import shutil
+import tempfile
+import time
+import tracemalloc
+from binascii import b2a_hex
+
+from cuckoo.model.buffers import SentNotificationBuffer
+from cuckoo.model.connections import GatewayConnection
+from cuckoo.model.fcm import FCMClient
+from cuckoo.model.messages import DataPayload, FCMMessage, Frame
+
+from servers import MockAPNsServer, MockFCMServer, ServerProcess, make_certificate
+
+SCENARIOS = ('single', 'frame', 'recovery', 'fcm', 'memory')
+WAIT_SEC = 120
+
+
+def percentile(values, fraction):
+    if not values:
+        return float('nan')
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * fraction))]
+
+
+def report(name, count, elapsed, latencies=None, extra=""):
+    line = "%-9s %8d notifications %8.3f s %10.0f/s" % (name, count, elapsed, count / elapsed)
+    if latencies:
+        line += "  p50 %7.2f ms  p99 %7.2f ms" % (percentile(latencies, 0.5) * 1000, percentile(latencies, 0.99) * 1000)
+    print(line + extra)
+
+
+def random_tokens(count):
+    return [b2a_hex(os.urandom(32)).decode('ascii') for _ in range(count)]
+
+
+def latencies(sent_at, arrivals):
+    return [arrivals[identifier] - start for identifier, start in sent_at.items() if identifier in arrivals]
+
+
+def run_gateway(args, certificate, payload, tokens, frame_size=None, fail_ids=()):
+    server = ServerProcess(MockAPNsServer, cert_file=certificate[0], key_file=certificate[1],
+                           fail_ids=fail_ids, read_delay=args.read_delay)
+    gateway = GatewayConnection(server='127.0.0.1', port=server.port)
+    gateway.send_notification(tokens[0], payload, len(tokens))  # connect and warm up
+    expected = len(tokens) + 1 - len(fail_ids)
+    sent_at = {}
+    start = time.monotonic()
+    if frame_size is None:
+        for identifier, token in enumerate(tokens):
+            sent_at[identifier] = time.monotonic()
+            gateway.send_notification(token, payload, identifier)
+    else:
+        for first in range(0, len(tokens), frame_size):
+            frame = Frame.from_tokens(tokens[first:first + frame_size], payload, first)
+            now = time.monotonic()
+            sent_at.update((identifier, now) for identifier in frame.item_identifiers)
+            gateway.send_notification_multiple(frame)
+    done = server.wait_for(expected, WAIT_SEC)
+    arrivals = server.arrivals()
+    recovery_times = list(gateway.recovery_times)
+    gateway.close()
+    server.stop()
+    if done is None:
+        print("only %d of %d notifications arrived" % (len(arrivals), expected))
+        done = time.monotonic()
+    for identifier in fail_ids:
+        sent_at.pop(identifier, None)
+    return done - start, latencies(sent_at, arrivals), recovery_times
+
+
+def bench_single(args, certificate, payload):
+    tokens = random_tokens(args.notifications)
+    elapsed, lats, _ = run_gateway(args, certificate, payload, tokens)
+    report("single", len(tokens), elapsed, lats)
+
+
+def bench_frame(args, certificate, payload):
+    tokens = random_tokens(args.notifications)
+    elapsed, lats, _ = run_gateway(args, certificate, payload, tokens, frame_size=args.frame_size)
+    report("frame", len(tokens), elapsed, lats, "  (%d per frame)" % args.frame_size)
+
+
+def bench_recovery(args, certificate, payload):
+    tokens = random_tokens(args.notifications)
+    fail_ids = range(args.fail_every, len(tokens), args.fail_every)
+    elapsed, lats, recovery_times = run_gateway(args, certificate, payload, tokens, frame_size=args.frame_size,
+                                                fail_ids=fail_ids)
+    extra = ""
+    if recovery_times:
+        extra = "  %d recoveries, mean %.1f ms, max %.1f ms" % (
+            len(recovery_times), sum(recovery_times) / len(recovery_times) * 1000, max(recovery_times) * 1000)
+    report("recovery", len(tokens), elapsed, lats, extra)
+
+
+def bench_fcm(args, certificate, payload):
+    server = ServerProcess(MockFCMServer, delay=args.fcm_delay)
+    client = FCMClient(url="http://127.0.0.1:%d/fcm/send" % server.port)
+    message = FCMMessage("apikey", data={"message": "Campaign message"}).compile()
+    tokens = random_tokens(args.fcm_messages)
+    message.send(tokens[0], client=client)  # connect and warm up
+    lats = []
+    start = time.monotonic()
+    for token in tokens:
+        sent = time.monotonic()
+        message.send(token, client=client)
+        lats.append(time.monotonic() - sent)
+    elapsed = time.monotonic() - start
+    client.close()
+    server.stop()
+    report("fcm", len(tokens), elapsed, lats)
+
+
+def buffered_bytes(messages, journal_dir=None):
+    journal = None
+    if journal_dir:
+        from cuckoo.model.journal import OutboxJournal
+        journal = OutboxJournal(journal_dir)
+    tracemalloc.start()
+    before = tracemalloc.get_traced_memory()[0]
+    buff = SentNotificationBuffer(len(messages), journal=journal)
+    for identifier, message in enumerate(messages):
+        buff.append(identifier, message)
+    used = tracemalloc.get_traced_memory()[0] - before
+    tracemalloc.stop()
+    if journal is not None:
+        journal.close()
+    return used
+
+
+def bench_memory(args, certificate, payload):
+    tokens = random_tokens(args.notifications)
+    gateway = GatewayConnection()
+    # the messages themselves are counted as they are built by the send path
+    tracemalloc.start()
+    before = tracemalloc.get_traced_memory()[0]
+    messages = [gateway._get_enhanced_notification(token, payload, i, 0) for i, token in enumerate(tokens)]
+    message_bytes = tracemalloc.get_traced_memory()[0] - before
+    tracemalloc.stop()
+    index_bytes = buffered_bytes([b'' for _ in messages])
+    print("memory    %8.1f bytes per buffered notification (%.1f message, %.1f buffer)" % (
+        (message_bytes + index_bytes) / len(messages), message_bytes / len(messages), index_bytes / len(messages)))
+    journal_dir = tempfile.mkdtemp(prefix='cuckoo-journal-')
+    try:
+        journaled = buffered_bytes(messages, journal_dir)
+    finally:
+        shutil.rmtree(journal_dir)
+    print("memory    %8.1f bytes per journaled notification held in process memory" % (journaled / len(messages)))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--scenario', choices=SCENARIOS, action='append')
+    parser.add_argument('--notifications', type=int, default=20000)
+    parser.add_argument('--frame-size', type=int, default=1000)
+    parser.add_argument('--fail-every', type=int, default=5000,
+                        help="answer every n-th identifier with an invalid-token error-response")
+    parser.add_argument('--read-delay', type=float, default=0.0, help="seconds the gateway sleeps before each read")
+    parser.add_argument('--fcm-messages', type=int, default=2000)
+    parser.add_argument('--fcm-delay', type=float, default=0.0, help="seconds FCM takes to answer")
+    parser.add_argument('--verbose', action='store_true')
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO if args.verbose else logging.ERROR)
+
+    certificate = make_certificate()
+    payload = DataPayload(alert="Campaign message", badge=1, sound="default").compile()
+    try:
+        for scenario in args.scenario or SCENARIOS:
+            globals()['bench_' + scenario](args, certificate, payload)
+    finally:
+        shutil.rmtree(os.path.dirname(certificate[0]))
+
+
+if __name__ == '__main__':
+    main()
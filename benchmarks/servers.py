@@ -0,0 +1,287 @@
+# -*- coding: utf-8 -*-
+"""
+Local stand-ins for the APNs gateway and FCM used by the benchmarks.
+
+MockAPNsServer speaks the APNs binary protocol over TLS, answers chosen
+identifiers with an error-response and can read slowly; MockFCMServer
+answers FCM HTTP requests. ServerProcess runs either of them in a child
+process, so the server does not compete with the measured client for the
+GIL.
+"""
+import json
+import multiprocessing
+import os
+import socket
+import ssl
+import subprocess
+import tempfile
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from struct import Struct
+
+ERROR_RESPONSE = Struct('!BBI')
+ENHANCED_HEADER = Struct('!BII')  # command, identifier, expiry
+FRAME_HEADER = Struct('!BI')
+ITEM_HEADER = Struct('!BH')
+UINT = Struct('!I')
+USHORT = Struct('!H')
+STATUS_INVALID_TOKEN = 8
+LINGER_SEC = 0.5
+
+
+def make_certificate(directory=None):
+    """Creates a self-signed certificate with openssl, returns (cert_file, key_file)"""
+    directory = directory or tempfile.mkdtemp(prefix='cuckoo-bench-')
+    cert_file = os.path.join(directory, 'server.crt')
+    key_file = os.path.join(directory, 'server.key')
+    subprocess.check_call(['openssl', 'req', '-x509', '-newkey', 'rsa:2048', '-nodes', '-days', '1',
+                           '-subj', '/CN=localhost', '-keyout', key_file, '-out', cert_file],
+                          stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    return cert_file, key_file
+
+
+class MockAPNsServer(object):
+    """
+    A TLS server parsing enhanced (command 1) notifications and frames
+    (command 2). It records when every identifier first arrived and, for
+    an identifier in fail_ids, sends an error-response once and closes the
+    connection like APNs does, dropping whatever followed it. read_delay
+    sleeps before every read to simulate a slow gateway.
+    """
+
+    def __init__(self, cert_file, key_file, fail_ids=(), status=STATUS_INVALID_TOKEN, read_delay=0.0,
+                 host='127.0.0.1', port=0):
+        super(MockAPNsServer, self).__init__()
+        self.fail_ids = set(fail_ids)
+        self.status = status
+        self.read_delay = read_delay
+        self.arrivals = {}
+        self.received = 0
+        self.errors_sent = 0
+        self._context = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)
+        self._context.load_cert_chain(cert_file, key_file)
+        self._socket = socket.socket()
+        self._socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self._socket.bind((host, port))
+        self._socket.listen(128)
+        self.port = self._socket.getsockname()[1]
+        self._lock = threading.Lock()
+
+    def start(self):
+        thread = threading.Thread(target=self._accept, name=self.__class__.__name__)
+        thread.daemon = True
+        thread.start()
+
+    def stop(self):
+        self._socket.close()
+
+    def _accept(self):
+        while True:
+            try:
+                client, _ = self._socket.accept()
+            except OSError:
+                return
+            thread = threading.Thread(target=self._handle, args=(client,))
+            thread.daemon = True
+            thread.start()
+
+    def _handle(self, client):
+        try:
+            connection = self._context.wrap_socket(client, server_side=True)
+        except (OSError, ssl.SSLError):
+            client.close()
+            return
+        buff = bytearray()
+        try:
+            while True:
+                if self.read_delay:
+                    time.sleep(self.read_delay)
+                chunk = connection.recv(65536)
+                if not chunk:
+                    return
+                buff += chunk
+                offset = self._parse(connection, buff)
+                if offset is None:
+                    return
+                del buff[:offset]
+        except (OSError, ssl.SSLError):
+            return
+        finally:
+            connection.close()
+
+    def _parse(self, connection, buff):
+        """Handles the complete notifications in buff, returns the bytes consumed or None to hang up"""
+        offset = 0
+        now = time.monotonic()
+        while len(buff) - offset >= 5:
+            command = buff[offset]
+            if command == 1:
+                if len(buff) - offset < 45:
+                    break
+                end = offset + 45 + USHORT.unpack_from(buff, offset + 43)[0]
+                if end > len(buff):
+                    break
+                identifier = ENHANCED_HEADER.unpack_from(buff, offset)[1]
+            elif command == 2:
+                end = offset + 5 + FRAME_HEADER.unpack_from(buff, offset)[1]
+                if end > len(buff):
+                    break
+                identifier = self._frame_identifier(buff, offset + 5, end)
+            else:
+                return None
+            offset = end
+            if identifier in self.fail_ids:
+                with self._lock:
+                    self.fail_ids.discard(identifier)
+                    self.errors_sent += 1
+                connection.sendall(ERROR_RESPONSE.pack(8, self.status, identifier))
+                self._linger(connection)
+                return None
+            with self._lock:
+                self.received += 1
+                self.arrivals.setdefault(identifier, now)
+        return offset
+
+    def _frame_identifier(self, buff, offset, end):
+        while offset < end:
+            item_id, item_length = ITEM_HEADER.unpack_from(buff, offset)
+            if item_id == 3:
+                return UINT.unpack_from(buff, offset + 3)[0]
+            offset += 3 + item_length
+        return None
+
+    def _linger(self, connection):
+        # read on for a moment before closing, so the client receives the
+        # error-response instead of a reset
+        connection.settimeout(0.1)
+        deadline = time.monotonic() + LINGER_SEC
+        try:
+            while time.monotonic() < deadline and connection.recv(65536):
+                pass
+        except (OSError, ssl.SSLError):
+            pass
+
+
+class StalledAPNsServer(MockAPNsServer):
+    """A gateway which completes the TLS handshake, then neither reads nor closes until released"""
+
+    def __init__(self, cert_file, key_file, **kwargs):
+        super(StalledAPNsServer, self).__init__(cert_file, key_file, **kwargs)
+        self._released = threading.Event()
+
+    def release(self):
+        self._released.set()
+
+    def _handle(self, client):
+        try:
+            connection = self._context.wrap_socket(client, server_side=True)
+        except (OSError, ssl.SSLError):
+            client.close()
+            return
+        self._released.wait()
+        connection.close()
+
+
+class _FCMHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def setup(self):
+        BaseHTTPRequestHandler.setup(self)
+        # headers and body are written separately, which Nagle's algorithm
+        # would hold back for a delayed ACK
+        self.connection.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+
+    def log_message(self, *args):
+        pass
+
+    def do_POST(self):
+        body = json.loads(self.rfile.read(int(self.headers['Content-Length'])))
+        if self.server.delay:
+            time.sleep(self.server.delay)
+        tokens = body.get('registration_ids') or [body.get('to')]
+        results = [{'message_id': '0:%d' % i} for i in range(len(tokens))]
+        with self.server.lock:
+            self.server.received += len(tokens)
+        response = json.dumps({'multicast_id': 1, 'success': len(tokens), 'failure': 0, 'canonical_ids': 0,
+                               'results': results}).encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(response)))
+        self.end_headers()
+        self.wfile.write(response)
+
+
+class MockFCMServer(ThreadingHTTPServer):
+    """An HTTP server answering every FCM request with success, after delay seconds"""
+    daemon_threads = True
+
+    def __init__(self, delay=0.0, host='127.0.0.1', port=0):
+        ThreadingHTTPServer.__init__(self, (host, port), _FCMHandler)
+        self.delay = delay
+        self.received = 0
+        self.lock = threading.Lock()
+        self.port = self.server_address[1]
+        self.arrivals = {}
+
+    def start(self):
+        thread = threading.Thread(target=self.serve_forever, name=self.__class__.__name__)
+        thread.daemon = True
+        thread.start()
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+
+
+def _serve(pipe, server_class, kwargs):
+    server = server_class(**kwargs)
+    server.start()
+    pipe.send(server.port)
+    while True:
+        command = pipe.recv()
+        if command == 'received':
+            pipe.send(server.received)
+        elif command == 'arrivals':
+            pipe.send(server.arrivals)
+        elif command == 'stop':
+            server.stop()
+            pipe.send(None)
+            return
+
+
+class ServerProcess(object):
+    """Runs a MockAPNsServer or MockFCMServer in a child process"""
+
+    def __init__(self, server_class, **kwargs):
+        super(ServerProcess, self).__init__()
+        self._pipe, child = multiprocessing.Pipe()
+        self._process = multiprocessing.Process(target=_serve, args=(child, server_class, kwargs))
+        self._process.daemon = True
+        self._process.start()
+        self.port = self._pipe.recv()
+
+    def _call(self, command):
+        self._pipe.send(command)
+        return self._pipe.recv()
+
+    @property
+    def received(self):
+        return self._call('received')
+
+    def arrivals(self):
+        """Returns when every identifier first arrived, on the time.monotonic clock"""
+        return self._call('arrivals')
+
+    def wait_for(self, count, timeout):
+        """Waits until the server received count notifications, returns when that happened or None"""
+        deadline = time.monotonic() + timeout
+        while time.monotonic() < deadline:
+            if self.received >= count:
+                return time.monotonic()
+            time.sleep(0.005)
+        return None
+
+    def stop(self):
+        self._call('stop')
+        self._process.join()
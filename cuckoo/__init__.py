@@ -1,2 +1,5 @@
-from cuckoo.model.connections import APNService
-from cuckoo.model.messages import DataPayload, NotificationPayload, Frame, FCMMessage
+from cuckoo.model.connections import APNService, APNServiceRegistry
+from cuckoo.model.messages import DataPayload, NotificationPayload, CompiledPayload, Frame, FCMMessage
+from cuckoo.model.fcm import FCMClient
+from cuckoo.model.templates import PayloadTemplate, Slot, RawSlot
+from cuckoo.model.metrics import MetricsRegistry, enable_metrics, disable_metrics
@@ -0,0 +1,120 @@
+# -*- coding: utf-8 -*-
+"""
+Sends one notification to every token of a file through the APNs gateway.
+
+    cuckoo-broadcast tokens.txt --cert push.pem --alert "Hello" --checkpoint campaign.json
+
+The token file holds one hex token per line or packed 32-byte binary
+tokens. Throughput is printed while sending; an interrupted broadcast
+run again with the same --checkpoint resumes after the last frame sent.
+"""
+import argparse
+import json
+import logging
+import sys
+import time
+
+from cuckoo.model.broadcast import Broadcast, TokenFile, FRAME_SIZE, TOKEN_FORMAT_HEX, TOKEN_FORMAT_BINARY
+from cuckoo.model.connections import GatewayConnection, GatewayConnectionPool
+from cuckoo.model.messages import CompiledPayload, DataPayload, MAX_PAYLOAD_LENGTH, PayloadTooLargeError
+
+PROGRESS_INTERVAL_SEC = 1.0
+
+
+def _parser():
+    parser = argparse.ArgumentParser(prog='cuckoo-broadcast', description=__doc__.strip().splitlines()[0])
+    parser.add_argument('tokens', help="token file, one hex token per line or packed binary tokens")
+    parser.add_argument('--format', choices=(TOKEN_FORMAT_HEX, TOKEN_FORMAT_BINARY),
+                        help="format of the token file, detected by default")
+    parser.add_argument('--cert', help="certificate file")
+    parser.add_argument('--key', help="key file, if not in the certificate file")
+    parser.add_argument('--sandbox', action='store_true', help="use the sandbox gateway")
+    parser.add_argument('--server', help="gateway host replacing the APNs one")
+    parser.add_argument('--port', type=int, help="gateway port replacing the APNs one")
+    parser.add_argument('--connections', type=int, default=1, help="gateway connections to spread frames over")
+    parser.add_argument('--journal-dir', help="journal sent notifications to this directory")
+    parser.add_argument('--alert', help="alert text")
+    parser.add_argument('--badge', type=int, help="badge number")
+    parser.add_argument('--sound', help="sound name")
+    parser.add_argument('--payload', help="the whole payload as JSON, instead of --alert, --badge and --sound")
+    parser.add_argument('--expiry', type=int, default=0, help="unix time after which APNs drops the notification")
+    parser.add_argument('--priority', type=int, default=10, choices=(5, 10))
+    parser.add_argument('--first-identifier', type=int, default=0, help="identifier of the first token of the file")
+    parser.add_argument('--frame-size', type=int, default=FRAME_SIZE, help="notifications per frame")
+    parser.add_argument('--workers', type=int, help="encoding processes, 0 to encode in this process")
+    parser.add_argument('--in-flight', type=int, help="frames being encoded or waiting to be sent at most")
+    parser.add_argument('--checkpoint', help="file to save progress to and resume from")
+    parser.add_argument('--verbose', action='store_true')
+    return parser
+
+
+def _payload(args):
+    if args.payload:
+        payload = CompiledPayload(json.dumps(json.loads(args.payload), separators=(',', ':'),
+                                             ensure_ascii=False).encode('utf-8'))
+        if payload.length > MAX_PAYLOAD_LENGTH:
+            raise PayloadTooLargeError(payload.length)
+        return payload
+    return DataPayload(alert=args.alert, badge=args.badge, sound=args.sound).compile()
+
+
+def _gateway(args):
+    kwargs = dict(sandbox=args.sandbox, cert_file=args.cert, key_file=args.key, server=args.server,
+                  port=args.port, journal_dir=args.journal_dir)
+    if args.connections > 1:
+        return GatewayConnectionPool(args.connections, **kwargs)
+    return GatewayConnection(**kwargs)
+
+
+class _Progress(object):
+    """Prints the throughput of a broadcast at most every PROGRESS_INTERVAL_SEC"""
+
+    def __init__(self, stream):
+        super(_Progress, self).__init__()
+        self.stream = stream
+        self._printed = 0.0
+
+    def __call__(self, broadcast, force=False):
+        now = time.time()
+        if not force and now - self._printed < PROGRESS_INTERVAL_SEC:
+            return
+        self._printed = now
+        size = broadcast.tokens.size
+        done = 100.0 * broadcast.offset / size if size else 100.0
+        self.stream.write("\r%10d sent %10.0f/s %6.1f%% %8.1f s" % (
+            broadcast.sent, broadcast.rate, done, broadcast.elapsed))
+        self.stream.flush()
+
+
+def main(argv=None):
+    args = _parser().parse_args(argv)
+    logging.basicConfig(level=logging.INFO if args.verbose else logging.WARNING)
+    payload = _payload(args)
+    tokens = TokenFile(args.tokens, args.format)
+    gateway = _gateway(args)
+    broadcast = Broadcast(gateway, tokens, payload, frame_size=args.frame_size, workers=args.workers,
+                          max_in_flight=args.in_flight, first_identifier=args.first_identifier,
+                          expiry=args.expiry, priority=args.priority, checkpoint=args.checkpoint)
+    progress = _Progress(sys.stdout)
+    interrupted = False
+    try:
+        broadcast.run(progress)
+    except KeyboardInterrupt:
+        interrupted = True
+    finally:
+        progress(broadcast, force=True)
+        sys.stdout.write("\n")
+        # waits for the resends of late error-responses and for the gateway to read everything
+        clean = gateway.close()
+        broadcast.close()
+    if interrupted:
+        sys.stdout.write("interrupted, run again with the same --checkpoint to resume\n")
+        return 1
+    if not clean:
+        sys.stdout.write("the gateway connection was not closed cleanly, the last notifications may be lost\n")
+        return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,249 @@
+# -*- coding: utf-8 -*-
+import collections
+import json
+import logging
+import mmap
+import os
+import time
+from concurrent.futures import Future, ProcessPoolExecutor
+
+from cuckoo.model.messages import CompiledPayload, Frame, TOKEN_LENGTH, TOKEN_HEX_LENGTH
+
+TOKEN_FORMAT_HEX = 'hex'
+TOKEN_FORMAT_BINARY = 'binary'
+FRAME_SIZE = 1000
+_HEX_LINE_CHARS = b'0123456789abcdefABCDEF\r\n'
+_DETECT_BYTES = 4096
+
+logger = logging.getLogger("cuckoo")
+
+
+class TokenFile(object):
+    """
+    Device tokens read from a memory-mapped file holding either one hex
+    token per line or packed 32-byte binary tokens. The format is detected
+    from the start of the file unless given. The file is split into byte
+    ranges of about the same number of tokens, and only the tokens of a
+    range being read are copied out of the mapping.
+
+    Tokens are numbered by their position: the token on line i, or the
+    i-th binary token, has index i. Blank lines are read as b'' but keep
+    their index, so splitting a file never renumbers its tokens.
+    """
+
+    def __init__(self, path, format=None):
+        super(TokenFile, self).__init__()
+        self.path = path
+        self._file = open(path, 'rb')
+        self.size = os.fstat(self._file.fileno()).st_size
+        # an empty file can not be mapped
+        self._data = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ) if self.size else b''
+        self.format = format or self._detect()
+        if self.format not in (TOKEN_FORMAT_HEX, TOKEN_FORMAT_BINARY):
+            raise ValueError("unknown token file format: %s" % self.format)
+        if self.format == TOKEN_FORMAT_BINARY and self.size % TOKEN_LENGTH:
+            raise ValueError("%s is not a whole number of %d-byte tokens" % (path, TOKEN_LENGTH))
+
+    def _detect(self):
+        sample = self._data[:_DETECT_BYTES]
+        if sample.translate(None, _HEX_LINE_CHARS):
+            return TOKEN_FORMAT_BINARY
+        return TOKEN_FORMAT_HEX
+
+    def ranges(self, size, offset=0):
+        """
+        Yields (start, end, count) for consecutive byte ranges of about size
+        tokens from the byte offset on, count being the number of tokens or
+        lines in the range.
+        """
+        data = self._data
+        if self.format == TOKEN_FORMAT_BINARY:
+            step = size * TOKEN_LENGTH
+            for start in range(offset, self.size, step):
+                end = min(start + step, self.size)
+                yield start, end, (end - start) // TOKEN_LENGTH
+            return
+        start = offset
+        while start < self.size:
+            # the size-th newline if every line is a bare hex token
+            end = data.find(b'\n', start + size * (TOKEN_HEX_LENGTH + 1) - 1)
+            end = self.size if end < 0 else end + 1
+            count = data[start:end].count(b'\n')
+            if data[end - 1:end] != b'\n':
+                count += 1
+            yield start, end, count
+            start = end
+
+    def tokens(self, start, end):
+        """Returns the tokens of a range yielded by ranges() as bytes, hex or binary as in the file"""
+        data = self._data
+        if self.format == TOKEN_FORMAT_BINARY:
+            return [data[i:i + TOKEN_LENGTH] for i in range(start, end, TOKEN_LENGTH)]
+        return [line.strip() for line in data[start:end].splitlines()]
+
+    def close(self):
+        if self.size:
+            self._data.close()
+        self._file.close()
+
+
+class Checkpoint(object):
+    """
+    How far a broadcast got: the byte offset in the token file and the
+    index of the next token, saved as JSON after every frame handed to the
+    gateway. The file is replaced atomically, so it always holds a
+    consistent position.
+    """
+
+    def __init__(self, path):
+        super(Checkpoint, self).__init__()
+        self.path = path
+        self.offset = 0
+        self.index = 0
+        if os.path.exists(path):
+            with open(path) as f:
+                state = json.load(f)
+            self.offset = state['offset']
+            self.index = state['index']
+
+    def save(self, offset, index):
+        self.offset = offset
+        self.index = index
+        temporary = self.path + '.tmp'
+        with open(temporary, 'w') as f:
+            json.dump({'offset': offset, 'index': index}, f)
+        os.replace(temporary, self.path)
+
+
+class _DeadTokens(frozenset):
+    """The tokens of one range not to send, standing in for a TokenRegistry in the encoding processes"""
+
+    def is_dead(self, token):
+        return token in self
+
+
+def _frame(tokens, payload_data, first_identifier, expiry, priority, dead):
+    skip = set(dead or ())
+    if b'' in tokens:
+        skip.add(b'')
+    frame = Frame.from_tokens(tokens, CompiledPayload(payload_data), first_identifier, expiry, priority,
+                              _DeadTokens(skip) if skip else None)
+    frame.token_registry = None
+    return frame
+
+
+# token files opened by an encoding process, by path
+_token_files = {}
+
+
+def _encode_frame(path, format, start, end, payload_data, first_identifier, expiry, priority, dead):
+    """Encodes the tokens of a range in an encoding process, which maps the token file itself"""
+    token_file = _token_files.get(path)
+    if token_file is None:
+        token_file = _token_files[path] = TokenFile(path, format)
+    return _frame(token_file.tokens(start, end), payload_data, first_identifier, expiry, priority, dead)
+
+
+class Broadcast(object):
+    """
+    Sends one payload to every token of a TokenFile through a gateway
+    connection or pool.
+
+    The file is cut into ranges of about frame_size tokens which a pool of
+    `workers` processes reads and encodes into Frames, or this process with
+    workers=0; only byte offsets and the encoded frames pass between the
+    processes. At most max_in_flight frames are being encoded or waiting to
+    be written at any time, so memory stays bounded however large the file
+    is; frames are written in file order. The token at index i of the file
+    gets identifier first_identifier + i.
+
+    With a TokenRegistry the tokens it knows to be dead are read in this
+    process and left out of the frames.
+
+    With a checkpoint path the position after every written frame is saved
+    there and a later run resumes from it. A written frame may still be
+    resent by the gateway after an error-response, so the checkpoint marks
+    what was handed to the connection, not what APNs accepted.
+    """
+
+    def __init__(self, gateway, tokens, payload, frame_size=FRAME_SIZE, workers=None, max_in_flight=None,
+                 first_identifier=0, expiry=0, priority=10, checkpoint=None, token_registry=None):
+        super(Broadcast, self).__init__()
+        self.gateway = gateway
+        self.tokens = tokens if isinstance(tokens, TokenFile) else TokenFile(tokens)
+        self.payload = payload
+        self.frame_size = frame_size
+        self.workers = os.cpu_count() if workers is None else workers
+        self.max_in_flight = max_in_flight or max(2 * self.workers, 2)
+        self.first_identifier = first_identifier
+        self.expiry = expiry
+        self.priority = priority
+        self.checkpoint = Checkpoint(checkpoint) if checkpoint else None
+        self.token_registry = token_registry
+        self.sent = 0
+        self.skipped = 0
+        self.offset = self.checkpoint.offset if self.checkpoint else 0
+        self._started = None
+
+    @property
+    def elapsed(self):
+        return time.time() - self._started if self._started else 0.0
+
+    @property
+    def rate(self):
+        """Notifications sent per second so far"""
+        elapsed = self.elapsed
+        return self.sent / elapsed if elapsed else 0.0
+
+    def run(self, progress=None):
+        """
+        Sends to every token after the checkpoint and returns the number of
+        notifications sent. progress, if given, is called with the
+        Broadcast after every frame.
+        """
+        self._started = time.time()
+        index = self.checkpoint.index if self.checkpoint else 0
+        payload_data = self.payload.json()
+        executor = ProcessPoolExecutor(self.workers) if self.workers else None
+        in_flight = collections.deque()
+        try:
+            for start, end, count in self.tokens.ranges(self.frame_size, self.offset):
+                dead = None
+                if self.token_registry is not None:
+                    dead = frozenset(token for token in self.tokens.tokens(start, end)
+                                     if token and self.token_registry.is_dead(token))
+                    self.skipped += len(dead)
+                args = (payload_data, self.first_identifier + index, self.expiry, self.priority, dead)
+                if executor is not None:
+                    future = executor.submit(_encode_frame, self.tokens.path, self.tokens.format, start, end, *args)
+                else:
+                    future = Future()
+                    future.set_result(_frame(self.tokens.tokens(start, end), *args))
+                index += count
+                in_flight.append((future, end, index))
+                if len(in_flight) >= self.max_in_flight:
+                    self._send(in_flight.popleft(), progress)
+            while in_flight:
+                self._send(in_flight.popleft(), progress)
+        finally:
+            for future, _, _ in in_flight:
+                future.cancel()
+            if executor is not None:
+                executor.shutdown()
+        logger.info("broadcast sent %d notifications in %.1f secs, %d skipped", self.sent, self.elapsed, self.skipped)
+        return self.sent
+
+    def _send(self, entry, progress):
+        future, end, index = entry
+        frame = future.result()
+        if frame.item_offsets:
+            self.gateway.send_notification_multiple(frame)
+            self.sent += len(frame.item_offsets)
+        self.offset = end
+        if self.checkpoint is not None:
+            self.checkpoint.save(end, index)
+        if progress is not None:
+            progress(self)
+
+    def close(self):
+        self.tokens.close()
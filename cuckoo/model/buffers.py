@@ -0,0 +1,139 @@
+# -*- coding: utf-8 -*-
+from array import array
+
+
+class SentNotificationBuffer(object):
+    """
+    A bounded ring buffer of sent notifications indexed by identifier.
+
+    Records are kept in send order. Looking up an identifier and dropping
+    every record up to and including it are O(1); when the buffer is full
+    the oldest record is overwritten. Slots are allocated lazily, so an
+    idle connection does not pay for ``maxlen`` empty slots up front.
+
+    If the same identifier is sent more than once, lookups resolve to its
+    first occurrence, so a resend never skips a notification that may not
+    have been delivered.
+
+    Given an OutboxJournal, messages are copied into the journal and the
+    buffer only keeps references to them; they are read back as
+    memoryviews of the journal. Records whose journal segment has been
+    deleted are skipped.
+
+    Identifiers, sequence links and journal references are stored unboxed
+    in arrays, and an identifier sent only once has no entry in the index
+    of last occurrences, so a record costs little more than its message.
+    """
+
+    def __init__(self, maxlen, journal=None):
+        super(SentNotificationBuffer, self).__init__()
+        if maxlen <= 0:
+            raise ValueError("maxlen must be positive")
+        self.maxlen = maxlen
+        self.journal = journal
+        self.clear()
+
+    def __len__(self):
+        return self._tail - self._head
+
+    def __iter__(self):
+        """Yields (identifier, message) pairs from the oldest to the newest"""
+        for seq in range(self._head, self._tail):
+            slot = seq % self.maxlen
+            message = self._messages[slot]
+            if self.journal is not None:
+                message = self.journal.read(message)
+                if message is None:
+                    continue
+            yield self._ids[slot], message
+
+    def append(self, identifier, message):
+        if self.journal is not None:
+            message = self.journal.append(identifier, message)
+        seq = self._tail
+        slot = seq % self.maxlen
+        if slot < len(self._ids):
+            self._evict(slot, seq - self.maxlen)
+            self._ids[slot] = identifier
+            self._messages[slot] = message
+            self._next_same[slot] = -1
+        else:
+            self._ids.append(identifier)
+            self._messages.append(message)
+            self._next_same.append(-1)
+
+        first = self._first.get(identifier)
+        if first is None:
+            self._first[identifier] = seq
+        else:
+            self._next_same[self._last.get(identifier, first) % self.maxlen] = seq
+            self._last[identifier] = seq
+        self._tail = seq + 1
+
+    def _evict(self, slot, seq):
+        """Forgets the record with sequence number seq before its slot is reused"""
+        if seq >= self._head:
+            self._head = seq + 1
+        identifier = self._ids[slot]
+        if self._first.get(identifier) == seq:
+            following = self._next_same[slot]
+            if following < 0:
+                del self._first[identifier]
+                self._last.pop(identifier, None)
+            else:
+                self._first[identifier] = following
+                if self._last.get(identifier) == following:
+                    del self._last[identifier]
+
+    def extend(self, records):
+        """Appends (identifier, message) pairs"""
+        for identifier, message in records:
+            self.append(identifier, message)
+
+    def _seq_of(self, identifier):
+        seq = self._first.get(identifier)
+        if seq is None:
+            return None
+        # skip occurrences that were already dropped
+        while seq < self._head:
+            seq = self._next_same[seq % self.maxlen]
+            if seq < 0:
+                return None
+        self._first[identifier] = seq
+        return seq
+
+    def get(self, identifier):
+        """Returns the message sent with the given identifier, or None"""
+        seq = self._seq_of(identifier)
+        if seq is None:
+            return None
+        message = self._messages[seq % self.maxlen]
+        if self.journal is not None:
+            return self.journal.read(message)
+        return message
+
+    def __contains__(self, identifier):
+        return self._seq_of(identifier) is not None
+
+    def drop_through(self, identifier):
+        """
+        Drops every record up to and including the one with the given
+        identifier. Returns False if the identifier is not in the buffer.
+        """
+        seq = self._seq_of(identifier)
+        if seq is None:
+            return False
+        self._head = seq + 1
+        return True
+
+    def clear(self):
+        self._ids = array('I')
+        self._messages = [] if self.journal is None else array('Q')
+        # sequence number of the next record with the same identifier, or -1
+        self._next_same = array('q')
+        # identifier -> sequence number of its first occurrence and, if it
+        # occurs more than once, of its last one
+        self._first = {}
+        self._last = {}
+        # sequence numbers of the oldest live record and of the next record
+        self._head = self._tail = 0
@@ -0,0 +1,137 @@
+# -*- coding: utf-8 -*-
+import collections
+import logging
+import threading
+import time
+
+from cuckoo.model.messages import Frame
+from cuckoo.model.utils import binary_token
+
+COLLAPSE_WINDOW_SEC = 0.05
+PRIORITY_IMMEDIATE = 10
+
+provider_log = logging.getLogger("cuckoo")
+
+
+class NotificationCollapser(object):
+    """
+    Holds notifications which carry a collapse key for a short window and
+    sends only the newest one queued for the same device and collapse key,
+    e.g. of several badge updates emitted within milliseconds.
+
+    A notification is sent at most `window` seconds after the first one it
+    replaced was queued. APNs notifications due at the same moment for the
+    same gateway go out together in one Frame. FCM messages collapse on
+    their own collapse_key. Notifications without a collapse key are sent
+    right away.
+    """
+
+    def __init__(self, window=COLLAPSE_WINDOW_SEC):
+        super(NotificationCollapser, self).__init__()
+        self.window = window
+        self._pending = {}  # collapse key -> newest (kind, target, args)
+        self._deadlines = collections.deque()  # (deadline, collapse key), oldest first
+        self._condition = threading.Condition(threading.Lock())
+        self._thread = None
+        self._closing = False
+        self.collapsed = 0
+
+    def __len__(self):
+        return len(self._pending)
+
+    def send_notification(self, gateway, token_hex, payload, identifier=0, expiry=0, collapse_key=None,
+                          priority=PRIORITY_IMMEDIATE):
+        """
+        Queues a notification for a GatewayConnection or GatewayConnectionPool,
+        replacing one still queued for the same token and collapse key
+        """
+        if collapse_key is None:
+            return gateway.send_notification(token_hex, payload, identifier, expiry)
+        token = binary_token(token_hex)
+        self._add(('apns', gateway, token, collapse_key),
+                  ('apns', gateway, (token, payload, identifier, expiry, priority)))
+        return True
+
+    def send_fcm(self, message, to):
+        """Queues an FCMMessage, replacing one to the same recipient with the same collapse_key"""
+        if message.collapse_key is None:
+            return message.send(to)
+        self._add(('fcm', message.apikey, to, message.collapse_key), ('fcm', message, (to,)))
+        return True
+
+    def _add(self, key, item):
+        with self._condition:
+            if self._closing:
+                raise RuntimeError("collapser is closed")
+            if key in self._pending:
+                self.collapsed += 1
+            else:
+                self._deadlines.append((time.time() + self.window, key))
+            self._pending[key] = item
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name=self.__class__.__name__)
+                self._thread.daemon = True
+                self._thread.start()
+            self._condition.notify()
+
+    def flush(self):
+        """Sends everything queued now"""
+        with self._condition:
+            items = self._take(None)
+        self._send(items)
+
+    def close(self):
+        """Sends everything queued and stops the sending thread"""
+        with self._condition:
+            self._closing = True
+            self._condition.notify()
+            thread = self._thread
+        if thread is not None:
+            thread.join()
+        self.flush()
+
+    def _take(self, now):
+        """Pops the items due at `now`, or all of them if now is None"""
+        items = []
+        while self._deadlines and (now is None or self._deadlines[0][0] <= now):
+            _, key = self._deadlines.popleft()
+            items.append(self._pending.pop(key))
+        return items
+
+    def _run(self):
+        while True:
+            with self._condition:
+                while not self._closing:
+                    now = time.time()
+                    if self._deadlines and self._deadlines[0][0] <= now:
+                        break
+                    self._condition.wait(self._deadlines[0][0] - now if self._deadlines else None)
+                if self._closing:
+                    self._thread = None
+                    return
+                items = self._take(now)
+            self._send(items)
+
+    def _send(self, items):
+        frames = collections.OrderedDict()
+        for kind, target, args in items:
+            try:
+                if kind == 'fcm':
+                    target.send(*args)
+                else:
+                    frames.setdefault(target, []).append(args)
+            except Exception as e:
+                provider_log.exception("sending collapsed notification failed: %s: %s", type(e).__name__, e)
+        for gateway, notifications in frames.items():
+            try:
+                if len(notifications) == 1:
+                    token, payload, identifier, expiry, _ = notifications[0]
+                    gateway.send_notification(token, payload, identifier, expiry)
+                    continue
+                frame = Frame(token_registry=getattr(gateway, 'token_registry', None))
+                for notification in notifications:
+                    frame.add_item(*notification)
+                if frame.item_offsets:
+                    gateway.send_notification_multiple(frame)
+            except Exception as e:
+                provider_log.exception("sending collapsed notifications failed: %s: %s", type(e).__name__, e)
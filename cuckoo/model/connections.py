@@ -1,23 +1,25 @@
 # -*- coding: utf-8 -*-
 import logging
-from binascii import a2b_hex, b2a_hex
+from binascii import b2a_hex
 from datetime import datetime
 from socket import (
     socket,
+    socketpair,
     timeout,
     AF_INET,
     SOCK_STREAM
 )
 from socket import error as socket_error
-import ssl, select, time, collections, itertools
+import ssl, select, selectors, time, itertools, collections, os
 import threading
-
-try:
-    from ssl import wrap_socket, SSLError
-except ImportError:
-    from socket import ssl as wrap_socket, sslerror as SSLError
+from urllib.parse import quote
 
 from cuckoo.model.utils import *
+from cuckoo.model.buffers import SentNotificationBuffer
+from cuckoo.model.journal import OutboxJournal
+from cuckoo.model.metrics import get_metrics
+from cuckoo.model.feedback import FeedbackParser, FeedbackBatch, FEEDBACK_BATCH_SIZE
+from cuckoo.model.tokens import DEAD_INVALID, STATUS_INVALID_TOKEN
 
 ENHANCED_NOTIFICATION_COMMAND = 1
 ENHANCED_NOTIFICATION_FORMAT = (
@@ -39,28 +41,104 @@ ERROR_RESPONSE_FORMAT = (
 
 TOKEN_LENGTH = 32
 ERROR_RESPONSE_LENGTH = 6
-DELAY_RESEND_SEC = 0.0
 SENT_BUFFER_QTY = 100000
 WAIT_WRITE_TIMEOUT_SEC = 10
 WAIT_READ_TIMEOUT_SEC = 10
 WRITE_RETRY = 3
+REACTOR_TICK_SEC = 1
+COALESCE_BYTES = 65536
+COALESCE_DELAY_SEC = 0.01
+COALESCE_MAX_PENDING = 10000
+RESEND_CHUNK_BYTES = 65536
+RECOVERY_HISTORY = 100
+CLOSE_TIMEOUT_SEC = 10
+CLOSE_POLL_SEC = 0.01
+
+BACKPRESSURE_BLOCK = 'block'
+BACKPRESSURE_FAIL = 'fail'
+BACKPRESSURE_DROP_OLDEST = 'drop_oldest'
 
 TIMEOUT_IDLE = 15
+MAX_CONNECTIONS = 100
+TIMEOUT_IDLE_SERVICE = 300
+
+DISPATCH_ROUND_ROBIN = 'round_robin'
+DISPATCH_LEAST_LOADED = 'least_loaded'
 
 provider_log = logging.getLogger("cuckoo")
 
+_ssl_contexts = {}
+_ssl_contexts_lock = threading.Lock()
+
+
+def get_ssl_context(cert_file=None, key_file=None):
+    """
+    Returns the SSLContext shared by every connection using the given
+    certificate, so the certificate is only loaded once and TLS sessions can
+    be resumed across reconnects. Like ssl.wrap_socket, which connections
+    used before, it does not verify the server certificate.
+    """
+    key = (cert_file, key_file)
+    with _ssl_contexts_lock:
+        context = _ssl_contexts.get(key)
+        if context is None:
+            context = ssl.SSLContext(ssl.PROTOCOL_TLS_CLIENT)
+            context.check_hostname = False
+            context.verify_mode = ssl.CERT_NONE
+            if cert_file:
+                context.load_cert_chain(cert_file, key_file)
+            _ssl_contexts[key] = context
+        return context
+
+
+def encode_enhanced_notification(token_hex, payload, identifier, expiry):
+    """
+    Returns a notification in the enhanced (command 1) format. token_hex may
+    also be the 32-byte binary token.
+    """
+    token = binary_token(token_hex)
+    payload = payload.json()
+    fmt = ENHANCED_NOTIFICATION_FORMAT % len(payload)
+    return pack(fmt, ENHANCED_NOTIFICATION_COMMAND, identifier, expiry, TOKEN_LENGTH, token, len(payload), payload)
+
+
+class QueueFullError(Exception):
+    """Raised by a queueing gateway connection with the 'fail' backpressure policy"""
+    def __init__(self, queue_depth):
+        super(QueueFullError, self).__init__()
+        self.queue_depth = queue_depth
+
 
 class APNService:
 
-    def __init__(self, cert_file=None, key_file=None, sandbox=False):
+    def __init__(self, cert_file=None, key_file=None, sandbox=False, gateway_connections=1,
+                 dispatch=DISPATCH_ROUND_ROBIN, shared_reactor=False, token_registry=None, journal_dir=None):
         """
         Set use_sandbox to True to use the sandbox (test) APNs servers.
         Default is False.
+
+        With gateway_connections greater than 1 the gateway server is a
+        GatewayConnectionPool spreading notifications over that many
+        connections, either round-robin or to the least loaded one.
+
+        Set shared_reactor to True to read error-responses of all gateway
+        connections from one shared thread instead of one thread each.
+
+        With a TokenRegistry, tokens it knows to be dead are not sent and
+        invalid-token error-responses are recorded in it.
+
+        With a journal_dir sent notifications are journaled to disk there, so
+        they survive a restart and the resend buffers stay small.
         """
         super(APNService, self).__init__()
         self.sandbox = sandbox
         self.cert_file = cert_file
         self.key_file = key_file
+        self.gateway_connections = gateway_connections
+        self.dispatch = dispatch
+        self.shared_reactor = shared_reactor
+        self.token_registry = token_registry
+        self.journal_dir = journal_dir
         self._feedback_connection = None
         self._gateway_connection = None
 
@@ -77,26 +155,205 @@ class APNService:
     @property
     def gateway_server(self):
         if not self._gateway_connection:
-            self._gateway_connection = GatewayConnection(
-                sandbox = self.sandbox,
-                cert_file = self.cert_file,
-                key_file = self.key_file
-            )
+            if self.gateway_connections > 1:
+                self._gateway_connection = GatewayConnectionPool(
+                    self.gateway_connections,
+                    dispatch = self.dispatch,
+                    sandbox = self.sandbox,
+                    shared_reactor = self.shared_reactor,
+                    token_registry = self.token_registry,
+                    journal_dir = self.journal_dir,
+                    cert_file = self.cert_file,
+                    key_file = self.key_file
+                )
+            else:
+                self._gateway_connection = GatewayConnection(
+                    sandbox = self.sandbox,
+                    shared_reactor = self.shared_reactor,
+                    token_registry = self.token_registry,
+                    journal_dir = self.journal_dir,
+                    cert_file = self.cert_file,
+                    key_file = self.key_file
+                )
         return self._gateway_connection
 
+    def open_connections(self):
+        """Returns how many gateway and feedback connections this service has created"""
+        count = 0
+        if self._gateway_connection:
+            count += self.gateway_connections
+        if self._feedback_connection:
+            count += 1
+        return count
+
+    def close(self):
+        """
+        Closes the gateway and feedback connections and drops them along with
+        their buffers; they are created again on the next use
+        """
+        if self._gateway_connection:
+            self._gateway_connection.close()
+            self._gateway_connection = None
+        if self._feedback_connection:
+            self._feedback_connection._disconnect()
+            self._feedback_connection = None
+
+
+class APNServiceRegistry(object):
+    """
+    APNService objects of many apps, each with its own certificate, created
+    when an app is first used.
+
+    At most max_connections gateway and feedback connections are kept open
+    across all apps: when a service goes over that cap the least recently
+    used services are closed, and so are services unused for idle_timeout
+    seconds. A closed service drops its connections, threads and resend
+    buffers, and reconnects if its app is used again. Keyword arguments are
+    passed to every APNService the registry creates; a journal_dir among
+    them gets a subdirectory per app, so apps never share a journal.
+
+    Closing a service waits for its gateway to read everything written, so
+    evicted services are closed on a background thread, outside the lock
+    every lookup takes; an app used again meanwhile waits for its old
+    service to finish closing.
+    """
+
+    def __init__(self, max_connections=MAX_CONNECTIONS, idle_timeout=TIMEOUT_IDLE_SERVICE, **kwargs):
+        super(APNServiceRegistry, self).__init__()
+        self.max_connections = max_connections
+        self.idle_timeout = idle_timeout
+        self.service_kwargs = kwargs
+        self._apps = {}  # app -> (cert_file, key_file, APNService kwargs)
+        self._services = collections.OrderedDict()  # app -> APNService, least recently used first
+        self._last_used = {}
+        self._closing = {}  # app -> thread closing its evicted service
+        self._lock = threading.RLock()
+
+    def __contains__(self, app):
+        return app in self._apps
+
+    def __len__(self):
+        return len(self._apps)
+
+    def register(self, app, cert_file, key_file=None, **kwargs):
+        """Adds an app, or changes its certificate, closing any service it had"""
+        with self._lock:
+            service = self._detach(app)
+            options = dict(self.service_kwargs)
+            if options.get('journal_dir'):
+                options['journal_dir'] = os.path.join(options['journal_dir'], quote(str(app), safe=''))
+            options.update(kwargs)
+            self._apps[app] = (cert_file, key_file, options)
+        if service is not None:
+            service.close()
+
+    def unregister(self, app):
+        with self._lock:
+            service = self._detach(app)
+            self._apps.pop(app, None)
+        if service is not None:
+            service.close()
+
+    def get(self, app):
+        """Returns the APNService of a registered app, raises KeyError for others"""
+        return self._use(app, lambda service: service)
+
+    def gateway_server(self, app):
+        return self._use(app, lambda service: service.gateway_server)
+
+    def feedback_server(self, app):
+        return self._use(app, lambda service: service.feedback_server)
+
+    def _use(self, app, connection):
+        """Returns connection(service) for the service of an app, then closes the services it evicted"""
+        closing = self._closing.get(app)
+        if closing is not None:
+            closing.join()
+        with self._lock:
+            service = self._services.get(app)
+            if service is None:
+                cert_file, key_file, options = self._apps[app]
+                service = APNService(cert_file=cert_file, key_file=key_file, **options)
+                self._services[app] = service
+            else:
+                self._services.move_to_end(app)
+            self._last_used[app] = time.time()
+            result = connection(service)
+            evicted = self._evict(app)
+            if evicted:
+                closer = threading.Thread(target=self._close_evicted, args=(evicted,),
+                                          name="APNServiceCloser", daemon=True)
+                for evicted_app, _ in evicted:
+                    self._closing[evicted_app] = closer
+                closer.start()
+        return result
+
+    def open_connections(self):
+        with self._lock:
+            return sum(service.open_connections() for service in self._services.values())
+
+    def close(self):
+        with self._lock:
+            services = [self._detach(app) for app in list(self._services)]
+            closing = list(self._closing.values())
+        for service in services:
+            service.close()
+        for closer in closing:
+            closer.join()
+
+    def _evict(self, keep):
+        """
+        Detaches idle services, then least recently used ones while over the
+        connection cap, and returns them as (app, service) pairs to close
+        """
+        evicted = []
+        idle_since = time.time() - self.idle_timeout
+        for app in [app for app in self._services if app != keep and self._last_used[app] < idle_since]:
+            provider_log.debug("closing APNs service of idle app %s", app)
+            evicted.append((app, self._detach(app)))
+        open_connections = self.open_connections()
+        for app in list(self._services):
+            if open_connections <= self.max_connections:
+                break
+            if app != keep:
+                open_connections -= self._services[app].open_connections()
+                provider_log.debug("closing APNs service of least recently used app %s", app)
+                evicted.append((app, self._detach(app)))
+        return evicted
+
+    def _close_evicted(self, evicted):
+        for app, service in evicted:
+            try:
+                service.close()
+            except Exception:
+                provider_log.exception("closing APNs service of app %s failed", app)
+            with self._lock:
+                if self._closing.get(app) is threading.current_thread():
+                    del self._closing[app]
+
+    def _detach(self, app):
+        """Drops the service of an app from the registry and returns it, or None, for the caller to close"""
+        self._last_used.pop(app, None)
+        return self._services.pop(app, None)
+
 
 class Connection(object):
     """
     A generic connection class for communicating with the APNs
     """
-    def __init__(self, cert_file=None, key_file=None, timeout=None):
+    def __init__(self, cert_file=None, key_file=None, timeout=None, ssl_context=None):
         super(Connection, self).__init__()
         self.cert_file = cert_file
         self.key_file = key_file
         self.timeout = timeout
+        self.ssl_context = ssl_context
         self._socket = None
         self._ssl = None
+        self._tls_session = None
         self.connection_alive = False
+        self.handshake_time = None
+        self.session_reused = False
+        self._metrics = get_metrics()
 
     def __del__(self):
         self._disconnect()
@@ -113,14 +370,17 @@ class Connection(object):
                 self._socket.connect((self.server, self.port))
                 break
             except timeout:
-                pass
+                self._metrics.connect_failures.inc(labels=(self.server,))
             except:
+                self._metrics.connect_failures.inc(labels=(self.server,))
                 raise
 
         self._last_activity_time = time.time()
         self._socket.setblocking(False)
-        self._ssl = wrap_socket(self._socket, self.key_file, self.cert_file,
-                                    do_handshake_on_connect=False)
+        context = self.ssl_context or get_ssl_context(self.cert_file, self.key_file)
+        handshake_start = time.time()
+        self._ssl = context.wrap_socket(self._socket, server_hostname=self.server,
+                                        do_handshake_on_connect=False, session=self._tls_session)
         while True:
             try:
                 self._ssl.do_handshake()
@@ -133,16 +393,33 @@ class Connection(object):
                 else:
                     raise
 
+        self.handshake_time = time.time() - handshake_start
+        self.session_reused = self._ssl.session_reused
+        self._keep_tls_session()
         self.connection_alive = True
-        provider_log.debug("APNS connection established")
+        self._metrics.connects.inc(labels=(self.server,))
+        self._metrics.handshake_seconds.observe(self.handshake_time)
+        if self.session_reused:
+            self._metrics.sessions_reused.inc()
+        provider_log.debug("APNS connection established, TLS handshake took %.3f secs%s",
+                           self.handshake_time, " (resumed)" if self.session_reused else "")
+
+    def _keep_tls_session(self):
+        # TLS 1.3 tickets arrive after the handshake, so this is repeated on disconnect
+        session = self._ssl.session
+        if session is not None and (session.has_ticket or self._tls_session is None):
+            self._tls_session = session
 
     def _disconnect(self):
         if self.connection_alive:
+            if self._ssl:
+                self._keep_tls_session()
             if self._socket:
                 self._socket.close()
             if self._ssl:
                 self._ssl.close()
             self.connection_alive = False
+            self._metrics.disconnects.inc()
 
     def _connection(self):
         if not self._ssl or not self.connection_alive:
@@ -153,32 +430,62 @@ class Connection(object):
         return self._connection().read(n)
 
     def write(self, string):
-        self._last_activity_time = time.time()
-        _, wlist, _ = select.select([], [self._connection()], [], WAIT_WRITE_TIMEOUT_SEC)
-
-        if len(wlist) > 0:
-            length = self._connection().sendall(string)
-            if length == 0:
-                provider_log.debug("sent length: %d" % length)  # DEBUG
-        else:
-            provider_log.warning("write socket descriptor is not ready after " + str(WAIT_WRITE_TIMEOUT_SEC))
+        """
+        Writes all of string to the non-blocking TLS socket, waiting for it to
+        become writable whenever it would block. Raises socket.timeout, after
+        dropping the connection, if no progress is made within
+        WAIT_WRITE_TIMEOUT_SEC; a partially written message must not be
+        followed by another one on the same connection.
+        """
+        self._last_activity_time = start = time.time()
+        connection = self._connection()
+        view = memoryview(string)
+        deadline = start + WAIT_WRITE_TIMEOUT_SEC
+        while len(view):
+            try:
+                sent = connection.send(view)
+            except ssl.SSLWantWriteError:
+                ready = select.select([], [connection], [], max(deadline - time.time(), 0))[1]
+            except ssl.SSLWantReadError:
+                ready = select.select([connection], [], [], max(deadline - time.time(), 0))[0]
+            else:
+                # OpenSSL requires a retry after WANT_WRITE to pass the same data,
+                # so the view only advances past what send() reports as written
+                view = view[sent:]
+                deadline = time.time() + WAIT_WRITE_TIMEOUT_SEC
+                continue
+            if not ready:
+                provider_log.warning("write socket descriptor is not ready after %s secs", WAIT_WRITE_TIMEOUT_SEC)
+                self._metrics.write_timeouts.inc()
+                self._metrics.bytes_written.inc(len(string) - len(view))
+                self._disconnect()
+                raise timeout("write timed out with %d of %d bytes unsent" % (len(view), len(string)))
+        self._metrics.bytes_written.inc(len(string))
+        self._metrics.write_seconds.observe(time.time() - start)
 
 
 class FeedbackConnection(Connection):
     """
     A class representing a connection to the APNs Feedback server
     """
-    def __init__(self, sandbox=False, **kwargs):
+    def __init__(self, sandbox=False, server=None, port=None, **kwargs):
         super(FeedbackConnection, self).__init__(**kwargs)
-        self.server = (
+        self.server = server or (
             'feedback.push.apple.com',
             'feedback.sandbox.push.apple.com')[sandbox]
-        self.port = 2196
+        self.port = port or 2196
 
     def _chunks(self):
         BUF_SIZE = 4096
         while 1:
-            data = self.read(BUF_SIZE)
+            try:
+                data = self.read(BUF_SIZE)
+            except ssl.SSLWantReadError:
+                rlist, _, _ = select.select([self._connection()], [], [], WAIT_READ_TIMEOUT_SEC)
+                if not rlist:
+                    provider_log.warning("no feedback data after %s secs", WAIT_READ_TIMEOUT_SEC)
+                    break
+                continue
             yield data
             if not data:
                 break
@@ -188,120 +495,505 @@ class FeedbackConnection(Connection):
         A generator that yields (token_hex, fail_time) pairs retrieved from
         the APNs feedback server
         """
-        buff = ''
+        parser = FeedbackParser()
+        last_fail_time_unix = fail_time = None
         for chunk in self._chunks():
-            buff += chunk
-
             # Quit if there's no more data to read
-            if not buff:
-                break
-
-            # Sanity check: after a socket read we should always have at least
-            # 6 bytes in the buffer
-            if len(buff) < 6:
+            if not chunk:
                 break
+            parser.feed(chunk)
 
-            while len(buff) > 6:
-                token_length = unpacked_ushort_big_endian(buff[4:6])
-                bytes_to_read = 6 + token_length
-                if len(buff) >= bytes_to_read:
-                    fail_time_unix = unpacked_uint_big_endian(buff[0:4])
+            count = 0
+            for token, fail_time_unix in parser.records():
+                # records come in bursts sharing the same second
+                if fail_time_unix != last_fail_time_unix:
                     fail_time = datetime.utcfromtimestamp(fail_time_unix)
-                    token = b2a_hex(buff[6:bytes_to_read])
+                    last_fail_time_unix = fail_time_unix
+                count += 1
+                yield (b2a_hex(token), fail_time)
+            self._metrics.feedback_tokens.inc(count)
 
-                    yield (token, fail_time)
-
-                    # Remove data for current token from buffer
-                    buff = buff[bytes_to_read:]
-                else:
-                    # break out of inner while loop - i.e. go and fetch
-                    # some more data and append to buffer
-                    break
+    def items_bulk(self, batch_size=FEEDBACK_BATCH_SIZE):
+        """
+        A generator that yields FeedbackBatch objects of up to batch_size
+        binary tokens and unix fail times, for callers storing them in bulk
+        """
+        parser = FeedbackParser()
+        batch = FeedbackBatch()
+        for chunk in self._chunks():
+            if not chunk:
+                break
+            parser.feed(chunk)
+            while parser.read_into(batch, batch_size - len(batch)):
+                if len(batch) == batch_size:
+                    self._metrics.feedback_tokens.inc(len(batch))
+                    yield batch
+                    batch = FeedbackBatch()
+        if len(batch):
+            self._metrics.feedback_tokens.inc(len(batch))
+            yield batch
 
 
 class GatewayConnection(Connection):
     """
     A class that represents a connection to the APNs gateway server
+
+    Error-responses are read by a dedicated ErrorResponseHandlerWorker
+    thread, or with shared_reactor=True by the process-wide
+    ErrorResponseReactor which watches every such connection from one
+    thread.
+
+    With coalesce=True send_notification only queues the notification; a
+    CoalescingFlusher thread writes the queue with a single sendall once it
+    holds coalesce_bytes or its oldest notification has waited
+    coalesce_delay seconds. flush() writes the queue right away.
+
+    The queue holds at most max_pending notifications. When it is full the
+    backpressure policy decides: 'block' makes the sender wait for room,
+    'fail' raises QueueFullError and 'drop_oldest' discards the oldest
+    queued notification. queue_stats() reports the queue depth and how
+    often each policy kicked in.
+
+    With a journal_dir the sent notifications are journaled to an
+    OutboxJournal in that directory, the resend buffer only keeping
+    references into it, and replay_journal() resends them after a restart.
+
+    server and port replace the address of the APNs gateway, e.g. to point
+    the connection at a local test server.
     """
 
-    def __init__(self, sandbox=False, **kwargs):
+    def __init__(self, sandbox=False, shared_reactor=False, token_registry=None, coalesce=False,
+                 coalesce_bytes=COALESCE_BYTES, coalesce_delay=COALESCE_DELAY_SEC,
+                 max_pending=COALESCE_MAX_PENDING, backpressure=BACKPRESSURE_BLOCK, journal_dir=None,
+                 server=None, port=None, **kwargs):
         super(GatewayConnection, self).__init__(**kwargs)
-        self.server = (
+        self.server = server or (
             'gateway.push.apple.com',
             'gateway.sandbox.push.apple.com')[sandbox]
-        self.port = 2195
+        self.port = port or 2195
 
         self._last_activity_time = time.time()
 
         self._send_lock = threading.RLock()
         self._error_response_handler_worker = None
+        self._reactor = get_error_response_reactor() if shared_reactor else None
         self._response_listener = None
+        self._error_response_count = 0
+        self._error_response_read = threading.Condition(threading.Lock())
+        self._half_closed = None
+        self._close_error = None
+        self.token_registry = token_registry
+
+        self.journal = OutboxJournal(journal_dir) if journal_dir else None
+        self._sent_notifications = SentNotificationBuffer(SENT_BUFFER_QTY, journal=self.journal)
+        self._metrics.track_gateway(self)
 
-        self._sent_notifications = collections.deque(maxlen=SENT_BUFFER_QTY)
+        self._replay = collections.deque()
+        self._replay_lock = threading.Lock()
+        self._resender = None
+        self._recovery_started = None
+        self.recovery_times = collections.deque(maxlen=RECOVERY_HISTORY)
+        self.expired_dropped = 0
+
+        self.coalesce = coalesce
+        self.coalesce_bytes = coalesce_bytes
+        self.coalesce_delay = coalesce_delay
+        if backpressure not in (BACKPRESSURE_BLOCK, BACKPRESSURE_FAIL, BACKPRESSURE_DROP_OLDEST):
+            raise ValueError("unknown backpressure policy: %s" % backpressure)
+        self.max_pending = max_pending
+        self.backpressure = backpressure
+        self._pending = collections.deque()
+        self._pending_bytes = 0
+        self._pending_deadline = None
+        self._pending_lock = threading.Lock()
+        self._pending_condition = threading.Condition(self._pending_lock)
+        self._pending_space = threading.Condition(self._pending_lock)
+        self._flush_lock = threading.Lock()
+        self._flusher = None
+        self._max_queue_depth = 0
+        self._blocked_sends = 0
+        self._blocked_time = 0.0
+        self._rejected = 0
+        self._dropped = 0
 
     def _init_error_response_handler_worker(self):
-        self._send_lock = threading.RLock()
         self._error_response_handler_worker = self.ErrorResponseHandlerWorker(apns_connection=self)
         self._error_response_handler_worker.start()
         provider_log.debug("initialized error-response handler worker")
 
+    def _connect(self):
+        super(GatewayConnection, self)._connect()
+        if self._reactor:
+            self._reactor.register(self)
+
+    def _disconnect(self):
+        if self._reactor:
+            self._reactor.unregister(self)
+        super(GatewayConnection, self)._disconnect()
+
     def _get_enhanced_notification(self, token_hex, payload, identifier, expiry):
         """
         form notification data in an enhanced format
         """
-        token = a2b_hex(token_hex)
-        payload = payload.json()
-        fmt = ENHANCED_NOTIFICATION_FORMAT % len(payload)
-        notification = pack(fmt, ENHANCED_NOTIFICATION_COMMAND, identifier, expiry,
-                            TOKEN_LENGTH, token, len(payload), payload)
-        return notification
+        return encode_enhanced_notification(token_hex, payload, identifier, expiry)
 
     def send_notification(self, token_hex, payload, identifier=0, expiry=0):
         """
         in enhanced mode, send_notification may return error response from APNs if any
+
+        token_hex may also be the 32-byte binary token. Returns False if the
+        notification was not sent, e.g. because the token is known to be dead.
         """
+        if self.token_registry is not None and self.token_registry.is_dead(token_hex):
+            provider_log.debug("skipping notification with id:%s to a dead token", identifier)
+            self._metrics.notifications_skipped.inc()
+            return False
         self._last_activity_time = time.time()
         message = self._get_enhanced_notification(token_hex, payload, identifier, expiry)
 
+        if self.coalesce:
+            self._enqueue(identifier, message)
+            return True
+        return self._write_notifications(message, ((identifier, message),))
+
+    def _write_notifications(self, data, records, resend=False):
+        """
+        Writes data holding the given (identifier, message) records, retrying
+        on socket errors. The records are put in the sent buffer together with
+        the first write, so the buffer keeps the order of the wire and an
+        error-response which made APNs drop the connection mid-write resends
+        them; they are only written again here if no error-response arrived.
+        """
+        error_responses = None
         for i in range(WRITE_RETRY):
             try:
                 with self._send_lock:
+                    if error_responses is None:
+                        error_responses = self._error_response_count
+                        self._sent_notifications.extend(records)
+                        if not resend:
+                            self._metrics.notifications_sent.inc(len(records))
+                    elif self._error_response_count != error_responses:
+                        return True
                     self._make_sure_error_response_handler_worker_alive()
-                    self.write(message)
-                    self._sent_notifications.append(dict({'id': identifier, 'message': message}))
-                break
+                    self.write(data)
+                return True
             except socket_error as e:
                 delay = 10 + (i * 2)
-                provider_log.exception("sending notification with id:" + str(identifier) +
-                             " to APNS failed: " + str(type(e)) + ": " + str(e) +
-                             " in " + str(i+1) + "th attempt, will wait " + str(delay) + " secs for next action")
-                time.sleep(delay) # wait potential error-response to be read
+                self._metrics.write_failures.inc()
+                provider_log.exception("sending notification with id:%s to APNS failed: %s: %s in %dth attempt, "
+                                       "will wait up to %s secs for next action", records[0][0], type(e), e, i + 1, delay)
+                if error_responses is None:
+                    time.sleep(delay)
+                else:
+                    # wait potential error-response to be read
+                    with self._error_response_read:
+                        self._error_response_read.wait_for(
+                            lambda: self._error_response_count != error_responses, delay)
+        return False
+
+    def _enqueue(self, identifier, message):
+        with self._pending_condition:
+            if len(self._pending) >= self.max_pending:
+                self._make_room()
+            if not self._pending:
+                self._pending_deadline = time.time() + self.coalesce_delay
+            self._pending.append((identifier, message))
+            self._pending_bytes += len(message)
+            self._max_queue_depth = max(self._max_queue_depth, len(self._pending))
+            if self._flusher is None or not self._flusher.is_alive():
+                self._flusher = self.CoalescingFlusher(apns_connection=self)
+                self._flusher.start()
+            if self._pending_bytes >= self.coalesce_bytes or len(self._pending) >= self.max_pending:
+                self._pending_condition.notify()
+
+    def _make_room(self):
+        """Applies the backpressure policy to a full queue, called with the queue locked"""
+        if self.backpressure == BACKPRESSURE_FAIL:
+            self._rejected += 1
+            self._metrics.notifications_dropped.inc(labels=('rejected',))
+            raise QueueFullError(len(self._pending))
+        if self.backpressure == BACKPRESSURE_DROP_OLDEST:
+            identifier, message = self._pending.popleft()
+            self._pending_bytes -= len(message)
+            self._dropped += 1
+            self._metrics.notifications_dropped.inc(labels=('drop_oldest',))
+            provider_log.debug("outbound queue full, dropped notification with id:%s", identifier)
+            return
+        self._blocked_sends += 1
+        blocked_since = time.time()
+        self._pending_condition.notify()
+        while len(self._pending) >= self.max_pending:
+            self._pending_space.wait()
+        self._blocked_time += time.time() - blocked_since
+
+    def _take_pending(self):
+        with self._pending_condition:
+            records = list(self._pending)
+            self._pending.clear()
+            self._pending_bytes = 0
+            self._pending_deadline = None
+            self._pending_space.notify_all()
+        return records
+
+    def queue_stats(self):
+        """Returns counters of the coalescing queue"""
+        with self._pending_lock:
+            return {
+                'depth': len(self._pending),
+                'bytes': self._pending_bytes,
+                'max_depth': self._max_queue_depth,
+                'blocked': self._blocked_sends,
+                'blocked_time': self._blocked_time,
+                'rejected': self._rejected,
+                'dropped': self._dropped,
+            }
+
+    def flush(self):
+        """Writes the notifications queued in coalescing mode now"""
+        with self._flush_lock:
+            records = self._take_pending()
+            if records:
+                return self._write_notifications(b''.join(message for _, message in records), records)
+        return True
 
     def _make_sure_error_response_handler_worker_alive(self):
-        if (not self._error_response_handler_worker or not self._error_response_handler_worker.is_alive()):
+        if self._reactor:
+            self._reactor = self._reactor.start_if_needed()
+        elif (not self._error_response_handler_worker or not self._error_response_handler_worker.is_alive()):
+            # Thread.start() only returns once the thread is running
             self._init_error_response_handler_worker()
-            TIMEOUT_SEC = 10
-            for _ in range(TIMEOUT_SEC):
-                if self._error_response_handler_worker.is_alive():
-                    provider_log.debug("error response handler worker is running")
-                    return
-                time.sleep(1)
-            provider_log.warning("error response handler worker is not started after %s secs" % TIMEOUT_SEC)
 
     def send_notification_multiple(self, frame):
-        self._sent_notifications += frame.get_notifications(self)
-        return self.write(frame.get_frame())
+        if self.coalesce:
+            self.flush()
+        # one immutable copy, written and kept for resends, so the frame can be reused
+        data = bytes(frame.get_frame())
+        return self._write_notifications(data, list(frame.records(data)))
 
     def register_response_listener(self, response_listener):
         self._response_listener = response_listener
 
     def force_close(self):
+        if self._flusher:
+            self._flusher.close()
+            self.flush()
         if self._error_response_handler_worker:
             self._error_response_handler_worker.close()
+        if self._reactor:
+            with self._send_lock:
+                self._disconnect()
+
+    def close(self, timeout=CLOSE_TIMEOUT_SEC):
+        """
+        Closes the connection for good. Queued notifications are written and
+        pending resends finished first, then the connection is half-closed
+        and read until the gateway closes it, so APNs reads everything that
+        was written and a last error-response still has its notifications
+        resent. Whatever is left after timeout seconds is discarded along
+        with the sent buffer. Returns False in that case.
+        """
+        if self._flusher:
+            self._flusher.close()
+            self.flush()
+        self._close_error = None
+        clean = self._shutdown(time.time() + timeout)
+        self.force_close()
+        with self._send_lock:
+            self._disconnect()
+            self._sent_notifications.clear()
+            with self._replay_lock:
+                self._replay.clear()
+            if self.journal is not None:
+                self.journal.close()
+        return clean
+
+    def _shutdown(self, deadline):
+        """
+        Sends a TLS close_notify and waits until the gateway has closed the
+        connection and no resend is pending. Returns True only if every
+        connection closed at the gateway ended with an EOF.
+        """
+        while time.time() < deadline:
+            with self._send_lock:
+                # checked under the lock, which the reader holds from an
+                # error-response until its resend is queued
+                if self.replay_pending() or self._resender is not None:
+                    pass
+                elif not self.connection_alive:
+                    return self._close_error is None
+                elif self._half_closed is not self._ssl and not self._readable():
+                    # the error-response reader sees the end of the stream and disconnects
+                    self._make_sure_error_response_handler_worker_alive()
+                    self._send_close_notify()
+            time.sleep(CLOSE_POLL_SEC)
+        provider_log.warning("gateway connection was not closed cleanly within the timeout")
+        return False
+
+    def _readable(self):
+        return self._ssl.pending() > 0 or bool(select.select([self._ssl], [], [], 0)[0])
+
+    def _send_close_notify(self):
+        """
+        Sends close_notify and leaves the connection open for reading. OpenSSL
+        discards application data it meets while shutting down, so this is
+        only called with nothing waiting to be read; an error-response still
+        lost that way fails the close.
+        """
+        try:
+            self._ssl.unwrap()
+        except (ssl.SSLWantReadError, ssl.SSLWantWriteError):
+            # close_notify is sent, the gateway's answer is left to the reader
+            self._half_closed = self._ssl
+        except ssl.SSLEOFError:
+            # the gateway closed the connection meanwhile, with nothing left to read
+            self._disconnect()
+        except socket_error as e:
+            self._close_error = e
+            provider_log.error("sending close_notify to APNS failed: %s: %s", type(e), e)
+            self._disconnect()
+        else:
+            # the gateway had already answered with its own close_notify
+            self._disconnect()
 
     def _is_idle_timeout(self):
         return (time.time() - self._last_activity_time) >= TIMEOUT_IDLE
 
+    def _read_error_response(self):
+        """
+        Reads an error-response once the socket is readable, then reports it
+        and resends the notifications which followed the failed one
+        """
+        with self._send_lock:
+            try:
+                buff = self.read(ERROR_RESPONSE_LENGTH)
+            except ssl.SSLWantReadError:
+                return
+            except socket_error as e:
+                if self._ssl is not self._half_closed:
+                    raise
+                self._close_error = e
+                provider_log.warning("gateway did not close the connection cleanly: %s: %s", type(e), e)
+                self._disconnect()
+                return
+            if len(buff) == ERROR_RESPONSE_LENGTH:
+                command, status, identifier = unpack(ERROR_RESPONSE_FORMAT, buff)
+                if 8 == command: # there is error response from APNS
+                    self._error_response_count += 1
+                    with self._error_response_read:
+                        self._error_response_read.notify_all()
+                    self._metrics.error_responses.inc(labels=(status,))
+                    error_response = (status, identifier)
+                    if status == STATUS_INVALID_TOKEN and self.token_registry is not None:
+                        self._tombstone_token(identifier)
+                    provider_log.info("got error-response from APNS:%s", error_response)
+                    self._disconnect()
+                    self._resend_notifications_by_id(identifier)
+                    # last, so a failing listener can not keep the resend from happening
+                    if self._response_listener:
+                        try:
+                            self._response_listener(convert_error_response_to_dict(self, error_response))
+                        except Exception:
+                            provider_log.exception("error-response listener failed on %s", error_response)
+            if len(buff) == 0:
+                if self._ssl is self._half_closed:
+                    provider_log.debug("gateway closed the half-closed connection")
+                else:
+                    provider_log.warning("read socket got 0 bytes data") #DEBUG
+                self._disconnect()
+
+    def _tombstone_token(self, identifier):
+        message = self._sent_notifications.get(identifier)
+        if message is not None:
+            self.token_registry.mark_dead(token_from_message(message), DEAD_INVALID)
+
+    def _resend_notifications_by_id(self, failed_identifier):
+        # pop-out success notifications till failed one
+        if not self._sent_notifications.drop_through(failed_identifier):
+            provider_log.warning("notification with id:%s is no longer in the sent buffer, nothing to resend", failed_identifier)
+            return
+        self._resend_sent_notifications()
+
+    def _resend_sent_notifications(self):
+        """
+        Moves the buffered notifications to the front of the replay queue and
+        makes sure a ResendWorker writes them. Called with the send lock held,
+        so the buffer holds exactly what followed the failed notification on
+        the wire, which comes before anything still waiting for a replay.
+        """
+        records = list(self._sent_notifications)
+        self._sent_notifications.clear()
+        self._queue_replay(records, front=True)
+
+    def replay_journal(self, since=None):
+        """
+        Resends the journaled notifications, or those journaled at or after
+        the unix time since, e.g. the ones in flight when the previous
+        process stopped. APNs may already have delivered some of them.
+        Notifications journaled again by a resend are replayed once.
+        """
+        if self.journal is None:
+            raise ValueError("the connection has no journal")
+        records = collections.OrderedDict()
+        for identifier, message in self.journal.records(since):
+            records.setdefault((identifier, bytes(message)), None)
+        records = list(records)
+        self._queue_replay(records, front=False)
+        return len(records)
+
+    def _queue_replay(self, records, front):
+        with self._replay_lock:
+            if front:
+                self._replay.extendleft(reversed(records))
+            else:
+                self._replay.extend(records)
+            self._metrics.resent.inc(len(records))
+            provider_log.info("resending %s notifications to APNS", len(self._replay)) #DEBUG
+            if self._recovery_started is None:
+                self._recovery_started = time.time()
+            if self._replay and self._resender is None:
+                self._resender = self.ResendWorker(apns_connection=self)
+                self._resender.start()
+
+    def _take_replay_chunk(self):
+        """
+        Pops up to RESEND_CHUNK_BYTES of notifications off the replay queue,
+        dropping those whose expiry has passed. Returns an empty list, and
+        records how long the recovery took, once the queue is drained.
+        """
+        records = []
+        size = 0
+        now = time.time()
+        with self._replay_lock:
+            while self._replay and size < RESEND_CHUNK_BYTES:
+                record = self._replay.popleft()
+                expiry = expiry_from_message(record[1])
+                if expiry and expiry < now:
+                    self.expired_dropped += 1
+                    self._metrics.notifications_dropped.inc(labels=('expired',))
+                    continue
+                records.append(record)
+                size += len(record[1])
+            if not records:
+                self._resender = None
+                if self._recovery_started is not None:
+                    self.recovery_times.append(time.time() - self._recovery_started)
+                    provider_log.info("recovered from error-response in %.3f secs", self.recovery_times[-1])
+                    self._metrics.recovery_seconds.observe(self.recovery_times[-1])
+                    self._recovery_started = None
+        return records
+
+    def _abandon_replay(self):
+        with self._replay_lock:
+            provider_log.error("giving up resending %d notifications to APNS", len(self._replay))
+            self._replay.clear()
+            self._resender = None
+            self._recovery_started = None
+
+    def replay_pending(self):
+        """Returns the number of notifications waiting to be resent"""
+        return len(self._replay)
+
     class ErrorResponseHandlerWorker(threading.Thread):
         def __init__(self, apns_connection):
             threading.Thread.__init__(self, name=self.__class__.__name__)
@@ -319,7 +1011,7 @@ class GatewayConnection(Connection):
 
                 if self._apns_connection._is_idle_timeout():
                     idled_time = (time.time() - self._apns_connection._last_activity_time)
-                    provider_log.debug("connection idle after %d secs" % idled_time)
+                    provider_log.debug("connection idle after %d secs", idled_time)
                     break
 
                 if not self._apns_connection.connection_alive:
@@ -330,23 +1022,11 @@ class GatewayConnection(Connection):
                     rlist, _, _ = select.select([self._apns_connection._connection()], [], [], WAIT_READ_TIMEOUT_SEC)
 
                     if len(rlist) > 0: # there's some data from APNs
-                        with self._apns_connection._send_lock:
-                            buff = self._apns_connection.read(ERROR_RESPONSE_LENGTH)
-                            if len(buff) == ERROR_RESPONSE_LENGTH:
-                                command, status, identifier = unpack(ERROR_RESPONSE_FORMAT, buff)
-                                if 8 == command: # there is error response from APNS
-                                    error_response = (status, identifier)
-                                    if self._apns_connection._response_listener:
-                                        self._apns_connection._response_listener(convert_error_response_to_dict(*error_response))
-                                    provider_log.info("got error-response from APNS:" + str(error_response))
-                                    self._apns_connection._disconnect()
-                                    self._resend_notifications_by_id(identifier)
-                            if len(buff) == 0:
-                                provider_log.warning("read socket got 0 bytes data") #DEBUG
-                                self._apns_connection._disconnect()
+                        self._apns_connection._read_error_response()
 
                 except socket_error as e:  # APNS close connection arbitrarily
-                    provider_log.exception("exception occur when reading APNS error-response: " + str(type(e)) + ": " + str(e)) #DEBUG
+                    provider_log.exception("exception occur when reading APNS error-response: %s: %s", type(e), e) #DEBUG
+                    self._apns_connection._metrics.worker_errors.inc()
                     self._apns_connection._disconnect()
                     continue
 
@@ -355,20 +1035,279 @@ class GatewayConnection(Connection):
             self._apns_connection._disconnect()
             provider_log.debug("error-response handler worker closed")  # DEBUG
 
-        def _resend_notifications_by_id(self, failed_identifier):
-            fail_idx = getListIndexFromID(self._apns_connection._sent_notifications, failed_identifier)
-            # pop-out success notifications till failed one
-            self._resend_notification_by_range(fail_idx+1, len(self._apns_connection._sent_notifications))
-            return
 
-        def _resend_notification_by_range(self, start_idx, end_idx):
-            self._apns_connection._sent_notifications = collections.deque(itertools.islice(self._apns_connection._sent_notifications, start_idx, end_idx))
-            provider_log.info("resending %s notifications to APNS" % len(self._apns_connection._sent_notifications)) #DEBUG
-            for sent_notification in self._apns_connection._sent_notifications:
-                provider_log.debug("resending notification with id:" + str(sent_notification['id']) + " to APNS") #DEBUG
-                try:
-                    self._apns_connection.write(sent_notification['message'])
-                except socket_error as e:
-                    provider_log.exception("resending notification with id:" + str(sent_notification['id']) + " failed: " + str(type(e)) + ": " + str(e)) #DEBUG
+    class ResendWorker(threading.Thread):
+        """
+        Replays notifications after an error-response in writes of up to
+        RESEND_CHUNK_BYTES, taking the send lock once per chunk so that new
+        sends go out between chunks instead of waiting for the whole replay.
+        A further error-response requeues whatever followed it on the wire,
+        replayed chunks included, and the worker carries on.
+        """
+
+        def __init__(self, apns_connection):
+            threading.Thread.__init__(self, name=self.__class__.__name__)
+            self.daemon = True
+            self._apns_connection = apns_connection
+
+        def run(self):
+            connection = self._apns_connection
+            while True:
+                records = connection._take_replay_chunk()
+                if not records:
                     break
-                time.sleep(DELAY_RESEND_SEC)  # DEBUG
\ No newline at end of file
+                if not connection._write_notifications(b''.join(message for _, message in records), records, resend=True):
+                    connection._abandon_replay()
+                    break
+            provider_log.debug("resend worker closed")  # DEBUG
+
+    class CoalescingFlusher(threading.Thread):
+        def __init__(self, apns_connection):
+            threading.Thread.__init__(self, name=self.__class__.__name__)
+            self.daemon = True
+            self._apns_connection = apns_connection
+            self._close_signal = False
+
+        def close(self):
+            self._close_signal = True
+            with self._apns_connection._pending_condition:
+                self._apns_connection._pending_condition.notify()
+
+        def _wait_for_batch(self):
+            """Waits until the queue is due for a write, returns False when the flusher should stop"""
+            connection = self._apns_connection
+            with connection._pending_condition:
+                while not self._close_signal:
+                    if connection._pending:
+                        remaining = connection._pending_deadline - time.time()
+                        if (connection._pending_bytes >= connection.coalesce_bytes or remaining <= 0 or
+                                len(connection._pending) >= connection.max_pending):
+                            return True
+                    elif connection._is_idle_timeout():
+                        break
+                    else:
+                        remaining = TIMEOUT_IDLE
+                    connection._pending_condition.wait(remaining)
+                # let the next queued notification start a new flusher
+                if connection._flusher is self:
+                    connection._flusher = None
+            return False
+
+        def run(self):
+            while self._wait_for_batch():
+                self._apns_connection.flush()
+            provider_log.debug("coalescing flusher closed")  # DEBUG
+
+
+class ErrorResponseReactor(threading.Thread):
+    """
+    Watches the sockets of every registered gateway connection for
+    error-responses from a single thread and dispatches them to the owning
+    connection. Connections register themselves when they connect and
+    unregister when they disconnect; idle ones are disconnected after
+    TIMEOUT_IDLE as the per-connection worker would.
+    """
+
+    def __init__(self):
+        threading.Thread.__init__(self, name=self.__class__.__name__)
+        self.daemon = True
+        self._selector = selectors.DefaultSelector()
+        self._lock = threading.Lock()
+        self._sockets = {}
+        self._wakeup_r, self._wakeup_w = socketpair()
+        self._wakeup_r.setblocking(False)
+        self._wakeup_w.setblocking(False)
+        self._selector.register(self._wakeup_r, selectors.EVENT_READ, None)
+        self._started_once = False
+
+    def start_if_needed(self):
+        """
+        Starts the reactor and returns the reactor in charge. If this one
+        has died, that is a new one which the connections registered here
+        are moved over to.
+        """
+        with self._lock:
+            if not self._started_once:
+                self._started_once = True
+                self.start()
+                return self
+            if self.is_alive():
+                return self
+            connections = list(self._sockets)
+            for connection in connections:
+                self._unregister(connection)
+        provider_log.error("error-response reactor died, starting a new one")
+        reactor = get_error_response_reactor(replacing=self)
+        for connection in connections:
+            connection._reactor = reactor
+            if connection.connection_alive:
+                reactor.register(connection)
+        return reactor.start_if_needed()
+
+    def register(self, connection):
+        with self._lock:
+            self._unregister(connection)
+            self._sockets[connection] = connection._ssl
+            self._selector.register(connection._ssl, selectors.EVENT_READ, connection)
+        self._wakeup()
+
+    def unregister(self, connection):
+        with self._lock:
+            self._unregister(connection)
+
+    def _unregister(self, connection):
+        sock = self._sockets.pop(connection, None)
+        if sock is not None:
+            try:
+                self._selector.unregister(sock)
+            except (KeyError, ValueError):
+                pass
+
+    def _wakeup(self):
+        try:
+            self._wakeup_w.send(b'\0')
+        except socket_error:
+            pass  # the reactor already has a pending wakeup
+
+    def run(self):
+        while True:
+            try:
+                events = self._selector.select(REACTOR_TICK_SEC)
+            except (OSError, ValueError) as e:
+                provider_log.warning("error-response reactor select failed: %s", e)
+                time.sleep(REACTOR_TICK_SEC)
+                continue
+
+            for key, _ in events:
+                connection = key.data
+                if connection is None:
+                    self._drain_wakeup()
+                    continue
+                try:
+                    connection._read_error_response()
+                except socket_error as e:  # APNS close connection arbitrarily
+                    provider_log.exception("exception occur when reading APNS error-response: %s: %s", type(e), e) #DEBUG
+                    connection._metrics.worker_errors.inc()
+                    connection._disconnect()
+                except Exception as e:
+                    # the reactor serves every connection, it must outlive a failure of one
+                    provider_log.exception("handling APNS error-response failed: %s: %s", type(e), e)
+                    connection._metrics.worker_errors.inc()
+                    connection._disconnect()
+
+            self._disconnect_idle_connections()
+
+    def _drain_wakeup(self):
+        try:
+            while self._wakeup_r.recv(4096):
+                pass
+        except socket_error:
+            pass
+
+    def _disconnect_idle_connections(self):
+        with self._lock:
+            connections = list(self._sockets)
+        for connection in connections:
+            if connection._is_idle_timeout():
+                provider_log.debug("connection idle after %d secs", time.time() - connection._last_activity_time)
+                with connection._send_lock:
+                    connection._disconnect()
+
+
+_error_response_reactor = None
+_error_response_reactor_lock = threading.Lock()
+
+
+def get_error_response_reactor(replacing=None):
+    """
+    Returns the ErrorResponseReactor shared by every gateway connection, a
+    new one if it is the given dead reactor
+    """
+    global _error_response_reactor
+    with _error_response_reactor_lock:
+        if _error_response_reactor is None or _error_response_reactor is replacing:
+            _error_response_reactor = ErrorResponseReactor()
+        return _error_response_reactor
+
+
+class GatewayConnectionPool(object):
+    """
+    Spreads notifications over several gateway connections so that senders
+    do not all serialize on one socket.
+
+    Every connection keeps its own error-response worker and resend buffer,
+    so an error-response is always resolved against the notifications sent
+    on the connection it arrived on; identifiers only have to be unique per
+    connection. Error-responses passed to the response listener carry the
+    index of that connection under ER_CONNECTION.
+    """
+
+    def __init__(self, size, dispatch=DISPATCH_ROUND_ROBIN, journal_dir=None, token_registry=None, **kwargs):
+        super(GatewayConnectionPool, self).__init__()
+        if dispatch not in (DISPATCH_ROUND_ROBIN, DISPATCH_LEAST_LOADED):
+            raise ValueError("unknown dispatch policy: %s" % dispatch)
+        self.dispatch = dispatch
+        self.token_registry = token_registry
+        # every connection journals to a subdirectory named after its index
+        self.connections = [GatewayConnection(journal_dir=journal_dir and os.path.join(journal_dir, str(index)),
+                                              token_registry=token_registry, **kwargs)
+                            for index in range(size)]
+        self._loads = [0] * size
+        self._loads_lock = threading.Lock()
+        self._round_robin = itertools.count()
+
+    def __len__(self):
+        return len(self.connections)
+
+    def _acquire(self, weight):
+        with self._loads_lock:
+            if self.dispatch == DISPATCH_LEAST_LOADED:
+                index = min(range(len(self._loads)), key=self._loads.__getitem__)
+            else:
+                index = next(self._round_robin) % len(self.connections)
+            self._loads[index] += weight
+        return index
+
+    def _release(self, index, weight):
+        with self._loads_lock:
+            self._loads[index] -= weight
+
+    def send_notification(self, token_hex, payload, identifier=0, expiry=0):
+        index = self._acquire(1)
+        try:
+            return self.connections[index].send_notification(token_hex, payload, identifier, expiry)
+        finally:
+            self._release(index, 1)
+
+    def send_notification_multiple(self, frame):
+        weight = len(frame.item_offsets)
+        index = self._acquire(weight)
+        try:
+            return self.connections[index].send_notification_multiple(frame)
+        finally:
+            self._release(index, weight)
+
+    def register_response_listener(self, response_listener):
+        for index, connection in enumerate(self.connections):
+            connection.register_response_listener(self._tagged_listener(response_listener, index))
+
+    def _tagged_listener(self, response_listener, index):
+        def listener(error_response):
+            error_response[ER_CONNECTION] = index
+            return response_listener(error_response)
+        return listener
+
+    def force_close(self):
+        for connection in self.connections:
+            connection.force_close()
+
+    def close(self, timeout=CLOSE_TIMEOUT_SEC):
+        """Closes every connection as GatewayConnection.close does, returns False unless all closed cleanly"""
+        deadline = time.time() + timeout
+        clean = True
+        for connection in self.connections:
+            clean = connection.close(max(deadline - time.time(), 0)) and clean
+        return clean
+
+    def replay_journal(self, since=None):
+        return sum(connection.replay_journal(since) for connection in self.connections)
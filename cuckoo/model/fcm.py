@@ -0,0 +1,226 @@
+# -*- coding: utf-8 -*-
+import logging
+import threading
+import time
+from itertools import islice
+from email.utils import parsedate_tz, mktime_tz
+
+import requests
+from requests.adapters import HTTPAdapter
+
+from cuckoo.model.metrics import get_metrics
+
+FCM_URL = "https://fcm.googleapis.com/fcm/send"
+POOL_SIZE = 10
+REQUEST_TIMEOUT_SEC = 10
+RETRY = 3
+RETRY_BACKOFF_SEC = 0.5
+MAX_RETRY_DELAY_SEC = 60
+MAX_MULTICAST_TOKENS = 1000
+
+# errors after which a token should not be used again
+UNREGISTERED_ERRORS = ('NotRegistered', 'InvalidRegistration', 'MissingRegistration', 'MismatchSenderId')
+RETRYABLE_ERRORS = ('Unavailable', 'InternalServerError', 'DeviceMessageRateExceeded')
+
+logger = logging.getLogger("cuckoo")
+
+
+class FCMClient(object):
+    """
+    A thread-safe client posting messages to FCM over a pooled, keep-alive
+    requests.Session, so consecutive pushes reuse established TLS
+    connections instead of opening a new one each time.
+
+    Connection errors, 429 and 5xx responses are retried with exponential
+    backoff; a Retry-After header sent by FCM takes precedence over the
+    computed delay.
+    """
+
+    def __init__(self, url=FCM_URL, pool_size=POOL_SIZE, timeout=REQUEST_TIMEOUT_SEC, retry=RETRY,
+                 backoff=RETRY_BACKOFF_SEC, max_delay=MAX_RETRY_DELAY_SEC):
+        super(FCMClient, self).__init__()
+        self.url = url
+        self.pool_size = pool_size
+        self.timeout = timeout
+        self.retry = retry
+        self.backoff = backoff
+        self.max_delay = max_delay
+        self._session = None
+        self._session_lock = threading.Lock()
+        self._metrics = get_metrics()
+
+    @property
+    def session(self):
+        if self._session is None:
+            with self._session_lock:
+                if self._session is None:
+                    session = requests.Session()
+                    adapter = HTTPAdapter(pool_connections=1, pool_maxsize=self.pool_size)
+                    session.mount('https://', adapter)
+                    session.mount('http://', adapter)
+                    self._session = session
+        return self._session
+
+    def close(self):
+        with self._session_lock:
+            if self._session is not None:
+                self._session.close()
+                self._session = None
+
+    def post(self, apikey, body):
+        """
+        Posts a JSON request body to FCM and returns the response. Raises
+        requests.RequestException if the last attempt could not connect.
+        """
+        headers = {'Content-Type': 'application/json', 'Authorization': 'key=' + str(apikey)}
+        attempt = 0
+        metrics = self._metrics
+        while True:
+            start = time.time()
+            try:
+                response = self.session.post(self.url, data=body, headers=headers, timeout=self.timeout)
+            except (requests.ConnectionError, requests.Timeout) as e:
+                metrics.fcm_requests.inc(labels=('error',))
+                if attempt >= self.retry:
+                    raise
+                delay = self._backoff_delay(attempt)
+                logger.warning("request to FCM failed: %s, retrying in %.2f secs", e, delay)
+            else:
+                metrics.fcm_requests.inc(labels=(response.status_code,))
+                metrics.fcm_request_seconds.observe(time.time() - start)
+                if not self._is_retryable(response.status_code) or attempt >= self.retry:
+                    return response
+                delay = self._retry_after(response)
+                if delay is None:
+                    delay = self._backoff_delay(attempt)
+                logger.warning("FCM responded with %s, retrying in %.2f secs", response.status_code, delay)
+            metrics.fcm_retries.inc()
+            time.sleep(delay)
+            attempt += 1
+
+    def _is_retryable(self, status_code):
+        return status_code == 429 or 500 <= status_code < 600
+
+    def _backoff_delay(self, attempt):
+        return min(self.backoff * (2 ** attempt), self.max_delay)
+
+    def _retry_after(self, response):
+        value = response.headers.get('Retry-After')
+        if not value:
+            return None
+        try:
+            delay = float(value)
+        except ValueError:
+            parsed = parsedate_tz(value)
+            if parsed is None:
+                return None
+            delay = mktime_tz(parsed) - time.time()
+        return min(max(delay, 0), self.max_delay)
+
+
+class TokenResult(object):
+    """The outcome of sending a message to a single token"""
+
+    def __init__(self, token, message_id=None, registration_id=None, error=None):
+        super(TokenResult, self).__init__()
+        self.token = token
+        self.message_id = message_id
+        self.registration_id = registration_id
+        self.error = error
+
+    @property
+    def success(self):
+        return self.message_id is not None
+
+    def __repr__(self):
+        attrs = ("token", "message_id", "registration_id", "error")
+        args = ", ".join(["%s=%r" % (n, getattr(self, n)) for n in attrs])
+        return "%s(%s)" % (self.__class__.__name__, args)
+
+
+class MulticastResult(object):
+    """Per-token outcomes of a multicast send, in the order tokens were given"""
+
+    def __init__(self):
+        super(MulticastResult, self).__init__()
+        self.results = []
+        self.requests = 0
+
+    def __len__(self):
+        return len(self.results)
+
+    def __iter__(self):
+        return iter(self.results)
+
+    def add_response(self, tokens, response):
+        """Records the per-token results of a successful FCM response body"""
+        self.requests += 1
+        results = response.get('results') or []
+        for i, token in enumerate(tokens):
+            result = results[i] if i < len(results) else {'error': 'MissingResult'}
+            self.results.append(TokenResult(token, message_id=result.get('message_id'),
+                                            registration_id=result.get('registration_id'),
+                                            error=result.get('error')))
+
+    def add_failure(self, tokens, error):
+        """Records the same error for every token of a failed request"""
+        self.requests += 1
+        self.results.extend(TokenResult(token, error=error) for token in tokens)
+
+    @property
+    def success(self):
+        return sum(1 for r in self.results if r.success)
+
+    @property
+    def failure(self):
+        return len(self.results) - self.success
+
+    def succeeded(self):
+        return [r.token for r in self.results if r.success]
+
+    def failed(self):
+        return [r for r in self.results if not r.success]
+
+    def canonical_ids(self):
+        """Returns a dict mapping tokens to the canonical registration ids FCM reported for them"""
+        return dict((r.token, r.registration_id) for r in self.results if r.registration_id)
+
+    def not_registered(self):
+        """Returns tokens which should be removed from the database"""
+        return [r.token for r in self.results if r.error in UNREGISTERED_ERRORS]
+
+    def retryable(self):
+        """Returns tokens whose delivery may succeed if sent again later"""
+        return [r.token for r in self.results
+                if r.error in RETRYABLE_ERRORS or (r.error or '').startswith(('HTTP 5', 'HTTP 429'))]
+
+
+def chunked(iterable, size):
+    """Yields lists of at most size items taken from any iterable"""
+    iterator = iter(iterable)
+    while True:
+        chunk = list(islice(iterator, size))
+        if not chunk:
+            return
+        yield chunk
+
+
+_default_client = None
+_default_client_lock = threading.Lock()
+
+
+def get_default_client():
+    """Returns the FCMClient shared by every message that is not given its own"""
+    global _default_client
+    if _default_client is None:
+        with _default_client_lock:
+            if _default_client is None:
+                _default_client = FCMClient()
+    return _default_client
+
+
+def set_default_client(client):
+    """Replaces the shared FCMClient, e.g. to point it at another endpoint"""
+    global _default_client
+    with _default_client_lock:
+        _default_client = client
@@ -0,0 +1,156 @@
+# -*- coding: utf-8 -*-
+import asyncio
+import functools
+import logging
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from cuckoo.model.fcm import FCMClient, MulticastResult
+
+CONCURRENCY = 10
+
+logger = logging.getLogger("cuckoo")
+
+
+class SendResult(object):
+    """
+    The outcome of one (message, target) pair: whatever FCMMessage.send or
+    FCMMessage.send_multicast returned, or the exception it raised.
+    """
+
+    def __init__(self, message, target, result=None, error=None, elapsed=0.0):
+        super(SendResult, self).__init__()
+        self.message = message
+        self.target = target
+        self.result = result
+        self.error = error
+        self.elapsed = elapsed
+
+    @property
+    def success(self):
+        """True if nothing was raised and, for a multicast, every token was accepted"""
+        if self.error is not None:
+            return False
+        if isinstance(self.result, MulticastResult):
+            return self.result.failure == 0
+        return bool(self.result)
+
+    def __repr__(self):
+        attrs = ("target", "result", "error", "elapsed")
+        args = ", ".join(["%s=%r" % (n, getattr(self, n)) for n in attrs])
+        return "%s(%s)" % (self.__class__.__name__, args)
+
+
+class RateLimiter(object):
+    """Spaces out acquisitions so that at most `rate` happen per second"""
+
+    def __init__(self, rate):
+        super(RateLimiter, self).__init__()
+        self.interval = 1.0 / rate
+        self._next_time = 0.0
+        self._lock = None
+
+    async def wait(self):
+        if self._lock is None:
+            self._lock = asyncio.Lock()
+        async with self._lock:
+            now = time.monotonic()
+            if self._next_time > now:
+                await asyncio.sleep(self._next_time - now)
+                now = self._next_time
+            self._next_time = now + self.interval
+
+
+class AsyncFCMSender(object):
+    """
+    Sends FCMMessage objects from asyncio code, keeping up to `concurrency`
+    requests in flight and, if `rate` is given, starting at most that many
+    per second.
+
+    The HTTP requests are made by FCMClient on a private thread pool, so the
+    event loop is never blocked and keep-alive connections are pooled as
+    for synchronous sends. A target may be a token, a topic or a list of
+    tokens; lists are sent with FCMMessage.send_multicast.
+    """
+
+    def __init__(self, client=None, concurrency=CONCURRENCY, rate=None):
+        super(AsyncFCMSender, self).__init__()
+        self.concurrency = concurrency
+        self.client = client or FCMClient(pool_size=concurrency)
+        self._limiter = RateLimiter(rate) if rate else None
+        self._executor = ThreadPoolExecutor(max_workers=concurrency)
+        self._semaphore = None
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc_info):
+        await self.close()
+
+    async def close(self):
+        """Waits for the requests in flight on another thread, so the event loop keeps running"""
+        await asyncio.get_running_loop().run_in_executor(None, functools.partial(self._executor.shutdown, wait=True))
+
+    async def send(self, message, target):
+        """Sends one message and returns what FCMMessage.send or send_multicast returned"""
+        if self._semaphore is None:
+            self._semaphore = asyncio.Semaphore(self.concurrency)
+        async with self._semaphore:
+            if self._limiter:
+                await self._limiter.wait()
+            if isinstance(target, (list, tuple)):
+                call = functools.partial(message.send_multicast, target, client=self.client)
+            else:
+                call = functools.partial(message.send, target, client=self.client)
+            return await asyncio.get_running_loop().run_in_executor(self._executor, call)
+
+    async def _send_result(self, message, target):
+        start = time.monotonic()
+        try:
+            result = await self.send(message, target)
+        except Exception as e:
+            logger.warning("sending FCM message to %s failed: %s: %s", target, type(e).__name__, e)
+            return SendResult(message, target, error=e, elapsed=time.monotonic() - start)
+        return SendResult(message, target, result=result, elapsed=time.monotonic() - start)
+
+    async def send_stream(self, pairs):
+        """
+        Sends every (message, target) pair of a regular or async iterable
+        and yields a SendResult for each as soon as it completes. Pairs are
+        only pulled from `pairs` while fewer than `concurrency` requests are
+        in flight. Closing the generator early cancels the sends still
+        pending.
+        """
+        if hasattr(pairs, '__aiter__'):
+            iterator = pairs.__aiter__()
+            next_pair = iterator.__anext__
+        else:
+            iterator = iter(pairs)
+
+            async def next_pair():
+                try:
+                    return next(iterator)
+                except StopIteration:
+                    raise StopAsyncIteration
+
+        pending = set()
+        exhausted = False
+        try:
+            while True:
+                while not exhausted and len(pending) < self.concurrency:
+                    try:
+                        message, target = await next_pair()
+                    except StopAsyncIteration:
+                        exhausted = True
+                        break
+                    pending.add(asyncio.ensure_future(self._send_result(message, target)))
+                if not pending:
+                    break
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    yield task.result()
+        finally:
+            # the consumer stopped early or was cancelled: the requests already
+            # handed to the thread pool complete, but nobody waits for them
+            for task in pending:
+                task.cancel()
@@ -0,0 +1,103 @@
+# -*- coding: utf-8 -*-
+import logging
+from array import array
+from struct import Struct
+
+FEEDBACK_HEADER = Struct('!IH')  # fail time, token length
+FEEDBACK_HEADER_LENGTH = FEEDBACK_HEADER.size
+FEEDBACK_TOKEN_LENGTH = 32
+FEEDBACK_BATCH_SIZE = 10000
+
+provider_log = logging.getLogger("cuckoo")
+
+
+class FeedbackBatch(object):
+    """
+    A batch of feedback records held in two compact arrays: the binary
+    tokens concatenated in one bytearray and their unix fail times in an
+    array of unsigned ints.
+    """
+
+    def __init__(self):
+        super(FeedbackBatch, self).__init__()
+        self.tokens = bytearray()
+        self.timestamps = array('I')
+
+    def __len__(self):
+        return len(self.timestamps)
+
+    def __iter__(self):
+        """Yields (token, unix fail time) pairs"""
+        tokens = bytes(self.tokens)
+        for i, timestamp in enumerate(self.timestamps):
+            yield tokens[i * FEEDBACK_TOKEN_LENGTH:(i + 1) * FEEDBACK_TOKEN_LENGTH], timestamp
+
+    def token(self, i):
+        return bytes(self.tokens[i * FEEDBACK_TOKEN_LENGTH:(i + 1) * FEEDBACK_TOKEN_LENGTH])
+
+
+class FeedbackParser(object):
+    """
+    Incrementally parses the APNs feedback stream. Chunks are appended to a
+    single bytearray and records are read at an offset cursor, so a large
+    backlog is parsed in linear time.
+    """
+
+    def __init__(self):
+        super(FeedbackParser, self).__init__()
+        self._buff = bytearray()
+        self._offset = 0
+
+    def feed(self, chunk):
+        # dropping consumed bytes from the front of a bytearray does not copy
+        # the rest of it
+        if self._offset:
+            del self._buff[:self._offset]
+            self._offset = 0
+        self._buff += chunk
+
+    def pending(self):
+        """Returns the number of buffered bytes not parsed yet"""
+        return len(self._buff) - self._offset
+
+    def records(self):
+        """Yields (token, unix fail time) for every complete record fed so far"""
+        buff = self._buff
+        length = len(buff)
+        unpack_header = FEEDBACK_HEADER.unpack_from
+        while length - self._offset > FEEDBACK_HEADER_LENGTH:
+            offset = self._offset
+            fail_time, token_length = unpack_header(buff, offset)
+            end = offset + FEEDBACK_HEADER_LENGTH + token_length
+            if end > length:
+                break
+            self._offset = end
+            yield bytes(buff[offset + FEEDBACK_HEADER_LENGTH:end]), fail_time
+
+    def read_into(self, batch, limit):
+        """
+        Appends up to limit complete records to a FeedbackBatch and returns
+        how many were added. Tokens of unexpected length are skipped.
+        """
+        buff = self._buff
+        length = len(buff)
+        offset = self._offset
+        unpack_header = FEEDBACK_HEADER.unpack_from
+        tokens = batch.tokens
+        timestamps = batch.timestamps
+        added = 0
+        while added < limit and length - offset > FEEDBACK_HEADER_LENGTH:
+            fail_time, token_length = unpack_header(buff, offset)
+            start = offset + FEEDBACK_HEADER_LENGTH
+            end = start + token_length
+            if end > length:
+                break
+            offset = end
+            if token_length != FEEDBACK_TOKEN_LENGTH:
+                provider_log.warning("skipping feedback token of length %d", token_length)
+                continue
+            tokens += buff[start:end]
+            timestamps.append(fail_time)
+            added += 1
+        self._offset = offset
+        return added
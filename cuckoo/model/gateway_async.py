@@ -0,0 +1,447 @@
+# -*- coding: utf-8 -*-
+import asyncio
+import collections
+import functools
+import itertools
+import logging
+import time
+from struct import unpack
+
+from cuckoo.model.buffers import SentNotificationBuffer
+from cuckoo.model.connections import (
+    encode_enhanced_notification,
+    get_ssl_context,
+    ERROR_RESPONSE_FORMAT,
+    ERROR_RESPONSE_LENGTH,
+    SENT_BUFFER_QTY,
+    WAIT_WRITE_TIMEOUT_SEC,
+    WRITE_RETRY,
+    RESEND_CHUNK_BYTES,
+    RECOVERY_HISTORY,
+    TIMEOUT_IDLE,
+    DISPATCH_ROUND_ROBIN,
+    DISPATCH_LEAST_LOADED
+)
+from cuckoo.model.metrics import get_metrics
+from cuckoo.model.tokens import DEAD_INVALID, STATUS_INVALID_TOKEN
+from cuckoo.model.utils import (
+    convert_error_response_to_dict,
+    expiry_from_message,
+    token_from_message,
+    ER_CONNECTION
+)
+
+logger = logging.getLogger("cuckoo")
+
+
+def _log_task_failure(name, task):
+    if not task.cancelled() and task.exception() is not None:
+        logger.error("%s failed", name, exc_info=task.exception())
+
+
+def _spawn(coroutine, name):
+    """Runs a coroutine as a task whose failure is logged rather than lost with the task"""
+    task = asyncio.ensure_future(coroutine)
+    if hasattr(task, 'set_name'):  # tasks are named since Python 3.8
+        task.set_name(name)
+    task.add_done_callback(functools.partial(_log_task_failure, name))
+    return task
+
+
+class AsyncGatewayConnection(object):
+    """
+    A connection to the APNs gateway for asyncio code. It sends the same
+    enhanced notifications and Frames as GatewayConnection over an asyncio
+    TLS stream, so any number of connections can be driven from one event
+    loop without a thread each.
+
+    Error-responses are read by a task of the connection. The notifications
+    which followed a failed one are replayed by another task in writes of up
+    to RESEND_CHUNK_BYTES, letting new sends go out between chunks. Sends
+    wait for the stream to drain, so a slow gateway holds senders back
+    rather than letting the transport buffer grow; a drain taking longer
+    than timeout seconds drops the connection and the write is retried.
+
+    The response listener may be a coroutine function, its coroutines are
+    run as tasks.
+    """
+
+    def __init__(self, sandbox=False, cert_file=None, key_file=None, ssl_context=None, token_registry=None,
+                 server=None, port=None, timeout=WAIT_WRITE_TIMEOUT_SEC):
+        super(AsyncGatewayConnection, self).__init__()
+        self.server = server or (
+            'gateway.push.apple.com',
+            'gateway.sandbox.push.apple.com')[sandbox]
+        self.port = port or 2195
+        self.cert_file = cert_file
+        self.key_file = key_file
+        self.ssl_context = ssl_context
+        self.token_registry = token_registry
+        self.timeout = timeout
+        self.connect_time = None
+        self._reader = None
+        self._writer = None
+        self._reader_task = None
+        self._connect_lock = None
+        self._last_activity_time = time.time()
+        self._response_listener = None
+        self._error_response_count = 0
+        self._sent_notifications = SentNotificationBuffer(SENT_BUFFER_QTY)
+        self._replay = collections.deque()
+        self._resend_task = None
+        self._recovery_started = None
+        self.recovery_times = collections.deque(maxlen=RECOVERY_HISTORY)
+        self.expired_dropped = 0
+        self._metrics = get_metrics()
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc_info):
+        await self.close()
+
+    @property
+    def connection_alive(self):
+        return self._writer is not None and not self._writer.is_closing()
+
+    async def connect(self):
+        """Opens the TLS connection and starts reading error-responses, unless it is open already"""
+        if self._connect_lock is None:
+            self._connect_lock = asyncio.Lock()
+        async with self._connect_lock:
+            if self.connection_alive:
+                return
+            logger.debug("APNS connection establishing...")
+            context = self.ssl_context or get_ssl_context(self.cert_file, self.key_file)
+            start = time.time()
+            try:
+                reader, writer = await asyncio.wait_for(
+                    asyncio.open_connection(self.server, self.port, ssl=context, server_hostname=self.server),
+                    self.timeout)
+            except (OSError, asyncio.TimeoutError):
+                self._metrics.connect_failures.inc(labels=(self.server,))
+                raise
+            self.connect_time = time.time() - start
+            self._reader, self._writer = reader, writer
+            self._last_activity_time = time.time()
+            self._reader_task = _spawn(self._read_error_responses(reader, writer), "error-response reader")
+            self._metrics.connects.inc(labels=(self.server,))
+            self._metrics.handshake_seconds.observe(self.connect_time)
+            logger.debug("APNS connection established in %.3f secs", self.connect_time)
+
+    def _disconnect(self, writer=None):
+        """Closes the connection; given a writer, only if that still is the current one"""
+        if self._writer is None or (writer is not None and writer is not self._writer):
+            return
+        self._writer.close()
+        self._reader = self._writer = None
+        self._metrics.disconnects.inc()
+
+    async def _current_writer(self):
+        while not self.connection_alive:
+            await self.connect()
+        return self._writer
+
+    async def send_notification(self, token_hex, payload, identifier=0, expiry=0):
+        """
+        token_hex may also be the 32-byte binary token. Returns False if the
+        notification was not sent, e.g. because the token is known to be dead.
+        """
+        if self.token_registry is not None and self.token_registry.is_dead(token_hex):
+            logger.debug("skipping notification with id:%s to a dead token", identifier)
+            self._metrics.notifications_skipped.inc()
+            return False
+        message = encode_enhanced_notification(token_hex, payload, identifier, expiry)
+        return await self._write_notifications(message, ((identifier, message),))
+
+    async def send_notification_multiple(self, frame):
+        # one immutable copy, written and kept for resends, so the frame can be reused
+        data = bytes(frame.get_frame())
+        return await self._write_notifications(data, list(frame.records(data)))
+
+    async def _write_notifications(self, data, records, resend=False):
+        """
+        Writes data holding the given (identifier, message) records, retrying
+        on socket errors. As in GatewayConnection the records are put in the
+        sent buffer right before the first write, with no await in between,
+        and are only written again if no error-response arrived meanwhile.
+        """
+        error_responses = None
+        for i in range(WRITE_RETRY):
+            writer = None
+            try:
+                writer = await self._current_writer()
+                if error_responses is None:
+                    error_responses = self._error_response_count
+                    self._sent_notifications.extend(records)
+                    if not resend:
+                        self._metrics.notifications_sent.inc(len(records))
+                elif self._error_response_count != error_responses:
+                    return True
+                self._last_activity_time = start = time.time()
+                writer.write(data)
+                await asyncio.wait_for(writer.drain(), self.timeout)
+                self._metrics.bytes_written.inc(len(data))
+                self._metrics.write_seconds.observe(time.time() - start)
+                return True
+            except (OSError, asyncio.TimeoutError) as e:
+                if isinstance(e, asyncio.TimeoutError):
+                    self._metrics.write_timeouts.inc()
+                # a partially written message must not be followed by another one
+                self._disconnect(writer)
+                delay = 10 + (i * 2)
+                self._metrics.write_failures.inc()
+                logger.exception("sending notification with id:%s to APNS failed: %s: %s in %dth attempt, "
+                                 "will wait %s secs for next action", records[0][0], type(e), e, i + 1, delay)
+                await asyncio.sleep(delay)  # wait potential error-response to be read
+        return False
+
+    def register_response_listener(self, response_listener):
+        self._response_listener = response_listener
+
+    async def _read_error_responses(self, reader, writer):
+        """Reads error-responses of one TLS stream until it is closed or idle for TIMEOUT_IDLE"""
+        buff = b''
+        while True:
+            remaining = self._last_activity_time + TIMEOUT_IDLE - time.time()
+            if remaining <= 0:
+                logger.debug("connection idle after %d secs", time.time() - self._last_activity_time)
+                break
+            try:
+                chunk = await asyncio.wait_for(reader.read(ERROR_RESPONSE_LENGTH - len(buff)), remaining)
+            except asyncio.TimeoutError:
+                continue
+            except OSError as e:  # APNS close connection arbitrarily
+                if writer is self._writer:
+                    logger.exception("exception occur when reading APNS error-response: %s: %s", type(e), e)
+                    self._metrics.worker_errors.inc()
+                break
+            if not chunk:
+                if writer is self._writer:
+                    logger.warning("read socket got 0 bytes data")
+                break
+            buff += chunk
+            if len(buff) < ERROR_RESPONSE_LENGTH:
+                continue
+            command, status, identifier = unpack(ERROR_RESPONSE_FORMAT, buff)
+            buff = b''
+            if 8 == command:  # there is error response from APNS
+                self._handle_error_response(status, identifier, writer)
+                break
+        self._disconnect(writer)
+        logger.debug("error-response reader finished")
+
+    def _handle_error_response(self, status, identifier, writer):
+        self._error_response_count += 1
+        self._metrics.error_responses.inc(labels=(status,))
+        error_response = (status, identifier)
+        if status == STATUS_INVALID_TOKEN and self.token_registry is not None:
+            message = self._sent_notifications.get(identifier)
+            if message is not None:
+                self.token_registry.mark_dead(token_from_message(message), DEAD_INVALID)
+        logger.info("got error-response from APNS:%s", error_response)
+        self._disconnect(writer)
+        self._resend_notifications_by_id(identifier)
+        # last, so a failing listener can not keep the resend from happening
+        if self._response_listener:
+            try:
+                result = self._response_listener(convert_error_response_to_dict(self, error_response))
+            except Exception:
+                logger.exception("error-response listener failed on %s", error_response)
+                return
+            if asyncio.iscoroutine(result):
+                _spawn(result, "error-response listener")
+
+    def _resend_notifications_by_id(self, failed_identifier):
+        # pop-out success notifications till failed one
+        if not self._sent_notifications.drop_through(failed_identifier):
+            logger.warning("notification with id:%s is no longer in the sent buffer, nothing to resend",
+                           failed_identifier)
+            return
+        records = list(self._sent_notifications)
+        self._sent_notifications.clear()
+        # what followed the failed notification on the wire goes before
+        # anything still waiting for a replay
+        self._replay.extendleft(reversed(records))
+        self._metrics.resent.inc(len(records))
+        logger.info("resending %s notifications to APNS", len(self._replay))
+        if self._recovery_started is None:
+            self._recovery_started = time.time()
+        if self._replay and self._resend_task is None:
+            self._resend_task = _spawn(self._resend(), "resend task")
+
+    def _take_replay_chunk(self):
+        """
+        Pops up to RESEND_CHUNK_BYTES of notifications off the replay queue,
+        dropping those whose expiry has passed. Returns an empty list, and
+        records how long the recovery took, once the queue is drained.
+        """
+        records = []
+        size = 0
+        now = time.time()
+        while self._replay and size < RESEND_CHUNK_BYTES:
+            record = self._replay.popleft()
+            expiry = expiry_from_message(record[1])
+            if expiry and expiry < now:
+                self.expired_dropped += 1
+                self._metrics.notifications_dropped.inc(labels=('expired',))
+                continue
+            records.append(record)
+            size += len(record[1])
+        if not records:
+            self._resend_task = None
+            if self._recovery_started is not None:
+                self.recovery_times.append(time.time() - self._recovery_started)
+                logger.info("recovered from error-response in %.3f secs", self.recovery_times[-1])
+                self._metrics.recovery_seconds.observe(self.recovery_times[-1])
+                self._recovery_started = None
+        return records
+
+    async def _resend(self):
+        while True:
+            records = self._take_replay_chunk()
+            if not records:
+                break
+            if not await self._write_notifications(b''.join(message for _, message in records), records,
+                                                   resend=True):
+                logger.error("giving up resending %d notifications to APNS", len(self._replay))
+                self._replay.clear()
+                self._resend_task = None
+                self._recovery_started = None
+                break
+            await asyncio.sleep(0)  # let new sends go out between chunks
+        logger.debug("resend task finished")
+
+    def replay_pending(self):
+        """Returns the number of notifications waiting to be resent"""
+        return len(self._replay)
+
+    async def close(self):
+        """Closes the connection for good, discarding the sent buffer and any pending replay"""
+        current = asyncio.current_task()
+        for task in (self._reader_task, self._resend_task):
+            if task is not None and task is not current:
+                task.cancel()
+        self._reader_task = self._resend_task = None
+        writer = self._writer
+        self._disconnect()
+        self._sent_notifications.clear()
+        self._replay.clear()
+        self._recovery_started = None
+        if writer is not None:
+            try:
+                await writer.wait_closed()
+            except OSError:
+                pass
+
+
+class AsyncGatewayConnectionPool(object):
+    """
+    Spreads notifications over several AsyncGatewayConnections, round-robin
+    or to the one with the fewest notifications in flight. As with
+    GatewayConnectionPool, identifiers only have to be unique per connection
+    and error-responses passed to the response listener carry the index of
+    their connection under ER_CONNECTION.
+    """
+
+    def __init__(self, size, dispatch=DISPATCH_ROUND_ROBIN, **kwargs):
+        super(AsyncGatewayConnectionPool, self).__init__()
+        if dispatch not in (DISPATCH_ROUND_ROBIN, DISPATCH_LEAST_LOADED):
+            raise ValueError("unknown dispatch policy: %s" % dispatch)
+        self.dispatch = dispatch
+        self.connections = [AsyncGatewayConnection(**kwargs) for _ in range(size)]
+        self._loads = [0] * size
+        self._round_robin = itertools.count()
+
+    def __len__(self):
+        return len(self.connections)
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc_info):
+        await self.close()
+
+    def _acquire(self, weight):
+        if self.dispatch == DISPATCH_LEAST_LOADED:
+            index = min(range(len(self._loads)), key=self._loads.__getitem__)
+        else:
+            index = next(self._round_robin) % len(self.connections)
+        self._loads[index] += weight
+        return index
+
+    async def send_notification(self, token_hex, payload, identifier=0, expiry=0):
+        index = self._acquire(1)
+        try:
+            return await self.connections[index].send_notification(token_hex, payload, identifier, expiry)
+        finally:
+            self._loads[index] -= 1
+
+    async def send_notification_multiple(self, frame):
+        weight = len(frame.item_offsets)
+        index = self._acquire(weight)
+        try:
+            return await self.connections[index].send_notification_multiple(frame)
+        finally:
+            self._loads[index] -= weight
+
+    def register_response_listener(self, response_listener):
+        for index, connection in enumerate(self.connections):
+            connection.register_response_listener(self._tagged_listener(response_listener, index))
+
+    def _tagged_listener(self, response_listener, index):
+        def listener(error_response):
+            error_response[ER_CONNECTION] = index
+            return response_listener(error_response)
+        return listener
+
+    def replay_pending(self):
+        return sum(connection.replay_pending() for connection in self.connections)
+
+    async def close(self):
+        await asyncio.gather(*(connection.close() for connection in self.connections))
+
+
+class AsyncAPNService(object):
+    """
+    The asyncio counterpart of APNService for the gateway: gateway_server is
+    an AsyncGatewayConnection, or with gateway_connections greater than 1 an
+    AsyncGatewayConnectionPool. The feedback service is still read with
+    FeedbackConnection.
+    """
+
+    def __init__(self, cert_file=None, key_file=None, sandbox=False, gateway_connections=1,
+                 dispatch=DISPATCH_ROUND_ROBIN, token_registry=None, **kwargs):
+        super(AsyncAPNService, self).__init__()
+        self.sandbox = sandbox
+        self.cert_file = cert_file
+        self.key_file = key_file
+        self.gateway_connections = gateway_connections
+        self.dispatch = dispatch
+        self.token_registry = token_registry
+        self._kwargs = kwargs
+        self._gateway_connection = None
+
+    @property
+    def gateway_server(self):
+        if not self._gateway_connection:
+            kwargs = dict(self._kwargs, sandbox=self.sandbox, token_registry=self.token_registry,
+                          cert_file=self.cert_file, key_file=self.key_file)
+            if self.gateway_connections > 1:
+                self._gateway_connection = AsyncGatewayConnectionPool(
+                    self.gateway_connections, dispatch=self.dispatch, **kwargs)
+            else:
+                self._gateway_connection = AsyncGatewayConnection(**kwargs)
+        return self._gateway_connection
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc_info):
+        await self.close()
+
+    async def close(self):
+        """Closes the gateway connections; they are created again on the next use"""
+        if self._gateway_connection:
+            connection, self._gateway_connection = self._gateway_connection, None
+            await connection.close()
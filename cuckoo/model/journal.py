@@ -0,0 +1,193 @@
+# -*- coding: utf-8 -*-
+import collections
+import logging
+import mmap
+import os
+import re
+import threading
+import time
+from struct import Struct
+
+try:
+    import fcntl
+except ImportError:  # Windows
+    fcntl = None
+
+JOURNAL_SEGMENT_SIZE = 16 * 1024 * 1024
+JOURNAL_MAX_SEGMENTS = 8
+
+RECORD_HEADER = Struct('!III')  # identifier, message length, unix time written
+RECORD_HEADER_LENGTH = RECORD_HEADER.size
+SEGMENT_NAME = 'outbox-%08d.seg'
+_SEGMENT_NAME = re.compile(r'^outbox-(\d{8})\.seg$')
+LOCK_NAME = 'outbox.lock'
+
+provider_log = logging.getLogger("cuckoo")
+
+
+class JournalLockedError(Exception):
+    """Raised when another OutboxJournal, in this process or another one, already uses the directory"""
+    def __init__(self, directory):
+        super(JournalLockedError, self).__init__("journal directory %s is in use" % directory)
+        self.directory = directory
+
+
+class OutboxJournal(object):
+    """
+    An append-only journal of sent notifications kept in memory-mapped
+    segment files in a directory.
+
+    append() copies a message into the current segment and returns an int
+    reference to it, from which read() returns a zero-copy memoryview.
+    Segments are preallocated to segment_size bytes; when one is full the
+    next is started and, beyond max_segments, the oldest is deleted, so the
+    journal never takes more than segment_size * max_segments bytes of
+    disk. References into a deleted segment read as None.
+
+    The segments found in the directory are reopened, so after a restart
+    records() returns what was sent before it. A journal owns its directory:
+    it holds an exclusive lock on a file there until it is closed, and a
+    second journal on the same directory raises JournalLockedError rather
+    than writing over the segments of the first.
+    """
+
+    def __init__(self, directory, segment_size=JOURNAL_SEGMENT_SIZE, max_segments=JOURNAL_MAX_SEGMENTS):
+        super(OutboxJournal, self).__init__()
+        if segment_size > 0xFFFFFFFF:
+            raise ValueError("segment_size must fit in 32 bits")
+        self.directory = directory
+        self.segment_size = segment_size
+        self.max_segments = max_segments
+        self._segments = collections.OrderedDict()  # segment number -> mmap, oldest first
+        self._lock = threading.Lock()
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        self._lock_file = self._acquire(directory)
+
+        numbers = sorted(int(match.group(1)) for match in map(_SEGMENT_NAME.match, os.listdir(directory)) if match)
+        for number in numbers:
+            self._segments[number] = self._map(number)
+        if numbers:
+            self._number = numbers[-1]
+            self._offset = self._end_of(self._segments[self._number])
+        else:
+            self._number = 0
+            self._offset = 0
+            self._segments[0] = self._map(0, create=True)
+        self._trim()
+
+    @staticmethod
+    def _acquire(directory):
+        lock_file = open(os.path.join(directory, LOCK_NAME), 'a')
+        if fcntl is not None:
+            try:
+                fcntl.flock(lock_file.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except OSError:
+                lock_file.close()
+                raise JournalLockedError(directory)
+        return lock_file
+
+    def _path(self, number):
+        return os.path.join(self.directory, SEGMENT_NAME % number)
+
+    def _map(self, number, create=False):
+        with open(self._path(number), 'w+b' if create else 'r+b') as f:
+            if create:
+                f.truncate(self.segment_size)
+            return mmap.mmap(f.fileno(), 0)
+
+    def _end_of(self, segment):
+        """Returns the offset following the last complete record of a segment"""
+        offset = 0
+        for offset, _, _, _ in self._scan(segment):
+            pass
+        return offset
+
+    def _scan(self, segment):
+        """Yields (offset of the next record, identifier, message, written) for every record of a segment"""
+        offset = 0
+        size = len(segment)
+        view = memoryview(segment)
+        while offset + RECORD_HEADER_LENGTH <= size:
+            identifier, length, written = RECORD_HEADER.unpack_from(segment, offset)
+            end = offset + RECORD_HEADER_LENGTH + length
+            if length == 0 or end > size:
+                break
+            yield end, identifier, view[offset + RECORD_HEADER_LENGTH:end], written
+            offset = end
+
+    def append(self, identifier, message):
+        """Journals a message and returns a reference to it"""
+        length = len(message)
+        size = RECORD_HEADER_LENGTH + length
+        if size > self.segment_size:
+            raise ValueError("message of %d bytes does not fit in a journal segment" % length)
+        with self._lock:
+            if self._offset + size > self.segment_size:
+                self._rotate()
+            segment = self._segments[self._number]
+            offset = self._offset
+            # the header goes in last, so a record is only ever seen complete
+            segment[offset + RECORD_HEADER_LENGTH:offset + size] = message
+            RECORD_HEADER.pack_into(segment, offset, identifier, length, int(time.time()))
+            self._offset = offset + size
+            return (self._number << 32) | offset
+
+    def read(self, reference):
+        """Returns a memoryview of a journaled message, or None if its segment was deleted"""
+        segment = self._segments.get(reference >> 32)
+        if segment is None:
+            return None
+        offset = reference & 0xFFFFFFFF
+        length = RECORD_HEADER.unpack_from(segment, offset)[1]
+        start = offset + RECORD_HEADER_LENGTH
+        return memoryview(segment)[start:start + length]
+
+    def records(self, since=None):
+        """
+        Yields (identifier, message) for every journaled record, oldest
+        first, or only for those written at or after the unix time since
+        """
+        with self._lock:
+            segments = list(self._segments.values())
+        for segment in segments:
+            for _, identifier, message, written in self._scan(segment):
+                if since is None or written >= since:
+                    yield identifier, message
+
+    def _rotate(self):
+        self._segments[self._number].flush()
+        self._number += 1
+        self._offset = 0
+        self._segments[self._number] = self._map(self._number, create=True)
+        self._trim()
+
+    def _trim(self):
+        while len(self._segments) > self.max_segments:
+            number, segment = self._segments.popitem(last=False)
+            provider_log.debug("deleting journal segment %s", self._path(number))
+            self._close_segment(segment)
+            os.remove(self._path(number))
+
+    def _close_segment(self, segment):
+        try:
+            segment.close()
+        except BufferError:
+            # messages read from the segment are still referenced, the
+            # mapping goes away with the last of them
+            pass
+
+    def sync(self):
+        """Flushes the current segment to disk"""
+        with self._lock:
+            self._segments[self._number].flush()
+
+    def close(self):
+        with self._lock:
+            for segment in self._segments.values():
+                if not segment.closed:
+                    segment.flush()
+                self._close_segment(segment)
+            self._segments.clear()
+            # closing the file releases the lock
+            self._lock_file.close()
@@ -1,16 +1,38 @@
 # -*- coding: utf-8 -*-
 import json
 import logging
+from array import array
+from binascii import a2b_hex, b2a_hex
+from struct import Struct
+
 import requests
-from binascii import a2b_hex
 
 from cuckoo.model.utils import *
+from cuckoo.model.fcm import get_default_client, chunked, MulticastResult, MAX_MULTICAST_TOKENS
+from cuckoo.model.metrics import get_metrics
 
 MAX_PAYLOAD_LENGTH = 4096
 
+FRAME_ITEM_FORMAT = (
+     '!'    # network big-endian
+     'B'    # command
+     'I'    # frame length
+     'BH32s'  # token item
+     'BH%ds'  # payload item
+     'BHI'  # identifier item
+     'BHI'  # expiry item
+     'BHB'  # priority item
+    )
+FRAME_ITEM_TOKEN_OFFSET = 8
+TOKEN_LENGTH = 32
+TOKEN_HEX_LENGTH = 64
+_UINT = Struct('!I')
+
 
 class DataPayload(object):
     """A class representing an APNs message payload"""
+    __slots__ = ('alert', 'badge', 'sound', 'category', 'custom', 'content_available')
+
     def __init__(self, alert=None, badge=None, sound=None, category=None, custom=None, content_available=False):
         super(DataPayload, self).__init__()
         self.alert = alert
@@ -30,14 +52,14 @@ class DataPayload(object):
         if self.alert:
             # Alert can be either a string or a PayloadAlert
             # object
-            if isinstance(self.alert, NotificationPayload):
+            if isinstance(self.alert, (NotificationPayload, CompiledPayload)):
                 d['alert'] = self.alert.dict()
             else:
                 d['alert'] = self.alert
         if self.sound:
             d['sound'] = self.sound
         if self.badge is not None:
-            d['badge'] = int(self.badge)
+            d['badge'] = self.badge if isinstance(self.badge, RawSlot) else int(self.badge)
         if self.category:
             d['category'] = self.category
 
@@ -56,6 +78,16 @@ class DataPayload(object):
         if payload_length > MAX_PAYLOAD_LENGTH:
             raise PayloadTooLargeError(payload_length)
 
+    def compile(self):
+        """
+        Returns an immutable CompiledPayload holding the serialized payload.
+        Use it when the same payload is sent to many tokens.
+        """
+        payload = CompiledPayload(self.json())
+        if payload.length > MAX_PAYLOAD_LENGTH:
+            raise PayloadTooLargeError(payload.length)
+        return payload
+
     def __repr__(self):
         attrs = ("alert", "badge", "sound", "category", "custom")
         args = ", ".join(["%s=%r" % (n, getattr(self, n)) for n in attrs])
@@ -63,6 +95,9 @@ class DataPayload(object):
 
 
 class NotificationPayload(object):
+    __slots__ = ('title', 'body', 'tag', 'icon', 'launch_image', 'sound', 'color', 'title_loc_key', 'title_loc_args',
+                 'body_loc_key', 'body_loc_args', 'action_loc_key', 'click_action')
+
     def __init__(self, title=None, body=None, title_loc_key=None, title_loc_args=None, click_action=None, action_loc_key=None,
                  body_loc_key=None, body_loc_args=None, tag=None, icon=None, launch_image=None, sound=None, color=None):
         super(NotificationPayload, self).__init__()
@@ -110,6 +145,67 @@ class NotificationPayload(object):
             d['body-loc-args'] = self.body_loc_args
         return d
 
+    def json(self):
+        return json.dumps(self.dict(), separators=(',', ':'), ensure_ascii=False).encode('utf-8')
+
+    def compile(self):
+        """Returns an immutable CompiledPayload holding the serialized notification"""
+        return CompiledPayload(self.json())
+
+
+class CompiledPayload(object):
+    """
+    An immutable, already serialized payload. The UTF-8 JSON bytes and their
+    length are computed once and handed as they are to the frame and
+    enhanced-notification encoders.
+    """
+    __slots__ = ('data', 'length')
+
+    def __init__(self, data):
+        object.__setattr__(self, 'data', bytes(data))
+        object.__setattr__(self, 'length', len(self.data))
+
+    def __setattr__(self, name, value):
+        raise AttributeError("%s is immutable" % self.__class__.__name__)
+
+    def __len__(self):
+        return self.length
+
+    def json(self):
+        return self.data
+
+    def dict(self):
+        return json.loads(self.data.decode('utf-8'))
+
+    def compile(self):
+        return self
+
+    def __repr__(self):
+        return "%s(%r)" % (self.__class__.__name__, self.data)
+
+
+class Slot(str):
+    """
+    A named placeholder for a per-recipient string in a payload given to
+    PayloadTemplate. It may be concatenated with other text, e.g.
+    "Hi " + Slot("name").
+    """
+    kind = 'str'
+    __slots__ = ('name',)
+
+    def __new__(cls, name):
+        if not (name.isidentifier() and name.isascii()):
+            raise ValueError("slot name must be an identifier: %r" % name)
+        slot = str.__new__(cls, '\x00%s:%s\x00' % (cls.kind, name))
+        slot.name = name
+        return slot
+
+
+class RawSlot(Slot):
+    """A placeholder for a whole JSON value such as the badge number rather than a string"""
+    kind = 'raw'
+    __slots__ = ()
+
 
 class PayloadTooLargeError(Exception):
     def __init__(self, payload_size):
@@ -118,20 +214,38 @@ class PayloadTooLargeError(Exception):
 
 
 class Frame(object):
-    """A class representing an APNs message frame for multiple sending"""
-    def __init__(self):
+    """
+    A class representing an APNs message frame for multiple sending.
+
+    Items are only kept encoded in frame_data; their offsets and
+    identifiers are held in arrays, so an item costs little more than its
+    bytes on the wire.
+    """
+    __slots__ = ('token_registry', 'frame_data', 'item_offsets', 'item_identifiers')
+
+    def __init__(self, token_registry=None):
+        self.token_registry = token_registry
         self.frame_data = bytearray()
-        self.notification_data = list()
+        # offset of every item in frame_data, in the order they were added
+        self.item_offsets = array('I')
+        self.item_identifiers = array('I')
 
     def get_frame(self):
         return self.frame_data
 
     def add_item(self, token_hex, payload, identifier, expiry, priority):
-        """Add a notification message to the frame"""
+        """
+        Add a notification message to the frame. token_hex may also be the
+        32-byte binary token. Returns False if the token is known to be dead.
+        """
+        if self.token_registry is not None and self.token_registry.is_dead(token_hex):
+            return False
+        self.item_offsets.append(len(self.frame_data))
+        self.item_identifiers.append(identifier)
         item_len = 0
         self.frame_data.extend(b'\2' + packed_uint_big_endian(item_len))
 
-        token_bin = a2b_hex(token_hex)
+        token_bin = binary_token(token_hex)
         token_length_bin = packed_ushort_big_endian(len(token_bin))
         token_item = b'\1' + token_length_bin + token_bin
         self.frame_data.extend(token_item)
@@ -162,24 +276,114 @@ class Frame(object):
         item_len += len(priority_item)
 
         self.frame_data[-item_len-4:-item_len] = packed_uint_big_endian(item_len)
+        return True
+
+    @property
+    def notification_data(self):
+        """
+        Returns a dict with the hex token, the CompiledPayload, identifier,
+        expiry and priority of every item, decoded from frame_data
+        """
+        data = []
+        for identifier, message in self.records():
+            item = {'identifier': identifier}
+            offset = 5
+            while offset < len(message):
+                item_id, item_length = unpack_from('!BH', message, offset)
+                value = message[offset + 3:offset + 3 + item_length]
+                if item_id == 1:
+                    item['token'] = b2a_hex(value).decode('ascii')
+                elif item_id == 2:
+                    item['payload'] = CompiledPayload(value)
+                elif item_id == 4:
+                    item['expiry'] = unpack_from('!I', value)[0]
+                elif item_id == 5:
+                    item['priority'] = value[0]
+                offset += 3 + item_length
+            data.append(item)
+        return data
+
+    def records(self, data=None):
+        """
+        Yields (identifier, message) pairs for the resend buffer. Every item
+        already is a complete notification, so the message is a memoryview
+        slice of data rather than a re-encoded copy. data is an immutable
+        bytes copy of frame_data, made here unless the caller passes the one
+        it sends; the frame stays free to grow while the messages are kept.
+        """
+        if data is None:
+            data = bytes(self.frame_data)
+        view = memoryview(data)
+        ends = self.item_offsets[1:]
+        ends.append(len(data))
+        for identifier, start, end in zip(self.item_identifiers, self.item_offsets, ends):
+            yield identifier, view[start:end]
+
+    def get_notifications(self, gateway_connection=None):
+        return list({'id': identifier, 'message': message} for identifier, message in self.records())
+
+    @classmethod
+    def from_tokens(cls, tokens, payload, first_identifier=0, expiry=0, priority=10, token_registry=None):
+        """
+        Builds a frame sending the same payload to every token in one pass.
+
+        Tokens are either all hex or all 32-byte binary. The token at
+        position i gets identifier first_identifier + i. All hex tokens are
+        decoded at once and the items are written into a single preallocated
+        buffer; only the token and identifier differ between items. Tokens a
+        TokenRegistry knows to be dead are left out.
+        """
+        tokens = list(tokens)
+        identifiers = range(first_identifier, first_identifier + len(tokens))
+        if token_registry is not None:
+            live = [i for i, token in enumerate(tokens) if not token_registry.is_dead(token)]
+            if len(live) != len(tokens):
+                tokens = [tokens[i] for i in live]
+                identifiers = [first_identifier + i for i in live]
+        if tokens and isinstance(tokens[0], (bytes, bytearray)) and len(tokens[0]) == TOKEN_LENGTH:
+            if any(len(token) != TOKEN_LENGTH for token in tokens):
+                raise ValueError("every binary token must be %d bytes long" % TOKEN_LENGTH)
+            tokens_bin = memoryview(b''.join(tokens))
+        else:
+            if any(len(token) != TOKEN_HEX_LENGTH for token in tokens):
+                raise ValueError("every token must be %d hex characters long" % TOKEN_HEX_LENGTH)
+            joined = (b'' if tokens and isinstance(tokens[0], bytes) else '').join(tokens)
+            tokens_bin = memoryview(a2b_hex(joined))
 
-        self.notification_data.append({'token':token_hex, 'payload':payload, 'identifier':identifier, 'expiry':expiry, "priority":priority})
-
-    def get_notifications(self, gateway_connection):
-        notifications = list({'id': x['identifier'],
-                              'message':gateway_connection._get_enhanced_notification(x['token'],
-                                                                                      x['payload'],
-                                                                                      x['identifier'],
-                                                                                      x['expiry'])}
-                                                                    for x in self.notification_data)
-        return notifications
+        payload_json = payload.json()
+        payload_length = len(payload_json)
+        item = Struct(FRAME_ITEM_FORMAT % payload_length)
+        item_size = item.size
+        template = item.pack(2, item_size - 5,
+                             1, 32, b'',
+                             2, payload_length, payload_json,
+                             3, 4, 0,
+                             4, 4, expiry,
+                             5, 1, priority)
+        identifier_offset = item_size - 15
+
+        frame = cls(token_registry)
+        frame_data = bytearray(template) * len(tokens)
+        pack_identifier = _UINT.pack_into
+        offset = 0
+        for i in range(len(tokens)):
+            token_offset = offset + FRAME_ITEM_TOKEN_OFFSET
+            frame_data[token_offset:token_offset + 32] = tokens_bin[i * 32:i * 32 + 32]
+            pack_identifier(frame_data, offset + identifier_offset, identifiers[i])
+            offset += item_size
+
+        frame.frame_data = frame_data
+        frame.item_offsets = array('I', range(0, offset, item_size))
+        frame.item_identifiers = array('I', identifiers)
+        return frame
 
     def __str__(self):
         """Get the frame buffer"""
         return str(self.frame_data)
 
 
-class FCMMessage:
+class FCMMessage(object):
+    __slots__ = ('apikey', 'notification', 'data', 'collapse_key', 'time_to_live', 'priority')
 
     def __init__(self, apikey, notification=None, data=None, collapse_key=None, time_to_live=86400, priority="high"):
 
@@ -190,14 +394,8 @@ class FCMMessage:
         self.time_to_live = time_to_live
         self.priority = priority
 
-    def send(self, to):
-        '''
-
-        :param to: token lub topic
-        :return:
-        '''
-        logger = logging.getLogger('cuckoo')
-        url = "https://fcm.googleapis.com/fcm/send"
+    def dict(self):
+        """Returns the request body without the recipient"""
         data = {}
         if self.notification is not None:
             data["notification"] = self.notification.dict()
@@ -207,35 +405,124 @@ class FCMMessage:
             data['collapse_key'] = self.collapse_key
         if self.priority is not None:
             data["priority"] = self.priority
+        return data
+
+    def _request_body(self, to):
+        data = self.dict()
         data['to'] = to
+        return json.dumps(data)
+
+    def _multicast_body(self, tokens):
+        data = self.dict()
+        data['registration_ids'] = tokens
+        return json.dumps(data)
 
-        logger.debug("Trying to send notification: " + json.dumps(data))
-        r = requests.post(url, data=json.dumps(data), headers={'Content-Type':'application/json', 'Authorization':'key='+str(self.apikey)})
+    def compile(self):
+        """
+        Returns an immutable CompiledFCMMessage which serializes the request
+        body once and only splices the recipient in on every send.
+        """
+        return CompiledFCMMessage(self)
+
+    def send(self, to, client=None):
+        '''
+
+        :param to: token lub topic
+        :param client: FCMClient to send with, the shared one by default
+        :return:
+        '''
+        logger = logging.getLogger('cuckoo')
+        body = self._request_body(to)
+
+        logger.debug("Trying to send notification: %s", body)
+        r = (client or get_default_client()).post(self.apikey, body)
 
         if str(r.status_code) != "200":
-            logger.warning("{} error while trying to send message to {} .".format(r.status_code, to))
+            logger.warning("%s error while trying to send message to %s .", r.status_code, to)
+            get_metrics().fcm_messages.inc(labels=('failure',))
             return False
         else:
-            response = r.json()
-            logger.debug(response)
-            logger.debug("Response status 200 - OK")
+            get_metrics().fcm_messages.inc(labels=('success',))
+            if logger.isEnabledFor(logging.DEBUG):
+                logger.debug(r.json())
+                logger.debug("Response status 200 - OK")
             return True
 
+    def send_multicast(self, tokens, client=None):
+        '''
+        Sends the message to any number of tokens, MAX_MULTICAST_TOKENS per
+        request.
+
+        :param tokens: iterable of registration tokens
+        :param client: FCMClient to send with, the shared one by default
+        :return: MulticastResult with one TokenResult per token
+        '''
+        logger = logging.getLogger('cuckoo')
+        client = client or get_default_client()
+        result = MulticastResult()
+        for chunk in chunked(tokens, MAX_MULTICAST_TOKENS):
+            try:
+                r = client.post(self.apikey, self._multicast_body(chunk))
+            except requests.RequestException as e:
+                logger.warning("%s while trying to send message to %s tokens .", e, len(chunk))
+                result.add_failure(chunk, str(e))
+                continue
+            if str(r.status_code) != "200":
+                logger.warning("%s error while trying to send message to %s tokens .", r.status_code, len(chunk))
+                result.add_failure(chunk, "HTTP %s" % r.status_code)
+            else:
+                result.add_response(chunk, r.json())
+        failure = result.failure
+        logger.debug("multicast sent to %d tokens in %d requests, %d failed",
+                     len(result), result.requests, failure)
+        metrics = get_metrics()
+        metrics.fcm_messages.inc(len(result) - failure, labels=('success',))
+        metrics.fcm_messages.inc(failure, labels=('failure',))
+        return result
+
+
+class CompiledFCMMessage(FCMMessage):
+    """An immutable FCMMessage with a pre-serialized request body"""
+    __slots__ = ('_body_head', '_frozen')
+
+    def __init__(self, message):
+        FCMMessage.__init__(self, message.apikey, notification=message.notification, data=message.data,
+                            collapse_key=message.collapse_key, time_to_live=message.time_to_live,
+                            priority=message.priority)
+        # keep the serialized body open at the end so the recipients can be appended
+        body = json.dumps(self.dict())
+        object.__setattr__(self, '_body_head', body[:-1] + (', ' if len(body) > 2 else ''))
+        object.__setattr__(self, '_frozen', True)
+
+    def __setattr__(self, name, value):
+        if getattr(self, '_frozen', False):
+            raise AttributeError("%s is immutable" % self.__class__.__name__)
+        object.__setattr__(self, name, value)
+
+    def _request_body(self, to):
+        return self._body_head + '"to": ' + json.dumps(to) + '}'
+
+    def _multicast_body(self, tokens):
+        return self._body_head + '"registration_ids": ' + json.dumps(tokens) + '}'
+
+    def compile(self):
+        return self
+
 
 class WebMessage:
 
     def __init__(self, apikey, payload):
 
         self.apikey = apikey
+        self.payload = payload
 
-    def send(self, token):
+    def send(self, token, client=None):
         logger = logging.getLogger('cuckoo')
-        url = "https://fcm.googleapis.com/fcm/send"
         data = dict(to=token, data=self.payload.dict())
-        r = requests.post(url, data=json.dumps(data), headers={'Content-Type':'application/json', 'Authorization':'key='+str(self.apikey)})
+        r = (client or get_default_client()).post(self.apikey, json.dumps(data))
 
         if str(r.status_code) != "200":
-            logger.warning("{} error while trying to send message to {} .".format(r.status_code, token))
+            logger.warning("%s error while trying to send message to %s .", r.status_code, token)
             return False
         else:
             logger.info("200 OK")
@@ -0,0 +1,299 @@
+# -*- coding: utf-8 -*-
+import threading
+import weakref
+from bisect import bisect_left
+
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+
+class Counter(object):
+    kind = 'counter'
+
+    def __init__(self, name, help, labelnames=()):
+        super(Counter, self).__init__()
+        self.name = name
+        self.help = help
+        self.labelnames = labelnames
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def inc(self, amount=1, labels=()):
+        with self._lock:
+            self._values[labels] = self._values.get(labels, 0) + amount
+
+    def snapshot(self):
+        with self._lock:
+            return dict(self._values)
+
+    def samples(self):
+        values = self.snapshot()
+        if not values and not self.labelnames:
+            # exported as 0 before the first update rather than left out
+            values[()] = 0
+        for labels, value in sorted(values.items()):
+            yield self.name, labels, value
+
+
+class Gauge(Counter):
+    kind = 'gauge'
+
+    def set(self, value, labels=()):
+        with self._lock:
+            self._values[labels] = value
+
+    def dec(self, amount=1, labels=()):
+        self.inc(-amount, labels)
+
+
+class CallbackGauge(Gauge):
+    """A gauge whose value is computed by a function whenever it is read"""
+
+    def __init__(self, name, help, function):
+        super(CallbackGauge, self).__init__(name, help)
+        self.function = function
+
+    def snapshot(self):
+        return {(): self.function()}
+
+
+class Histogram(Counter):
+    kind = 'histogram'
+
+    def __init__(self, name, help, labelnames=(), buckets=LATENCY_BUCKETS):
+        super(Histogram, self).__init__(name, help, labelnames)
+        self.buckets = tuple(buckets)
+
+    def observe(self, value, labels=()):
+        with self._lock:
+            counts = self._values.get(labels)
+            if counts is None:
+                # one count per bucket, then +Inf, then the sum
+                counts = self._values[labels] = [0] * (len(self.buckets) + 1) + [0.0]
+            counts[bisect_left(self.buckets, value)] += 1
+            counts[-1] += value
+
+    def snapshot(self):
+        """Returns {labels: {'count': n, 'sum': s, 'buckets': [(le, cumulative count)]}}"""
+        with self._lock:
+            values = dict((labels, list(counts)) for labels, counts in self._values.items())
+        if not values and not self.labelnames:
+            values[()] = [0] * (len(self.buckets) + 1) + [0.0]
+        snapshot = {}
+        for labels, counts in values.items():
+            cumulative = 0
+            buckets = []
+            for le, count in zip(self.buckets + (float('inf'),), counts):
+                cumulative += count
+                buckets.append((le, cumulative))
+            snapshot[labels] = {'count': cumulative, 'sum': counts[-1], 'buckets': buckets}
+        return snapshot
+
+    def samples(self):
+        for labels, value in sorted(self.snapshot().items()):
+            for le, count in value['buckets']:
+                yield self.name + '_bucket', labels + (('+Inf' if le == float('inf') else repr(le)),), count
+            yield self.name + '_count', labels, value['count']
+            yield self.name + '_sum', labels, value['sum']
+
+
+class _NullMetric(object):
+    """Stands for every metric of a disabled registry, doing nothing"""
+
+    def inc(self, amount=1, labels=()):
+        pass
+
+    def dec(self, amount=1, labels=()):
+        pass
+
+    def set(self, value, labels=()):
+        pass
+
+    def observe(self, value, labels=()):
+        pass
+
+
+NULL_METRIC = _NullMetric()
+
+
+class MetricsRegistry(object):
+    """
+    A set of named counters, gauges and histograms. snapshot() returns
+    their current values as a dict and prometheus() in the Prometheus text
+    exposition format.
+    """
+    enabled = True
+
+    def __init__(self):
+        super(MetricsRegistry, self).__init__()
+        self._metrics = {}
+        self._lock = threading.Lock()
+
+    def _get(self, metric_class, name, *args):
+        with self._lock:
+            metric = self._metrics.get(name)
+            if metric is None:
+                metric = self._metrics[name] = metric_class(name, *args)
+            return metric
+
+    def counter(self, name, help, labelnames=()):
+        return self._get(Counter, name, help, labelnames)
+
+    def gauge(self, name, help, labelnames=()):
+        return self._get(Gauge, name, help, labelnames)
+
+    def callback_gauge(self, name, help, function):
+        return self._get(CallbackGauge, name, help, function)
+
+    def histogram(self, name, help, labelnames=(), buckets=LATENCY_BUCKETS):
+        return self._get(Histogram, name, help, labelnames, buckets)
+
+    def snapshot(self):
+        """
+        Returns {name: value} for metrics without labels and
+        {name: {label values: value}} for the others
+        """
+        with self._lock:
+            metrics = list(self._metrics.values())
+        snapshot = {}
+        for metric in metrics:
+            values = metric.snapshot()
+            snapshot[metric.name] = values.get((), 0) if not metric.labelnames else values
+        return snapshot
+
+    def prometheus(self):
+        """Returns every metric in the Prometheus text exposition format"""
+        with self._lock:
+            metrics = sorted(self._metrics.values(), key=lambda metric: metric.name)
+        lines = []
+        for metric in metrics:
+            lines.append('# HELP %s %s' % (metric.name, metric.help))
+            lines.append('# TYPE %s %s' % (metric.name, metric.kind))
+            labelnames = metric.labelnames
+            for name, labels, value in metric.samples():
+                names = labelnames + ('le',) if len(labels) > len(labelnames) else labelnames
+                if labels:
+                    pairs = ','.join('%s="%s"' % (n, _escape(v)) for n, v in zip(names, labels))
+                    lines.append('%s{%s} %s' % (name, pairs, _format(value)))
+                else:
+                    lines.append('%s %s' % (name, _format(value)))
+        return '\n'.join(lines) + '\n'
+
+
+class NullRegistry(MetricsRegistry):
+    """A disabled registry: every metric it hands out is NULL_METRIC"""
+    enabled = False
+
+    def _get(self, metric_class, name, *args):
+        return NULL_METRIC
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _format(value):
+    if isinstance(value, float):
+        return repr(value)
+    return str(value)
+
+
+class CuckooMetrics(object):
+    """The metrics cuckoo itself records, taken from one registry"""
+
+    def __init__(self, registry):
+        super(CuckooMetrics, self).__init__()
+        self.registry = registry
+        self._gateways = weakref.WeakSet()
+
+        self.connects = registry.counter(
+            'cuckoo_apns_connects_total', "TLS connections established to APNs", ('server',))
+        self.connect_failures = registry.counter(
+            'cuckoo_apns_connect_failures_total', "Failed attempts to connect to APNs", ('server',))
+        self.handshake_seconds = registry.histogram(
+            'cuckoo_apns_handshake_seconds', "Duration of TLS handshakes with APNs")
+        self.sessions_reused = registry.counter(
+            'cuckoo_apns_tls_sessions_reused_total', "TLS handshakes which resumed a previous session")
+        self.disconnects = registry.counter(
+            'cuckoo_apns_disconnects_total', "Connections to APNs closed")
+        self.bytes_written = registry.counter(
+            'cuckoo_apns_bytes_written_total', "Bytes written to the APNs gateway")
+        self.write_seconds = registry.histogram(
+            'cuckoo_apns_write_seconds', "Duration of writes to the APNs gateway")
+        self.write_timeouts = registry.counter(
+            'cuckoo_apns_write_timeouts_total', "Writes to the APNs gateway which timed out")
+        self.write_failures = registry.counter(
+            'cuckoo_apns_write_failures_total', "Writes to the APNs gateway which failed and were retried")
+        self.notifications_sent = registry.counter(
+            'cuckoo_apns_notifications_sent_total', "Notifications written to the APNs gateway, resends excluded")
+        self.notifications_skipped = registry.counter(
+            'cuckoo_apns_notifications_skipped_total', "Notifications not sent to tokens known to be dead")
+        self.notifications_dropped = registry.counter(
+            'cuckoo_apns_notifications_dropped_total', "Notifications dropped by the outbound queue",
+            ('reason',))
+        self.error_responses = registry.counter(
+            'cuckoo_apns_error_responses_total', "Error-responses received from APNs", ('status',))
+        self.resent = registry.counter(
+            'cuckoo_apns_notifications_resent_total', "Notifications queued for a resend after an error-response")
+        self.recovery_seconds = registry.histogram(
+            'cuckoo_apns_recovery_seconds', "Time from an error-response until its resend completed")
+        self.worker_errors = registry.counter(
+            'cuckoo_apns_error_response_worker_errors_total', "Socket errors met by error-response workers")
+        self.feedback_tokens = registry.counter(
+            'cuckoo_apns_feedback_tokens_total', "Tokens read from the APNs feedback service")
+        self.fcm_requests = registry.counter(
+            'cuckoo_fcm_requests_total', "Requests made to FCM", ('status',))
+        self.fcm_request_seconds = registry.histogram(
+            'cuckoo_fcm_request_seconds', "Duration of requests to FCM")
+        self.fcm_retries = registry.counter(
+            'cuckoo_fcm_retries_total', "Requests to FCM which were retried")
+        self.fcm_messages = registry.counter(
+            'cuckoo_fcm_messages_total', "Messages sent to FCM by outcome", ('result',))
+
+        registry.callback_gauge(
+            'cuckoo_apns_sent_buffer_notifications', "Notifications held in the resend buffers",
+            lambda: sum(len(gateway._sent_notifications) for gateway in list(self._gateways)))
+        registry.callback_gauge(
+            'cuckoo_apns_replay_pending_notifications', "Notifications waiting to be resent",
+            lambda: sum(gateway.replay_pending() for gateway in list(self._gateways)))
+        registry.callback_gauge(
+            'cuckoo_apns_queued_notifications', "Notifications waiting in outbound queues",
+            lambda: sum(len(gateway._pending) for gateway in list(self._gateways)))
+
+    def track_gateway(self, gateway):
+        """Includes a GatewayConnection in the buffer and queue gauges"""
+        if self.registry.enabled:
+            self._gateways.add(gateway)
+
+
+_metrics = CuckooMetrics(NullRegistry())
+_metrics_lock = threading.Lock()
+
+
+def get_metrics():
+    """Returns the CuckooMetrics connections and messages record to"""
+    return _metrics
+
+
+def enable_metrics(registry=None):
+    """
+    Starts recording metrics to a registry, a new MetricsRegistry by
+    default, and returns it. Connections pick the registry up when they are
+    created, so enable metrics before creating them. Enabling a registry
+    again keeps the gateways tracked for it.
+    """
+    global _metrics
+    with _metrics_lock:
+        registry = registry if registry is not None else MetricsRegistry()
+        # the callback gauges of a registry read the gateways of the first
+        # CuckooMetrics built on it, so that one is kept on the registry
+        metrics = getattr(registry, '_cuckoo_metrics', None)
+        if metrics is None:
+            metrics = registry._cuckoo_metrics = CuckooMetrics(registry)
+        _metrics = metrics
+        return registry
+
+
+def disable_metrics():
+    global _metrics
+    with _metrics_lock:
+        _metrics = CuckooMetrics(NullRegistry())
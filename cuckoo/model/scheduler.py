@@ -0,0 +1,203 @@
+# -*- coding: utf-8 -*-
+import functools
+import heapq
+import itertools
+import logging
+import threading
+import time
+
+PRIORITY_IMMEDIATE = 10
+PRIORITY_CONSERVE_POWER = 5
+
+# FCM message priorities mapped onto the APNs ones
+FCM_PRIORITIES = {'high': PRIORITY_IMMEDIATE, 'normal': PRIORITY_CONSERVE_POWER}
+
+WORKERS = 1
+IDLE_WAIT_SEC = 1
+
+provider_log = logging.getLogger("cuckoo")
+
+
+class TokenBucket(object):
+    """Allows `rate` acquisitions per second on average and bursts of up to `burst`"""
+
+    def __init__(self, rate, burst=None):
+        super(TokenBucket, self).__init__()
+        self.rate = float(rate)
+        self.burst = float(burst if burst is not None else max(rate, 1))
+        self._tokens = self.burst
+        self._updated = time.monotonic()
+
+    def acquire(self):
+        """
+        Takes a token if one is available and returns 0, otherwise returns
+        the number of seconds until one will be
+        """
+        now = time.monotonic()
+        self._tokens = min(self.burst, self._tokens + (now - self._updated) * self.rate)
+        self._updated = now
+        if self._tokens >= 1:
+            self._tokens -= 1
+            return 0
+        return (1 - self._tokens) / self.rate
+
+
+class SendScheduler(object):
+    """
+    Sends queued APNs notifications and FCM messages by priority instead of
+    in call order, so priority-10 alerts overtake a campaign of priority-5
+    background pushes queued before them.
+
+    Items of the same priority go out in the order they were queued.
+    Notifications whose expiry has passed are dropped before they are
+    encoded, and each app may be given a rate limit: an app over its limit
+    is held back without delaying the items of other apps.
+
+    Items are sent by `workers` threads, started with start() and stopped
+    with close().
+    """
+
+    def __init__(self, workers=WORKERS):
+        super(SendScheduler, self).__init__()
+        self.workers = workers
+        self._queue = []  # (-priority, sequence, item)
+        self._held = {}  # app -> queue of the items held back by its rate limit
+        self._wakeups = []  # (time, app) at which a held app may send again
+        self._sequence = itertools.count()
+        self._limits = {}
+        self._condition = threading.Condition(threading.Lock())
+        self._threads = []
+        self._closing = False
+        self.sent = 0
+        self.expired = 0
+        self.failed = 0
+
+    def __len__(self):
+        with self._condition:
+            return len(self._queue) + sum(len(held) for held in self._held.values())
+
+    def set_rate_limit(self, app, rate, burst=None):
+        """Lets at most `rate` items of an app go out per second, None removes the limit"""
+        with self._condition:
+            if rate is None:
+                self._limits.pop(app, None)
+            else:
+                self._limits[app] = TokenBucket(rate, burst)
+
+    def submit(self, send, priority=PRIORITY_IMMEDIATE, expiry=0, app=None):
+        """
+        Queues a callable doing the actual send. expiry is a unix time after
+        which the item is dropped instead of sent, 0 meaning never.
+        """
+        item = (priority, send, expiry, app)
+        with self._condition:
+            if self._closing:
+                raise RuntimeError("scheduler is closed")
+            heapq.heappush(self._queue, (-priority, next(self._sequence), item))
+            self._condition.notify()
+
+    def send_notification(self, gateway, token_hex, payload, identifier=0, expiry=0,
+                          priority=PRIORITY_IMMEDIATE, app=None):
+        """Queues a GatewayConnection.send_notification call"""
+        send = functools.partial(gateway.send_notification, token_hex, payload, identifier, expiry)
+        self.submit(send, priority, expiry, app)
+
+    def send_notification_multiple(self, gateway, frame, priority=PRIORITY_IMMEDIATE, expiry=0, app=None):
+        """Queues a GatewayConnection.send_notification_multiple call"""
+        self.submit(functools.partial(gateway.send_notification_multiple, frame), priority, expiry, app)
+
+    def send_fcm(self, message, to, app=None):
+        """
+        Queues an FCMMessage for a token, topic or list of tokens. Its
+        priority and time_to_live decide the lane and the expiry.
+        """
+        if isinstance(to, (list, tuple)):
+            send = functools.partial(message.send_multicast, to)
+        else:
+            send = functools.partial(message.send, to)
+        expiry = time.time() + message.time_to_live if message.time_to_live else 0
+        priority = FCM_PRIORITIES.get(message.priority, PRIORITY_IMMEDIATE)
+        self.submit(send, priority, expiry, app)
+
+    def start(self):
+        with self._condition:
+            self._closing = False
+            while len(self._threads) < self.workers:
+                thread = threading.Thread(target=self._run, name=self.__class__.__name__)
+                thread.daemon = True
+                thread.start()
+                self._threads.append(thread)
+
+    def close(self, wait=True):
+        """Stops the workers, after they sent everything queued if wait is True"""
+        with self._condition:
+            self._closing = True
+            if not wait:
+                del self._queue[:]
+                del self._wakeups[:]
+                self._held.clear()
+            self._condition.notify_all()
+        for thread in self._threads:
+            thread.join()
+        self._threads = []
+
+    def _next_item(self):
+        """
+        Returns the next item which may be sent now, or None once closed and
+        drained. An app over its rate limit gets a queue of its own, so its
+        items are set aside once rather than retried on every call.
+        """
+        with self._condition:
+            while True:
+                now = time.monotonic()
+                while self._wakeups and self._wakeups[0][0] <= now:
+                    _, app = heapq.heappop(self._wakeups)
+                    bucket = self._limits.get(app)
+                    delay = bucket.acquire() if bucket is not None else 0
+                    if delay:
+                        heapq.heappush(self._wakeups, (now + delay, app))
+                        continue
+                    held = self._held[app]
+                    item = heapq.heappop(held)[2]
+                    if held:
+                        heapq.heappush(self._wakeups, (now, app))
+                    else:
+                        del self._held[app]
+                    return item
+                while self._queue:
+                    entry = heapq.heappop(self._queue)
+                    app = entry[2][3]
+                    if app in self._held:
+                        heapq.heappush(self._held[app], entry)
+                        continue
+                    bucket = self._limits.get(app)
+                    delay = bucket.acquire() if bucket is not None else 0
+                    if not delay:
+                        return entry[2]
+                    self._held[app] = [entry]
+                    heapq.heappush(self._wakeups, (now + delay, app))
+                if self._closing and not self._held:
+                    return None
+                timeout = self._wakeups[0][0] - now if self._wakeups else IDLE_WAIT_SEC
+                self._condition.wait(timeout)
+
+    def _count(self, counter):
+        with self._condition:
+            setattr(self, counter, getattr(self, counter) + 1)
+
+    def _run(self):
+        while True:
+            item = self._next_item()
+            if item is None:
+                break
+            _, send, expiry, app = item
+            if expiry and expiry < time.time():
+                self._count('expired')
+                provider_log.debug("dropping expired item of app %s", app)
+                continue
+            try:
+                send()
+                self._count('sent')
+            except Exception as e:
+                self._count('failed')
+                provider_log.exception("scheduled send of app %s failed: %s: %s", app, type(e).__name__, e)
@@ -0,0 +1,93 @@
+# -*- coding: utf-8 -*-
+import json
+import re
+
+from cuckoo.model.messages import CompiledPayload, PayloadTooLargeError, Slot, RawSlot, MAX_PAYLOAD_LENGTH
+
+# how json.dumps writes a slot marker: string slots are spliced inside their
+# quotes, raw slots replace the quoted marker as a whole
+_MARKER = re.compile(br'"\\u0000raw:(\w+)\\u0000"|\\u0000str:(\w+)\\u0000')
+_NEEDS_ESCAPE = re.compile(r'[\x00-\x1f"\\]')
+
+ELLIPSIS = u'\u2026'
+
+
+def escape(value):
+    """Returns a string as UTF-8 JSON string content, without the quotes"""
+    if _NEEDS_ESCAPE.search(value) is None:
+        return value.encode('utf-8')
+    return json.dumps(value, ensure_ascii=False)[1:-1].encode('utf-8')
+
+
+class PayloadTemplate(object):
+    """
+    A DataPayload or NotificationPayload serialized once with Slot and
+    RawSlot placeholders, which render() fills with the values of one
+    recipient by splicing their escaped bytes between the static parts.
+
+    A rendered payload longer than MAX_PAYLOAD_LENGTH raises
+    PayloadTooLargeError, unless the template names a string slot to
+    truncate: that value is then shortened, ending with an ellipsis, until
+    the payload fits.
+
+        template = PayloadTemplate(DataPayload(alert="Hi " + Slot("name"), badge=RawSlot("badge")),
+                                   truncate="name")
+        payload = template.render(name=u"Zoë", badge=3)
+    """
+
+    def __init__(self, payload, truncate=None, max_length=MAX_PAYLOAD_LENGTH):
+        super(PayloadTemplate, self).__init__()
+        data = payload.json()
+        self.max_length = max_length
+        self._static = []
+        self._slots = []  # (name, raw) following every static part but the last
+        offset = 0
+        for match in _MARKER.finditer(data):
+            self._static.append(data[offset:match.start()])
+            raw_name, str_name = match.groups()
+            self._slots.append(((raw_name or str_name).decode('ascii'), raw_name is not None))
+            offset = match.end()
+        self._static.append(data[offset:])
+        self._static_length = sum(len(part) for part in self._static)
+        self.slots = tuple(sorted(set(name for name, _ in self._slots)))
+        if truncate is not None and (truncate, False) not in self._slots:
+            raise ValueError("%r is not a string slot of the template" % truncate)
+        self.truncate = truncate
+
+    def render(self, **values):
+        """Returns a CompiledPayload with every slot replaced by its value"""
+        encoded = {}
+        for name, raw in self._slots:
+            if name not in encoded:
+                value = values[name]
+                if raw:
+                    encoded[name] = json.dumps(value, separators=(',', ':'), ensure_ascii=False).encode('utf-8')
+                else:
+                    encoded[name] = escape(value)
+        length = self._static_length + sum(len(encoded[name]) for name, _ in self._slots)
+        if length > self.max_length:
+            if self.truncate is None:
+                raise PayloadTooLargeError(length)
+            occurrences = sum(1 for slot in self._slots if slot == (self.truncate, False))
+            over = length - self.max_length
+            budget = len(encoded[self.truncate]) - -(-over // occurrences)
+            encoded[self.truncate] = self._truncated(values[self.truncate], budget, length)
+
+        parts = []
+        for static, (name, _) in zip(self._static, self._slots):
+            parts.append(static)
+            parts.append(encoded[name])
+        parts.append(self._static[-1])
+        return CompiledPayload(b''.join(parts))
+
+    def _truncated(self, value, budget, length):
+        """Returns the escaped longest prefix of value which, with an ellipsis, takes at most budget bytes"""
+        budget -= len(escape(ELLIPSIS))
+        if budget < 0:
+            raise PayloadTooLargeError(length)
+        size = 0
+        for i, char in enumerate(value):
+            size += len(escape(char))
+            if size > budget:
+                return escape(value[:i] + ELLIPSIS)
+        return escape(value)
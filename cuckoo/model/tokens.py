@@ -0,0 +1,161 @@
+# -*- coding: utf-8 -*-
+import threading
+import time
+from array import array
+from datetime import datetime
+
+from cuckoo.model.utils import binary_token
+
+TOKEN_LENGTH = 32
+
+ALIVE = 0
+DEAD_INVALID = 1  # APNs answered with an invalid token error-response
+DEAD_UNINSTALLED = 2  # the feedback service reported the app uninstalled
+
+STATUS_INVALID_TOKEN = 8
+
+_EMPTY = -1
+_MIN_TABLE_SIZE = 8
+
+_EPOCH = datetime(1970, 1, 1)
+
+
+class TokenRegistry(object):
+    """
+    A registry of APNs device tokens remembering which of them are dead.
+
+    Tokens are stored as packed 32-byte binary in one contiguous bytearray,
+    the only copy of them the registry keeps. They are found through an
+    open-addressing hash table of slot numbers: a token's hash picks where
+    to start probing, and every slot met on the way is compared against the
+    bytearray. The table is kept at most half full, so the index takes 8 to
+    16 bytes per token. The registration time and the state of every token
+    are kept in parallel compact arrays. Tokens reported by the feedback
+    service or rejected with an invalid-token error-response are
+    tombstoned, so the send paths can skip them before encoding.
+    """
+
+    def __init__(self):
+        super(TokenRegistry, self).__init__()
+        self._tokens = bytearray()
+        self._table = array('i', [_EMPTY]) * _MIN_TABLE_SIZE
+        self._registered = array('I')
+        self._states = bytearray()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._states)
+
+    def __contains__(self, token):
+        return self._find(binary_token(token)) is not None
+
+    def _find(self, token):
+        """Returns the slot of a binary token, or None if it is not registered"""
+        table = self._table
+        mask = len(table) - 1
+        tokens = self._tokens
+        i = hash(token) & mask
+        while True:
+            slot = table[i]
+            if slot == _EMPTY:
+                return None
+            start = slot * TOKEN_LENGTH
+            if tokens[start:start + TOKEN_LENGTH] == token:
+                return slot
+            i = (i + 1) & mask
+
+    @staticmethod
+    def _place(table, token, slot):
+        mask = len(table) - 1
+        i = hash(token) & mask
+        while table[i] != _EMPTY:
+            i = (i + 1) & mask
+        table[i] = slot
+
+    def _insert(self, token, registered_at):
+        """Registers a binary token which is not in the registry yet; called with the lock held"""
+        slot = len(self._states)
+        self._tokens += token
+        self._registered.append(registered_at)
+        self._states.append(ALIVE)
+        if 2 * (slot + 1) > len(self._table):
+            # readers go on probing the old table until the new one is complete
+            table = array('i', [_EMPTY]) * (2 * len(self._table))
+            tokens = bytes(self._tokens)
+            for other in range(slot + 1):
+                self._place(table, tokens[other * TOKEN_LENGTH:(other + 1) * TOKEN_LENGTH], other)
+            self._table = table
+        else:
+            self._place(self._table, token, slot)
+        return slot
+
+    def add(self, token, registered_at=None):
+        """
+        Registers a token, or revives a dead one, and returns its slot.
+        registered_at is a unix time; a later feedback report older than it
+        does not kill the token.
+        """
+        token = binary_token(token)
+        if len(token) != TOKEN_LENGTH:
+            raise ValueError("token must be %d bytes long" % TOKEN_LENGTH)
+        registered_at = int(time.time() if registered_at is None else registered_at)
+        with self._lock:
+            slot = self._find(token)
+            if slot is None:
+                slot = self._insert(token, registered_at)
+            else:
+                self._registered[slot] = registered_at
+                self._states[slot] = ALIVE
+        return slot
+
+    def token(self, slot):
+        """Returns the binary token stored in a slot"""
+        return bytes(self._tokens[slot * TOKEN_LENGTH:(slot + 1) * TOKEN_LENGTH])
+
+    def state(self, token):
+        slot = self._find(binary_token(token))
+        return None if slot is None else self._states[slot]
+
+    def is_dead(self, token):
+        slot = self._find(binary_token(token))
+        return slot is not None and self._states[slot] != ALIVE
+
+    def mark_dead(self, token, reason=DEAD_INVALID, failed_at=None):
+        """
+        Tombstones a token, registering it first if needed. With failed_at
+        (a unix time) a token registered after that moment is left alive.
+        Returns True if the token is dead afterwards.
+        """
+        token = binary_token(token)
+        with self._lock:
+            slot = self._find(token)
+            if slot is None:
+                slot = self._insert(token, 0)
+            if failed_at is not None and self._registered[slot] > failed_at:
+                return False
+            self._states[slot] = reason
+        return True
+
+    def apply_feedback(self, items):
+        """
+        Tombstones tokens from FeedbackConnection.items() pairs or
+        FeedbackConnection.items_bulk() batches. Returns how many died.
+        """
+        dead = 0
+        for item in items:
+            records = item if not isinstance(item, tuple) else (item,)
+            for token, failed_at in records:
+                if isinstance(failed_at, datetime):
+                    failed_at = (failed_at - _EPOCH).total_seconds()
+                dead += self.mark_dead(token, DEAD_UNINSTALLED, failed_at)
+        return dead
+
+    def live_tokens(self):
+        """Yields the binary form of every token which is not dead"""
+        tokens = bytes(self._tokens)
+        for slot, state in enumerate(self._states):
+            if state == ALIVE:
+                yield tokens[slot * TOKEN_LENGTH:(slot + 1) * TOKEN_LENGTH]
+
+    def dead_count(self):
+        return len(self._states) - self._states.count(ALIVE)
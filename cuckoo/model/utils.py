@@ -1,8 +1,10 @@
 # -*- coding: utf-8 -*-
-from struct import pack, unpack
+from binascii import a2b_hex
+from struct import pack, unpack, unpack_from
 
 ER_STATUS = 'status'
 ER_IDENTIFER = 'identifier'
+ER_CONNECTION = 'connection'
 
 def packed_uchar(num):
     """
@@ -43,9 +45,39 @@ def unpacked_char_big_endian(bytes):
     """
     return unpack('c', bytes)[0]
 
-def getListIndexFromID(this_class, the_list, identifier):
-    return next(index for (index, d) in enumerate(the_list)
-                    if d['id'] == identifier)
-
 def convert_error_response_to_dict(this_class, error_response_tuple):
     return {ER_STATUS: error_response_tuple[0], ER_IDENTIFER: error_response_tuple[1]}
+
+
+def binary_token(token):
+    """
+    Returns a device token in its 32-byte binary form, decoding it if it is
+    given as hex
+    """
+    if isinstance(token, (bytes, bytearray)) and len(token) == 32:
+        return bytes(token)
+    return a2b_hex(token)
+
+def token_from_message(message):
+    """
+    Returns the binary token of an enhanced-format (command 1) or frame
+    (command 2) notification
+    """
+    if message[0] == 1:
+        return bytes(message[11:43])
+    return bytes(message[8:40])
+
+def expiry_from_message(message):
+    """
+    Returns the expiry of an enhanced-format (command 1) or frame item
+    (command 2) notification, 0 meaning it is not stored by APNs
+    """
+    if message[0] == 1:
+        return unpack_from('!I', message, 5)[0]
+    offset = 5
+    while offset < len(message):
+        item_id, item_length = unpack_from('!BH', message, offset)
+        if item_id == 4:
+            return unpack_from('!I', message, offset + 3)[0]
+        offset += 3 + item_length
+    return 0
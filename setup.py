@@ -15,6 +15,13 @@ setup(name='Cuckoo',
       long_description=README,
       classifiers=[
         "Programming Language :: Python",
+        "Programming Language :: Python :: 3",
+        "Programming Language :: Python :: 3 :: Only",
+        "Programming Language :: Python :: 3.7",
+        "Programming Language :: Python :: 3.8",
+        "Programming Language :: Python :: 3.9",
+        "Programming Language :: Python :: 3.10",
+        "Programming Language :: Python :: 3.11",
         "Framework :: Autobahn",
         "Topic :: Internet :: WWW/HTTP",
         "Topic :: Internet :: WWW/HTTP :: WSGI :: Application",
@@ -23,9 +30,15 @@ setup(name='Cuckoo',
       author_email='biuro@biokod.pl',
       url='',
       keywords='apple push notification',
-      packages=find_packages(),
+      packages=find_packages(exclude=['tests', 'tests.*', 'benchmarks']),
       include_package_data=True,
       zip_safe=False,
-      test_suite='cuckoo-test',
+      test_suite='tests',
+      python_requires='>=3.7',
       install_requires=requires,
+      entry_points={
+        'console_scripts': [
+          'cuckoo-broadcast = cuckoo.cli:main',
+          ],
+        },
       )
\ No newline at end of file
@@ -0,0 +1,163 @@
+# -*- coding: utf-8 -*-
+import asyncio
+import os
+import shutil
+import ssl
+import threading
+import time
+import unittest
+
+from benchmarks.servers import MockAPNsServer, make_certificate
+from cuckoo.model.fcm_async import AsyncFCMSender
+from cuckoo.model.gateway_async import AsyncGatewayConnection
+from cuckoo.model.messages import DataPayload, FCMMessage, Frame
+
+TOKENS = ['%064x' % (i * 0x1f2e3d4c5b6a7988) for i in range(1, 201)]
+WAIT_SEC = 10
+
+certificate = None
+
+
+def setUpModule():
+    global certificate
+    certificate = make_certificate()
+
+
+def tearDownModule():
+    shutil.rmtree(os.path.dirname(certificate[0]))
+
+
+async def wait_until(condition, timeout=WAIT_SEC):
+    deadline = time.time() + timeout
+    while not condition():
+        if time.time() > deadline:
+            return False
+        await asyncio.sleep(0.01)
+    return True
+
+
+class StubResponse(object):
+    status_code = 200
+
+    def json(self):
+        return {'results': [{'message_id': '0:1'}]}
+
+
+class SlowClient(object):
+    """Answers every request with success after delay seconds, counting the requests in flight"""
+
+    def __init__(self, delay):
+        self.delay = delay
+        self.posted = 0
+        self.in_flight = 0
+        self.max_in_flight = 0
+        self._lock = threading.Lock()
+
+    def post(self, apikey, body):
+        with self._lock:
+            self.in_flight += 1
+            self.max_in_flight = max(self.max_in_flight, self.in_flight)
+        time.sleep(self.delay)
+        with self._lock:
+            self.in_flight -= 1
+            self.posted += 1
+        return StubResponse()
+
+
+class AsyncFCMSenderTest(unittest.TestCase):
+
+    def setUp(self):
+        self.message = FCMMessage('apikey', data={'message': 'hello'})
+
+    def test_send_stream_yields_a_result_for_every_pair(self):
+        client = SlowClient(0.01)
+
+        async def run():
+            async with AsyncFCMSender(client, concurrency=4) as sender:
+                pairs = [(self.message, 'token%d' % i) for i in range(20)] + [(self.message, ['token'])]
+                return [result async for result in sender.send_stream(pairs)]
+
+        results = asyncio.run(run())
+        self.assertEqual(len(results), 21)
+        self.assertTrue(all(result.success for result in results))
+        self.assertEqual(client.posted, 21)
+        self.assertLessEqual(client.max_in_flight, 4)
+
+    def test_close_does_not_block_the_event_loop(self):
+        client = SlowClient(0.3)
+
+        async def run():
+            sender = AsyncFCMSender(client)
+            send = asyncio.ensure_future(sender.send(self.message, 'token'))
+            await wait_until(lambda: client.in_flight)
+            ticks = 0
+            close = asyncio.ensure_future(sender.close())
+            while not close.done():
+                await asyncio.sleep(0.01)
+                ticks += 1
+            await send
+            return ticks
+
+        self.assertGreater(asyncio.run(run()), 5)
+        self.assertEqual(client.posted, 1)
+
+    def test_stopping_a_stream_early_cancels_pending_sends(self):
+        client = SlowClient(0.05)
+        pulled = []
+
+        def pairs():
+            for i in range(100):
+                pulled.append(i)
+                yield self.message, 'token%d' % i
+
+        async def run():
+            sender = AsyncFCMSender(client, concurrency=4)
+            stream = sender.send_stream(pairs())
+            async for _ in stream:
+                break
+            await stream.aclose()
+            await asyncio.sleep(0)
+            others = [task for task in asyncio.all_tasks() if task is not asyncio.current_task()]
+            await sender.close()
+            return others
+
+        self.assertEqual(asyncio.run(run()), [])
+        self.assertLessEqual(len(pulled), 5)
+
+
+class AsyncGatewayConnectionTest(unittest.TestCase):
+
+    def setUp(self):
+        self.payload = DataPayload(alert=u"Hi").compile()
+        self.server = MockAPNsServer(*certificate, fail_ids=(100,))
+        self.server.start()
+        self.context = ssl.SSLContext(ssl.PROTOCOL_TLS_CLIENT)
+        self.context.check_hostname = False
+        self.context.verify_mode = ssl.CERT_NONE
+
+    def tearDown(self):
+        self.server.stop()
+
+    def test_notifications_after_an_error_response_are_resent(self):
+        responses = []
+
+        async def run():
+            async with AsyncGatewayConnection(server='127.0.0.1', port=self.server.port,
+                                              ssl_context=self.context) as gateway:
+                gateway.register_response_listener(responses.append)
+                for identifier, token in enumerate(TOKENS[:150]):
+                    self.assertTrue(await gateway.send_notification(token, self.payload, identifier))
+                await gateway.send_notification_multiple(Frame.from_tokens(TOKENS[150:], self.payload, 150))
+                self.assertTrue(await wait_until(lambda: self.server.received >= len(TOKENS) - 1))
+                self.assertTrue(await wait_until(lambda: not gateway.replay_pending()))
+                return len(gateway.recovery_times)
+
+        self.assertEqual(asyncio.run(run()), 1)
+        self.assertEqual(self.server.received, len(TOKENS) - 1)
+        self.assertNotIn(100, self.server.arrivals)
+        self.assertEqual(set(self.server.arrivals), set(range(len(TOKENS))) - {100})
+        self.assertEqual([(r['status'], r['identifier']) for r in responses], [(8, 100)])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,122 @@
+# -*- coding: utf-8 -*-
+import os
+import shutil
+import tempfile
+import unittest
+from binascii import a2b_hex
+
+from cuckoo.model.broadcast import Broadcast, Checkpoint, TOKEN_FORMAT_BINARY, TOKEN_FORMAT_HEX
+from cuckoo.model.messages import DataPayload
+from cuckoo.model.tokens import TokenRegistry
+
+TOKENS = ['%064x' % (i * 0x1f2e3d4c5b6a7988) for i in range(1, 51)]
+
+
+class RecordingGateway(object):
+    """Records the identifiers of every frame, failing on the frame numbered fail_at"""
+
+    def __init__(self, fail_at=None):
+        self.fail_at = fail_at
+        self.frames = []
+
+    def send_notification_multiple(self, frame):
+        if len(self.frames) == self.fail_at:
+            raise IOError("gateway gone")
+        self.frames.append(list(frame.item_identifiers))
+
+    @property
+    def identifiers(self):
+        return [identifier for frame in self.frames for identifier in frame]
+
+
+class BroadcastTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp(prefix='cuckoo-test-')
+        self.payload = DataPayload(alert=u"Hi").compile()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def token_file(self, content, name='tokens'):
+        path = os.path.join(self.directory, name)
+        with open(path, 'wb') as f:
+            f.write(content)
+        return path
+
+    def broadcast(self, gateway, path, **kwargs):
+        broadcast = Broadcast(gateway, path, self.payload, frame_size=10, workers=0, **kwargs)
+        self.addCleanup(broadcast.close)
+        return broadcast
+
+
+class CheckpointTest(BroadcastTestCase):
+
+    def test_new_checkpoint_starts_at_the_beginning(self):
+        checkpoint = Checkpoint(os.path.join(self.directory, 'checkpoint'))
+        self.assertEqual((checkpoint.offset, checkpoint.index), (0, 0))
+
+    def test_saved_position_is_read_back(self):
+        path = os.path.join(self.directory, 'checkpoint')
+        Checkpoint(path).save(650, 10)
+        checkpoint = Checkpoint(path)
+        self.assertEqual((checkpoint.offset, checkpoint.index), (650, 10))
+        self.assertEqual(os.listdir(self.directory), ['checkpoint'])
+
+    def test_broadcast_resumes_after_the_last_written_frame(self):
+        path = self.token_file('\n'.join(TOKENS).encode('ascii') + b'\n')
+        checkpoint = os.path.join(self.directory, 'checkpoint')
+        failing = RecordingGateway(fail_at=2)
+        self.assertRaises(IOError, self.broadcast(failing, path, checkpoint=checkpoint).run)
+        self.assertEqual(failing.identifiers, list(range(20)))
+        self.assertEqual(Checkpoint(checkpoint).index, 20)
+
+        gateway = RecordingGateway()
+        self.assertEqual(self.broadcast(gateway, path, checkpoint=checkpoint).run(), 30)
+        self.assertEqual(gateway.identifiers, list(range(20, 50)))
+        self.assertEqual(Checkpoint(checkpoint).offset, os.path.getsize(path))
+
+
+class BroadcastTest(BroadcastTestCase):
+
+    def test_hex_file_with_blank_lines_keeps_the_numbering(self):
+        lines = TOKENS[:5] + [''] + TOKENS[5:]
+        path = self.token_file('\r\n'.join(lines).encode('ascii'))
+        gateway = RecordingGateway()
+        progress = []
+        broadcast = self.broadcast(gateway, path, first_identifier=1000)
+        self.assertEqual(broadcast.tokens.format, TOKEN_FORMAT_HEX)
+        self.assertEqual(broadcast.run(progress=lambda b: progress.append(b.sent)), len(TOKENS))
+        self.assertEqual(gateway.identifiers, [1000 + i for i in range(len(lines)) if i != 5])
+        self.assertEqual(progress[-1], len(TOKENS))
+
+    def test_binary_file(self):
+        path = self.token_file(b''.join(a2b_hex(token) for token in TOKENS))
+        gateway = RecordingGateway()
+        broadcast = self.broadcast(gateway, path)
+        self.assertEqual(broadcast.tokens.format, TOKEN_FORMAT_BINARY)
+        self.assertEqual(broadcast.run(), len(TOKENS))
+        self.assertEqual([len(frame) for frame in gateway.frames], [10] * 5)
+
+    def test_dead_tokens_are_skipped(self):
+        registry = TokenRegistry()
+        registry.mark_dead(TOKENS[3])
+        registry.mark_dead(TOKENS[42])
+        path = self.token_file('\n'.join(TOKENS).encode('ascii'))
+        gateway = RecordingGateway()
+        broadcast = self.broadcast(gateway, path, token_registry=registry)
+        self.assertEqual(broadcast.run(), len(TOKENS) - 2)
+        self.assertEqual(broadcast.skipped, 2)
+        self.assertEqual(gateway.identifiers, [i for i in range(len(TOKENS)) if i not in (3, 42)])
+
+    def test_frames_encoded_by_worker_processes_are_written_in_file_order(self):
+        path = self.token_file('\n'.join(TOKENS).encode('ascii'))
+        gateway = RecordingGateway()
+        broadcast = Broadcast(gateway, path, self.payload, frame_size=7, workers=2)
+        self.addCleanup(broadcast.close)
+        self.assertEqual(broadcast.run(), len(TOKENS))
+        self.assertEqual(gateway.identifiers, list(range(len(TOKENS))))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,111 @@
+# -*- coding: utf-8 -*-
+import collections
+import random
+import unittest
+
+from cuckoo.model.buffers import SentNotificationBuffer
+
+
+class ReferenceBuffer(object):
+    """The behaviour SentNotificationBuffer must have, kept in a plain deque"""
+
+    def __init__(self, maxlen):
+        self.records = collections.deque(maxlen=maxlen)
+
+    def append(self, identifier, message):
+        self.records.append((identifier, message))
+
+    def _position(self, identifier):
+        for i, (other, _) in enumerate(self.records):
+            if other == identifier:
+                return i
+        return None
+
+    def get(self, identifier):
+        i = self._position(identifier)
+        return None if i is None else self.records[i][1]
+
+    def drop_through(self, identifier):
+        i = self._position(identifier)
+        if i is None:
+            return False
+        for _ in range(i + 1):
+            self.records.popleft()
+        return True
+
+
+class SentNotificationBufferTest(unittest.TestCase):
+
+    def test_rejects_empty_buffer(self):
+        self.assertRaises(ValueError, SentNotificationBuffer, 0)
+
+    def test_keeps_send_order(self):
+        buff = SentNotificationBuffer(10)
+        buff.extend((i, b'message %d' % i) for i in range(5))
+        self.assertEqual(len(buff), 5)
+        self.assertEqual(list(buff), [(i, b'message %d' % i) for i in range(5)])
+        self.assertEqual(buff.get(3), b'message 3')
+        self.assertIn(3, buff)
+        self.assertNotIn(7, buff)
+        self.assertIsNone(buff.get(7))
+
+    def test_overwrites_oldest_when_full(self):
+        buff = SentNotificationBuffer(3)
+        buff.extend((i, b'%d' % i) for i in range(5))
+        self.assertEqual(list(buff), [(2, b'2'), (3, b'3'), (4, b'4')])
+        self.assertIsNone(buff.get(1))
+        self.assertFalse(buff.drop_through(1))
+
+    def test_drop_through(self):
+        buff = SentNotificationBuffer(10)
+        buff.extend((i, b'%d' % i) for i in range(6))
+        self.assertTrue(buff.drop_through(2))
+        self.assertEqual([identifier for identifier, _ in buff], [3, 4, 5])
+        self.assertIsNone(buff.get(2))
+        self.assertTrue(buff.drop_through(5))
+        self.assertEqual(len(buff), 0)
+        buff.append(6, b'6')
+        self.assertEqual(list(buff), [(6, b'6')])
+
+    def test_repeated_identifier_resolves_to_first_occurrence(self):
+        buff = SentNotificationBuffer(10)
+        buff.extend([(1, b'a'), (2, b'b'), (1, b'c'), (3, b'd')])
+        self.assertEqual(buff.get(1), b'a')
+        self.assertTrue(buff.drop_through(1))
+        self.assertEqual([message for _, message in buff], [b'b', b'c', b'd'])
+        self.assertEqual(buff.get(1), b'c')
+
+    def test_clear(self):
+        buff = SentNotificationBuffer(4)
+        buff.extend((i, b'%d' % i) for i in range(6))
+        buff.clear()
+        self.assertEqual(len(buff), 0)
+        self.assertEqual(list(buff), [])
+        self.assertIsNone(buff.get(5))
+
+    def test_matches_reference_with_random_operations(self):
+        rng = random.Random(1234)
+        for maxlen in (1, 2, 7, 64):
+            buff = SentNotificationBuffer(maxlen)
+            reference = ReferenceBuffer(maxlen)
+            for step in range(3000):
+                # few distinct identifiers, so they repeat and get evicted
+                identifier = rng.randrange(maxlen * 2 + 3)
+                operation = rng.random()
+                if operation < 0.6:
+                    message = b'%d-%d' % (identifier, step)
+                    buff.append(identifier, message)
+                    reference.append(identifier, message)
+                elif operation < 0.8:
+                    self.assertEqual(buff.get(identifier), reference.get(identifier))
+                elif operation < 0.97:
+                    self.assertEqual(buff.drop_through(identifier), reference.drop_through(identifier))
+                else:
+                    buff.clear()
+                    reference.records.clear()
+                self.assertEqual(len(buff), len(reference.records))
+                self.assertEqual(list(buff), list(reference.records))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,114 @@
+# -*- coding: utf-8 -*-
+import threading
+import time
+import unittest
+from binascii import a2b_hex
+
+from cuckoo.model.collapse import NotificationCollapser
+from cuckoo.model.connections import GatewayConnectionPool
+from cuckoo.model.messages import DataPayload
+from cuckoo.model.tokens import TokenRegistry
+
+TOKENS = ['%064x' % (i * 0x1f2e3d4c5b6a7988) for i in range(1, 4)]
+
+
+class RecordingGateway(object):
+    token_registry = None
+
+    def __init__(self):
+        self.sent = []
+        self.frames = []
+        self.event = threading.Event()
+
+    def send_notification(self, token, payload, identifier=0, expiry=0):
+        self.sent.append((token, payload, identifier))
+        self.event.set()
+        return True
+
+    def send_notification_multiple(self, frame):
+        self.frames.append(frame)
+        self.event.set()
+
+
+class RecordingFCMMessage(object):
+
+    def __init__(self, collapse_key, sent):
+        self.apikey = 'apikey'
+        self.collapse_key = collapse_key
+        self.sent = sent
+
+    def send(self, to):
+        self.sent.append((self, to))
+        return True
+
+
+class NotificationCollapserTest(unittest.TestCase):
+
+    def setUp(self):
+        self.collapser = NotificationCollapser(window=0.05)
+        self.gateway = RecordingGateway()
+        self.payload = DataPayload(alert="hello")
+
+    def tearDown(self):
+        self.collapser.close()
+
+    def test_notification_without_collapse_key_is_sent_at_once(self):
+        self.collapser.send_notification(self.gateway, TOKENS[0], self.payload, 1)
+        self.assertEqual(self.gateway.sent, [(TOKENS[0], self.payload, 1)])
+        self.assertEqual(len(self.collapser), 0)
+
+    def test_only_the_newest_notification_is_sent(self):
+        payloads = [DataPayload(badge=badge) for badge in range(3)]
+        start = time.time()
+        for identifier, payload in enumerate(payloads):
+            self.collapser.send_notification(self.gateway, TOKENS[0], payload, identifier, collapse_key='badge')
+        self.assertEqual(len(self.collapser), 1)
+        self.assertTrue(self.gateway.event.wait(2))
+        self.assertGreaterEqual(time.time() - start, 0.05)
+        self.assertEqual(self.gateway.sent, [(a2b_hex(TOKENS[0]), payloads[2], 2)])
+        self.assertEqual(self.collapser.collapsed, 2)
+
+    def test_collapse_keys_and_tokens_are_kept_apart(self):
+        self.collapser.send_notification(self.gateway, TOKENS[0], self.payload, 1, collapse_key='badge')
+        self.collapser.send_notification(self.gateway, TOKENS[0], self.payload, 2, collapse_key='alert')
+        self.collapser.send_notification(self.gateway, TOKENS[1], self.payload, 3, collapse_key='badge')
+        self.collapser.flush()
+        self.assertEqual(self.gateway.sent, [])
+        self.assertEqual(len(self.gateway.frames), 1)
+        self.assertEqual(list(self.gateway.frames[0].item_identifiers), [1, 2, 3])
+        self.assertEqual(self.collapser.collapsed, 0)
+
+    def test_fcm_messages_collapse_on_their_collapse_key(self):
+        sent = []
+        first, second = RecordingFCMMessage('score', sent), RecordingFCMMessage('score', sent)
+        self.collapser.send_fcm(first, 'device')
+        self.collapser.send_fcm(second, 'device')
+        self.collapser.send_fcm(RecordingFCMMessage(None, sent), 'device')
+        self.assertEqual(len(sent), 1)
+        self.collapser.flush()
+        self.assertEqual(sent[1:], [(second, 'device')])
+
+    def test_close_sends_what_is_queued(self):
+        self.collapser.send_notification(self.gateway, TOKENS[0], self.payload, 1, collapse_key='badge')
+        self.collapser.close()
+        self.assertEqual(len(self.gateway.sent), 1)
+        self.assertRaises(RuntimeError, self.collapser.send_notification, self.gateway, TOKENS[0], self.payload,
+                          2, collapse_key='badge')
+
+    def test_frame_for_a_pool_skips_dead_tokens(self):
+        registry = TokenRegistry()
+        registry.mark_dead(TOKENS[1])
+        pool = GatewayConnectionPool(2, token_registry=registry)
+        self.assertIs(pool.token_registry, registry)
+        self.assertTrue(all(c.token_registry is registry for c in pool.connections))
+        frames = []
+        pool.send_notification_multiple = frames.append
+        for identifier, token in enumerate(TOKENS):
+            self.collapser.send_notification(pool, token, self.payload, identifier, collapse_key='badge')
+        self.collapser.flush()
+        self.assertEqual(len(frames), 1)
+        self.assertEqual(list(frames[0].item_identifiers), [0, 2])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,192 @@
+# -*- coding: utf-8 -*-
+import json
+import threading
+import time
+import unittest
+from http.server import BaseHTTPRequestHandler, HTTPServer
+
+import requests
+
+from cuckoo.model.fcm import FCMClient, MulticastResult
+from cuckoo.model.messages import FCMMessage
+
+
+class StubResponse(object):
+
+    def __init__(self, status_code, body=None):
+        self.status_code = status_code
+        self._body = body
+
+    def json(self):
+        return self._body
+
+
+class StubClient(object):
+    """Answers every request with the next of responses, raising those which are exceptions"""
+
+    def __init__(self, responses):
+        self.responses = list(responses)
+        self.bodies = []
+
+    def post(self, apikey, body):
+        self.bodies.append(json.loads(body))
+        response = self.responses.pop(0)
+        if isinstance(response, Exception):
+            raise response
+        return response
+
+
+def ok(*results):
+    return StubResponse(200, {'results': list(results)})
+
+
+class ScriptedHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, *args):
+        pass
+
+    def do_POST(self):
+        self.rfile.read(int(self.headers['Content-Length']))
+        self.server.requests.append(time.monotonic())
+        status, headers = self.server.responses.pop(0)
+        self.send_response(status)
+        for name, value in headers.items():
+            self.send_header(name, value)
+        self.send_header('Content-Length', '2')
+        self.end_headers()
+        self.wfile.write(b'{}')
+
+
+class ScriptedServer(HTTPServer):
+    """Answers requests with the next (status, headers) of responses"""
+
+    def __init__(self, responses):
+        HTTPServer.__init__(self, ('127.0.0.1', 0), ScriptedHandler)
+        self.responses = list(responses)
+        self.requests = []
+        thread = threading.Thread(target=self.serve_forever)
+        thread.daemon = True
+        thread.start()
+
+    @property
+    def url(self):
+        return "http://127.0.0.1:%d/fcm/send" % self.server_address[1]
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+
+
+class FCMClientRetryTest(unittest.TestCase):
+
+    def serve(self, *responses):
+        server = ScriptedServer(responses)
+        self.addCleanup(server.stop)
+        client = FCMClient(url=server.url, retry=2, backoff=0.05)
+        self.addCleanup(client.close)
+        return server, client
+
+    def test_unavailable_is_retried_with_backoff(self):
+        server, client = self.serve((503, {}), (503, {}), (200, {}))
+        self.assertEqual(client.post('apikey', '{}').status_code, 200)
+        self.assertEqual(len(server.requests), 3)
+        gaps = [b - a for a, b in zip(server.requests, server.requests[1:])]
+        self.assertGreaterEqual(gaps[0], 0.05)
+        self.assertGreaterEqual(gaps[1], 0.1)
+
+    def test_last_response_is_returned_when_retries_run_out(self):
+        server, client = self.serve((500, {}), (429, {}), (503, {}))
+        self.assertEqual(client.post('apikey', '{}').status_code, 503)
+        self.assertEqual(len(server.requests), 3)
+
+    def test_client_errors_are_not_retried(self):
+        server, client = self.serve((400, {}))
+        self.assertEqual(client.post('apikey', '{}').status_code, 400)
+        self.assertEqual(len(server.requests), 1)
+
+    def test_retry_after_takes_precedence_over_backoff(self):
+        server, client = self.serve((429, {'Retry-After': '0.3'}), (200, {}))
+        self.assertEqual(client.post('apikey', '{}').status_code, 200)
+        self.assertGreaterEqual(server.requests[1] - server.requests[0], 0.3)
+
+    def test_retry_after_is_capped(self):
+        client = FCMClient(max_delay=2)
+        response = StubResponse(503)
+        response.headers = {'Retry-After': '3600'}
+        self.assertEqual(client._retry_after(response), 2)
+        response.headers = {'Retry-After': 'Wed, 21 Oct 2015 07:28:00 GMT'}
+        self.assertEqual(client._retry_after(response), 0)
+        response.headers = {'Retry-After': 'soon'}
+        self.assertIsNone(client._retry_after(response))
+
+    def test_connection_error_is_raised_after_the_last_attempt(self):
+        server, client = self.serve()
+        client.url = "http://127.0.0.1:1/fcm/send"
+        start = time.monotonic()
+        self.assertRaises(requests.ConnectionError, client.post, 'apikey', '{}')
+        self.assertGreaterEqual(time.monotonic() - start, 0.15)
+
+
+class MulticastResultTest(unittest.TestCase):
+
+    def test_response_is_matched_to_tokens_in_order(self):
+        result = MulticastResult()
+        result.add_response(['a', 'b', 'c', 'd'], {'results': [
+            {'message_id': '0:1'},
+            {'message_id': '0:2', 'registration_id': 'b2'},
+            {'error': 'NotRegistered'},
+            {'error': 'Unavailable'},
+        ]})
+        self.assertEqual([r.token for r in result], ['a', 'b', 'c', 'd'])
+        self.assertEqual(result.success, 2)
+        self.assertEqual(result.failure, 2)
+        self.assertEqual(result.succeeded(), ['a', 'b'])
+        self.assertEqual(result.canonical_ids(), {'b': 'b2'})
+        self.assertEqual(result.not_registered(), ['c'])
+        self.assertEqual(result.retryable(), ['d'])
+
+    def test_missing_results_are_failures(self):
+        result = MulticastResult()
+        result.add_response(['a', 'b'], {'results': [{'message_id': '0:1'}]})
+        self.assertEqual([r.error for r in result], [None, 'MissingResult'])
+
+    def test_failed_request_fails_every_token(self):
+        result = MulticastResult()
+        result.add_failure(['a', 'b'], 'HTTP 503')
+        self.assertEqual(result.requests, 1)
+        self.assertEqual(result.failure, 2)
+        self.assertEqual(result.retryable(), ['a', 'b'])
+
+
+class SendMulticastTest(unittest.TestCase):
+
+    def setUp(self):
+        self.message = FCMMessage('apikey', data={'message': 'hello'})
+        self.tokens = ['token%d' % i for i in range(2500)]
+
+    def test_tokens_are_sent_in_chunks(self):
+        client = StubClient([ok(*[{'message_id': '0:%d' % i} for i in range(n)]) for n in (1000, 1000, 500)])
+        result = self.message.send_multicast(self.tokens, client=client)
+        self.assertEqual([len(body['registration_ids']) for body in client.bodies], [1000, 1000, 500])
+        self.assertEqual(client.bodies[0]['data'], {'message': 'hello'})
+        self.assertEqual(result.requests, 3)
+        self.assertEqual(result.succeeded(), self.tokens)
+
+    def test_failing_chunk_does_not_lose_the_others(self):
+        client = StubClient([
+            ok(*[{'message_id': '0:%d' % i} for i in range(1000)]),
+            requests.ConnectionError("connection refused"),
+            StubResponse(503),
+        ])
+        result = self.message.send_multicast(self.tokens, client=client)
+        self.assertEqual(len(result), len(self.tokens))
+        self.assertEqual(result.requests, 3)
+        self.assertEqual(result.succeeded(), self.tokens[:1000])
+        errors = [r.error for r in result.failed()]
+        self.assertEqual(errors[:1000], ["connection refused"] * 1000)
+        self.assertEqual(errors[1000:], ["HTTP 503"] * 500)
+
+
+if __name__ == '__main__':
+    unittest.main()
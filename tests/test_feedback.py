@@ -0,0 +1,60 @@
+# -*- coding: utf-8 -*-
+import unittest
+
+from cuckoo.model.feedback import FeedbackBatch, FeedbackParser, FEEDBACK_HEADER
+
+RECORDS = [(bytes(bytearray((i + j) % 256 for j in range(32))), 1500000000 + i) for i in range(20)]
+
+
+def encode(records):
+    return b''.join(FEEDBACK_HEADER.pack(fail_time, len(token)) + token for token, fail_time in records)
+
+
+class FeedbackParserTest(unittest.TestCase):
+
+    def test_records(self):
+        parser = FeedbackParser()
+        parser.feed(encode(RECORDS))
+        self.assertEqual(list(parser.records()), RECORDS)
+        self.assertEqual(parser.pending(), 0)
+
+    def test_records_split_across_chunks(self):
+        data = encode(RECORDS)
+        for size in (1, 5, 37, 38, 100):
+            parser = FeedbackParser()
+            parsed = []
+            for start in range(0, len(data), size):
+                parser.feed(data[start:start + size])
+                parsed.extend(parser.records())
+            self.assertEqual(parsed, RECORDS)
+            self.assertEqual(parser.pending(), 0)
+
+    def test_incomplete_record_stays_pending(self):
+        data = encode(RECORDS[:2])
+        parser = FeedbackParser()
+        parser.feed(data[:-10])
+        self.assertEqual(list(parser.records()), RECORDS[:1])
+        self.assertEqual(parser.pending(), len(data) - 10 - len(encode(RECORDS[:1])))
+        parser.feed(data[-10:])
+        self.assertEqual(list(parser.records()), RECORDS[1:2])
+
+    def test_read_into_batches(self):
+        parser = FeedbackParser()
+        parser.feed(encode(RECORDS))
+        first, second = FeedbackBatch(), FeedbackBatch()
+        self.assertEqual(parser.read_into(first, 15), 15)
+        self.assertEqual(parser.read_into(second, 15), 5)
+        self.assertEqual(list(first) + list(second), RECORDS)
+        self.assertEqual(second.token(1), RECORDS[16][0])
+
+    def test_read_into_skips_tokens_of_wrong_length(self):
+        parser = FeedbackParser()
+        parser.feed(encode(RECORDS[:1] + [(b'short', 1)] + RECORDS[1:2]))
+        batch = FeedbackBatch()
+        with self.assertLogs('cuckoo', 'WARNING'):
+            self.assertEqual(parser.read_into(batch, 10), 2)
+        self.assertEqual(list(batch), RECORDS[:2])
+
+
+if __name__ == '__main__':
+    unittest.main()
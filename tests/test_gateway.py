@@ -0,0 +1,216 @@
+# -*- coding: utf-8 -*-
+import os
+import shutil
+import threading
+import time
+import unittest
+from unittest import mock
+
+from benchmarks.servers import MockAPNsServer, StalledAPNsServer, make_certificate
+from cuckoo.model.connections import GatewayConnection, QueueFullError
+from cuckoo.model.messages import DataPayload, Frame
+
+TOKENS = ['%064x' % (i * 0x1f2e3d4c5b6a7988) for i in range(1, 501)]
+WAIT_SEC = 10
+
+certificate = None
+
+
+def setUpModule():
+    global certificate
+    certificate = make_certificate()
+
+
+def tearDownModule():
+    shutil.rmtree(os.path.dirname(certificate[0]))
+
+
+def wait_until(condition, timeout=WAIT_SEC):
+    deadline = time.time() + timeout
+    while not condition():
+        if time.time() > deadline:
+            return False
+        time.sleep(0.01)
+    return True
+
+
+class GatewayTestCase(unittest.TestCase):
+    server_class = MockAPNsServer
+    fail_ids = ()
+
+    def setUp(self):
+        self.payload = DataPayload(alert=u"Hi").compile()
+        self.server = self.server_class(*certificate, fail_ids=self.fail_ids)
+        self.server.start()
+        self.gateways = []
+
+    def tearDown(self):
+        for gateway in self.gateways:
+            gateway.close(timeout=0)
+        self.server.stop()
+
+    def gateway(self, **kwargs):
+        gateway = GatewayConnection(server='127.0.0.1', port=self.server.port, **kwargs)
+        self.gateways.append(gateway)
+        return gateway
+
+
+class GatewayCloseTest(GatewayTestCase):
+    fail_ids = (450,)
+
+    def test_close_waits_for_the_gateway_and_a_last_resend(self):
+        gateway = self.gateway()
+        gateway.send_notification_multiple(Frame.from_tokens(TOKENS, self.payload))
+        self.assertTrue(gateway.close())
+        self.assertEqual(self.server.received, len(TOKENS) - 1)
+        self.assertNotIn(450, self.server.arrivals)
+        self.assertFalse(gateway.connection_alive)
+
+
+class StalledGatewayCloseTest(GatewayTestCase):
+    server_class = StalledAPNsServer
+
+    def tearDown(self):
+        self.server.release()
+        super(StalledGatewayCloseTest, self).tearDown()
+
+    def test_close_gives_up_after_timeout(self):
+        gateway = self.gateway()
+        gateway.send_notification(TOKENS[0], self.payload, 1)
+        start = time.time()
+        self.assertFalse(gateway.close(timeout=0.3))
+        self.assertLess(time.time() - start, 2)
+        self.assertFalse(gateway.connection_alive)
+
+    def test_close_is_clean_once_the_gateway_closes(self):
+        gateway = self.gateway()
+        gateway.send_notification(TOKENS[0], self.payload, 1)
+        release = threading.Timer(0.3, self.server.release)
+        release.start()
+        start = time.time()
+        self.assertTrue(gateway.close())
+        self.assertGreaterEqual(time.time() - start, 0.25)
+        release.join()
+
+
+class ResendTest(GatewayTestCase):
+    fail_ids = (100, 300)
+
+    @mock.patch('cuckoo.model.connections.RESEND_CHUNK_BYTES', 1000)
+    def test_everything_after_a_failed_notification_is_resent_in_chunks(self):
+        gateway = self.gateway()
+        for identifier, token in enumerate(TOKENS):
+            self.assertTrue(gateway.send_notification(token, self.payload, identifier))
+        self.assertTrue(wait_until(lambda: self.server.received == len(TOKENS) - 2))
+        self.assertTrue(wait_until(lambda: not gateway.replay_pending() and gateway._resender is None))
+        self.assertEqual(set(self.server.arrivals), set(range(len(TOKENS))) - {100, 300})
+        self.assertGreaterEqual(len(gateway.recovery_times), 1)
+
+    @mock.patch('cuckoo.model.connections.RESEND_CHUNK_BYTES', 2000)
+    def test_new_sends_go_out_during_a_resend(self):
+        gateway = self.gateway()
+        take_replay_chunk = gateway._take_replay_chunk
+
+        def slow_replay_chunk():
+            time.sleep(0.02)
+            return take_replay_chunk()
+
+        gateway._take_replay_chunk = slow_replay_chunk
+        gateway.send_notification_multiple(Frame.from_tokens(TOKENS, self.payload))
+        self.assertTrue(wait_until(lambda: gateway.replay_pending() > 100))
+        self.assertTrue(gateway.send_notification(TOKENS[0], self.payload, 1000))
+        self.assertTrue(wait_until(lambda: self.server.received == len(TOKENS) - 1))
+        arrivals = self.server.arrivals
+        self.assertEqual(set(arrivals), set(range(len(TOKENS))) - {100, 300} | {1000})
+        self.assertLess(arrivals[1000], arrivals[len(TOKENS) - 1])
+
+
+class CoalescingTest(GatewayTestCase):
+
+    def test_queued_notifications_are_written_together(self):
+        gateway = self.gateway(coalesce=True, coalesce_delay=0.05)
+        for identifier, token in enumerate(TOKENS[:100]):
+            self.assertTrue(gateway.send_notification(token, self.payload, identifier))
+        self.assertTrue(wait_until(lambda: self.server.received == 100))
+        self.assertEqual(set(self.server.arrivals), set(range(100)))
+        stats = gateway.queue_stats()
+        self.assertEqual(stats['depth'], 0)
+        self.assertEqual(stats['bytes'], 0)
+        self.assertGreater(stats['max_depth'], 1)
+
+    def test_queue_is_written_once_it_holds_coalesce_bytes(self):
+        gateway = self.gateway(coalesce=True, coalesce_delay=60, coalesce_bytes=1)
+        gateway.send_notification(TOKENS[0], self.payload, 1)
+        self.assertTrue(wait_until(lambda: self.server.received == 1))
+
+    def test_flush_writes_right_away(self):
+        gateway = self.gateway(coalesce=True, coalesce_delay=60)
+        for identifier, token in enumerate(TOKENS[:3]):
+            gateway.send_notification(token, self.payload, identifier)
+        time.sleep(0.1)
+        self.assertEqual(self.server.received, 0)
+        self.assertEqual(gateway.queue_stats()['depth'], 3)
+        self.assertTrue(gateway.flush())
+        self.assertTrue(wait_until(lambda: self.server.received == 3))
+
+    def test_frame_goes_out_after_the_queued_notifications(self):
+        gateway = self.gateway(coalesce=True, coalesce_delay=60)
+        gateway.send_notification(TOKENS[0], self.payload, 0)
+        gateway.send_notification_multiple(Frame.from_tokens(TOKENS[1:10], self.payload, 1))
+        self.assertTrue(wait_until(lambda: self.server.received == 10))
+        arrivals = self.server.arrivals
+        self.assertLessEqual(arrivals[0], arrivals[1])
+
+
+class BackpressureTest(GatewayTestCase):
+    """Holds the flush lock, so the queue fills up until the test lets the flusher write"""
+
+    def full_gateway(self, backpressure):
+        gateway = self.gateway(coalesce=True, coalesce_delay=60, max_pending=3, backpressure=backpressure)
+        gateway._flush_lock.acquire()
+        self.addCleanup(lambda: gateway._flush_lock.locked() and gateway._flush_lock.release())
+        for identifier, token in enumerate(TOKENS[:3]):
+            gateway.send_notification(token, self.payload, identifier)
+        return gateway
+
+    def test_unknown_policy_is_rejected(self):
+        self.assertRaises(ValueError, GatewayConnection, coalesce=True, backpressure='wait')
+
+    def test_fail_policy_raises(self):
+        gateway = self.full_gateway('fail')
+        with self.assertRaises(QueueFullError) as raised:
+            gateway.send_notification(TOKENS[3], self.payload, 3)
+        self.assertEqual(raised.exception.queue_depth, 3)
+        gateway._flush_lock.release()
+        self.assertTrue(wait_until(lambda: self.server.received == 3))
+        self.assertEqual(set(self.server.arrivals), {0, 1, 2})
+        self.assertEqual(gateway.queue_stats()['rejected'], 1)
+
+    def test_drop_oldest_policy_discards_the_oldest(self):
+        gateway = self.full_gateway('drop_oldest')
+        gateway.send_notification(TOKENS[3], self.payload, 3)
+        gateway.send_notification(TOKENS[4], self.payload, 4)
+        gateway._flush_lock.release()
+        gateway.flush()
+        self.assertTrue(wait_until(lambda: self.server.received == 3))
+        self.assertEqual(set(self.server.arrivals), {2, 3, 4})
+        self.assertEqual(gateway.queue_stats()['dropped'], 2)
+
+    def test_block_policy_waits_for_room(self):
+        gateway = self.full_gateway('block')
+        sender = threading.Thread(target=gateway.send_notification, args=(TOKENS[3], self.payload, 3))
+        sender.start()
+        sender.join(0.2)
+        self.assertTrue(sender.is_alive())
+        gateway._flush_lock.release()
+        sender.join(WAIT_SEC)
+        self.assertFalse(sender.is_alive())
+        gateway.flush()
+        self.assertTrue(wait_until(lambda: self.server.received == 4))
+        stats = gateway.queue_stats()
+        self.assertEqual(stats['blocked'], 1)
+        self.assertGreaterEqual(stats['blocked_time'], 0.15)
+
+
+if __name__ == '__main__':
+    unittest.main()
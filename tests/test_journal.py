@@ -0,0 +1,85 @@
+# -*- coding: utf-8 -*-
+import os
+import shutil
+import tempfile
+import unittest
+
+from cuckoo.model.buffers import SentNotificationBuffer
+from cuckoo.model.journal import OutboxJournal, JournalLockedError, SEGMENT_NAME
+
+
+class OutboxJournalTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_read_back(self):
+        journal = OutboxJournal(self.directory, segment_size=4096)
+        references = [journal.append(i, b'message %d' % i) for i in range(10)]
+        self.assertEqual([bytes(journal.read(reference)) for reference in references],
+                         [b'message %d' % i for i in range(10)])
+        self.assertEqual([(identifier, bytes(message)) for identifier, message in journal.records()],
+                         [(i, b'message %d' % i) for i in range(10)])
+        journal.close()
+
+    def test_reopened_journal_keeps_records(self):
+        journal = OutboxJournal(self.directory, segment_size=4096)
+        for i in range(5):
+            journal.append(i, b'message %d' % i)
+        journal.close()
+        journal = OutboxJournal(self.directory, segment_size=4096)
+        journal.append(5, b'message 5')
+        self.assertEqual([identifier for identifier, _ in journal.records()], list(range(6)))
+        journal.close()
+
+    def test_oldest_segments_are_deleted(self):
+        journal = OutboxJournal(self.directory, segment_size=256, max_segments=2)
+        first = journal.append(0, b'x' * 100)
+        for i in range(1, 20):
+            journal.append(i, b'x' * 100)
+        self.assertIsNone(journal.read(first))
+        self.assertEqual(len([name for name in os.listdir(self.directory) if name.endswith('.seg')]), 2)
+        self.assertEqual([identifier for identifier, _ in journal.records()][-1], 19)
+        journal.close()
+
+    def test_directory_takes_one_journal_at_a_time(self):
+        journal = OutboxJournal(self.directory, segment_size=4096)
+        self.assertRaises(JournalLockedError, OutboxJournal, self.directory, segment_size=4096)
+        journal.append(1, b'first')
+        journal.close()
+        journal = OutboxJournal(self.directory, segment_size=4096)
+        self.assertEqual([bytes(message) for _, message in journal.records()], [b'first'])
+        self.assertTrue(os.path.exists(os.path.join(self.directory, SEGMENT_NAME % 0)))
+        journal.close()
+
+    def test_rejects_message_larger_than_segment(self):
+        journal = OutboxJournal(self.directory, segment_size=256)
+        self.assertRaises(ValueError, journal.append, 0, b'x' * 256)
+        journal.close()
+
+
+class JournalledBufferTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.journal = OutboxJournal(self.directory, segment_size=4096)
+
+    def tearDown(self):
+        self.journal.close()
+        shutil.rmtree(self.directory)
+
+    def test_reads_messages_back_from_journal(self):
+        buff = SentNotificationBuffer(3, journal=self.journal)
+        buff.extend((i, b'message %d' % i) for i in range(5))
+        self.assertEqual([(identifier, bytes(message)) for identifier, message in buff],
+                         [(2, b'message 2'), (3, b'message 3'), (4, b'message 4')])
+        self.assertEqual(bytes(buff.get(3)), b'message 3')
+        self.assertTrue(buff.drop_through(3))
+        self.assertEqual([identifier for identifier, _ in buff], [4])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,81 @@
+# -*- coding: utf-8 -*-
+import unittest
+from binascii import b2a_hex, a2b_hex
+
+from cuckoo.model.messages import DataPayload, Frame
+from cuckoo.model.utils import token_from_message
+
+TOKENS = ['%064x' % (i * 0x1f2e3d4c5b6a7988) for i in range(1, 41)]
+
+
+def frame_by_items(tokens, payload, first_identifier=0, expiry=0, priority=10, token_registry=None):
+    frame = Frame(token_registry)
+    for i, token in enumerate(tokens):
+        frame.add_item(token, payload, first_identifier + i, expiry, priority)
+    return frame
+
+
+class FrameRecordsTest(unittest.TestCase):
+
+    def setUp(self):
+        self.payload = DataPayload(alert=u"Zażółć gęślą jaźń", badge=3, sound="default").compile()
+
+    def test_records(self):
+        frame = frame_by_items(TOKENS, self.payload, 50)
+        records = list(frame.records())
+        self.assertEqual([identifier for identifier, _ in records], list(range(50, 50 + len(TOKENS))))
+        self.assertEqual(b''.join(message for _, message in records), bytes(frame.get_frame()))
+        self.assertEqual([b2a_hex(token_from_message(message)).decode('ascii') for _, message in records], TOKENS)
+
+    def test_frame_can_grow_while_records_are_kept(self):
+        frame = frame_by_items(TOKENS[:2], self.payload)
+        records = list(frame.records())
+        self.assertTrue(frame.add_item(TOKENS[2], self.payload, 2, 0, 10))
+        self.assertEqual(len(records), 2)
+        self.assertEqual(len(list(frame.records())), 3)
+
+
+    def test_notification_data(self):
+        frame = frame_by_items(TOKENS[:3], self.payload, 9, 1500000000, 5)
+        data = frame.notification_data
+        self.assertEqual([item['token'] for item in data], TOKENS[:3])
+        self.assertEqual([item['identifier'] for item in data], [9, 10, 11])
+        self.assertEqual(set(item['expiry'] for item in data), set([1500000000]))
+        self.assertEqual(set(item['priority'] for item in data), set([5]))
+        self.assertEqual(bytes(data[0]['payload'].json()), self.payload.json())
+
+class FrameFromTokensTest(unittest.TestCase):
+
+    def setUp(self):
+        self.payload = DataPayload(alert=u"Zażółć gęślą jaźń", badge=3, sound="default").compile()
+
+    def assertSameFrame(self, frame, expected):
+        self.assertEqual(bytes(frame.get_frame()), bytes(expected.get_frame()))
+        self.assertEqual(list(frame.item_offsets), list(expected.item_offsets))
+        self.assertEqual(list(frame.item_identifiers), list(expected.item_identifiers))
+
+    def test_hex_tokens(self):
+        self.assertSameFrame(Frame.from_tokens(TOKENS, self.payload, 100, 1500000000, 5),
+                             frame_by_items(TOKENS, self.payload, 100, 1500000000, 5))
+
+    def test_hex_bytes_tokens(self):
+        tokens = [token.encode('ascii') for token in TOKENS]
+        self.assertSameFrame(Frame.from_tokens(tokens, self.payload, 7),
+                             frame_by_items(TOKENS, self.payload, 7))
+
+    def test_binary_tokens(self):
+        tokens = [a2b_hex(token) for token in TOKENS]
+        self.assertSameFrame(Frame.from_tokens(tokens, self.payload),
+                             frame_by_items(TOKENS, self.payload))
+
+    def test_no_tokens(self):
+        frame = Frame.from_tokens([], self.payload)
+        self.assertEqual(bytes(frame.get_frame()), b'')
+        self.assertEqual(list(frame.records()), [])
+
+    def test_rejects_tokens_of_wrong_length(self):
+        self.assertRaises(ValueError, Frame.from_tokens, TOKENS + ['abcd'], self.payload)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,111 @@
+# -*- coding: utf-8 -*-
+import gc
+import unittest
+import weakref
+
+from cuckoo.model.connections import GatewayConnection
+from cuckoo.model.metrics import MetricsRegistry, NULL_METRIC, NullRegistry, disable_metrics, enable_metrics, \
+    get_metrics
+
+
+class MetricsRegistryTest(unittest.TestCase):
+
+    def setUp(self):
+        self.registry = MetricsRegistry()
+
+    def test_metrics_are_created_once(self):
+        counter = self.registry.counter('requests_total', "Requests")
+        self.assertIs(self.registry.counter('requests_total', "Requests"), counter)
+
+    def test_snapshot(self):
+        self.registry.counter('plain_total', "Plain").inc(3)
+        labelled = self.registry.counter('labelled_total', "Labelled", ('status',))
+        labelled.inc(labels=('200',))
+        labelled.inc(2, labels=('500',))
+        gauge = self.registry.gauge('level', "Level")
+        gauge.set(5)
+        gauge.dec(2)
+        self.assertEqual(self.registry.snapshot(), {'plain_total': 3, 'level': 3,
+                                                    'labelled_total': {('200',): 1, ('500',): 2}})
+
+    def test_histogram_buckets_are_cumulative(self):
+        histogram = self.registry.histogram('latency_seconds', "Latency", buckets=(0.1, 1.0))
+        for value in (0.05, 0.1, 0.5, 2.0):
+            histogram.observe(value)
+        value = histogram.snapshot()[()]
+        self.assertEqual(value['count'], 4)
+        self.assertAlmostEqual(value['sum'], 2.65)
+        self.assertEqual(value['buckets'], [(0.1, 2), (1.0, 3), (float('inf'), 4)])
+
+    def test_prometheus_text(self):
+        self.registry.counter('sent_total', "Sent").inc(2)
+        self.registry.counter('errors_total', "Errors", ('reason',)).inc(labels=('bad "token"\n',))
+        self.registry.histogram('write_seconds', "Writes", buckets=(0.5,)).observe(0.25)
+        self.assertEqual(self.registry.prometheus(), '\n'.join([
+            '# HELP errors_total Errors',
+            '# TYPE errors_total counter',
+            'errors_total{reason="bad \\"token\\"\\n"} 1',
+            '# HELP sent_total Sent',
+            '# TYPE sent_total counter',
+            'sent_total 2',
+            '# HELP write_seconds Writes',
+            '# TYPE write_seconds histogram',
+            'write_seconds_bucket{le="0.5"} 1',
+            'write_seconds_bucket{le="+Inf"} 1',
+            'write_seconds_count 1',
+            'write_seconds_sum 0.25',
+        ]) + '\n')
+
+    def test_metrics_without_labels_are_exported_before_the_first_update(self):
+        self.registry.counter('sent_total', "Sent")
+        self.registry.counter('errors_total', "Errors", ('reason',))
+        self.registry.histogram('write_seconds', "Writes", buckets=(0.5,))
+        text = self.registry.prometheus()
+        self.assertIn('sent_total 0\n', text)
+        self.assertNotIn('errors_total{', text)
+        self.assertIn('write_seconds_bucket{le="+Inf"} 0\n', text)
+        self.assertIn('write_seconds_sum 0.0\n', text)
+
+    def test_null_registry_records_nothing(self):
+        registry = NullRegistry()
+        self.assertIs(registry.counter('sent_total', "Sent"), NULL_METRIC)
+        NULL_METRIC.inc()
+        self.assertEqual(registry.snapshot(), {})
+
+
+class EnableMetricsTest(unittest.TestCase):
+
+    def tearDown(self):
+        disable_metrics()
+
+    def test_gateways_are_tracked_by_the_enabled_registry(self):
+        registry = enable_metrics()
+        gateway = GatewayConnection()
+        self.assertIs(get_metrics().registry, registry)
+        get_metrics().notifications_sent.inc(4)
+        snapshot = registry.snapshot()
+        self.assertEqual(snapshot['cuckoo_apns_notifications_sent_total'], 4)
+        self.assertEqual(snapshot['cuckoo_apns_sent_buffer_notifications'], 0)
+        self.assertIn('cuckoo_fcm_retries_total 0\n', registry.prometheus())
+        del gateway
+
+    def test_enabling_a_registry_again_reuses_its_metrics(self):
+        registry = enable_metrics()
+        metrics = get_metrics()
+        disable_metrics()
+        self.assertFalse(get_metrics().registry.enabled)
+        self.assertIs(enable_metrics(registry), registry)
+        self.assertIs(get_metrics(), metrics)
+
+    def test_registry_is_released_once_disabled(self):
+        registry = enable_metrics()
+        GatewayConnection()
+        disable_metrics()
+        reference = weakref.ref(registry)
+        del registry
+        gc.collect()
+        self.assertIsNone(reference())
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,128 @@
+# -*- coding: utf-8 -*-
+import os
+import shutil
+import tempfile
+import threading
+import time
+import unittest
+
+from benchmarks.servers import StalledAPNsServer, make_certificate
+from cuckoo.model.connections import APNServiceRegistry, GatewayConnection
+from cuckoo.model.messages import DataPayload
+
+TOKEN = '%064x' % 0x1f2e3d4c5b6a7988
+
+
+class APNServiceRegistryTest(unittest.TestCase):
+
+    def setUp(self):
+        self.registry = APNServiceRegistry(max_connections=2)
+        for app in ('a', 'b', 'c'):
+            self.registry.register(app, cert_file=None)
+
+    def tearDown(self):
+        self.registry.close()
+
+    def test_unknown_app(self):
+        self.assertIn('a', self.registry)
+        self.assertNotIn('x', self.registry)
+        self.assertRaises(KeyError, self.registry.get, 'x')
+
+    def test_services_are_created_once(self):
+        service = self.registry.get('a')
+        self.assertIs(self.registry.get('a'), service)
+        self.assertIs(self.registry.gateway_server('a'), service.gateway_server)
+        self.assertEqual(self.registry.open_connections(), 1)
+
+    def test_least_recently_used_service_is_closed_over_the_cap(self):
+        services = dict((app, self.registry.get(app)) for app in ('a', 'b'))
+        self.registry.gateway_server('a')
+        self.registry.gateway_server('b')
+        self.registry.gateway_server('a')
+        self.registry.gateway_server('c')
+        self.assertEqual(self.registry.open_connections(), 2)
+        self.assertIs(self.registry.get('a'), services['a'])
+        self.assertIsNot(self.registry.get('b'), services['b'])
+        self.registry.close()
+        self.assertEqual(services['b'].open_connections(), 0)
+
+    def test_idle_service_is_closed(self):
+        self.registry.idle_timeout = 0.05
+        service = self.registry.get('a')
+        self.registry.gateway_server('a')
+        time.sleep(0.1)
+        self.registry.gateway_server('b')
+        self.assertEqual(self.registry.open_connections(), 1)
+        self.assertIsNot(self.registry.get('a'), service)
+
+    def test_register_again_closes_the_service(self):
+        service = self.registry.get('a')
+        self.registry.gateway_server('a')
+        self.registry.register('a', cert_file=None, gateway_connections=2)
+        self.assertEqual(service.open_connections(), 0)
+        self.assertEqual(self.registry.get('a').gateway_connections, 2)
+        self.registry.unregister('a')
+        self.assertNotIn('a', self.registry)
+
+
+class JournalledRegistryTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.registry = APNServiceRegistry(journal_dir=self.directory)
+        self.registry.register('com.example.a', cert_file=None)
+        self.registry.register('com.example.b', cert_file=None)
+
+    def tearDown(self):
+        self.registry.close()
+        shutil.rmtree(self.directory)
+
+    def test_every_app_has_its_own_journal(self):
+        first = self.registry.gateway_server('com.example.a').journal
+        second = self.registry.gateway_server('com.example.b').journal
+        self.assertNotEqual(first.directory, second.directory)
+        first.append(1, b'a')
+        second.append(2, b'b')
+        self.assertEqual([(identifier, bytes(message)) for identifier, message in first.records()], [(1, b'a')])
+        self.assertEqual([(identifier, bytes(message)) for identifier, message in second.records()], [(2, b'b')])
+
+
+class StalledEvictionTest(unittest.TestCase):
+
+    def setUp(self):
+        self.certificate = make_certificate()
+        self.server = StalledAPNsServer(*self.certificate)
+        self.server.start()
+        self.registry = APNServiceRegistry(max_connections=1)
+        self.registry.register('a', cert_file=None)
+        self.registry.register('b', cert_file=None)
+
+    def tearDown(self):
+        self.server.release()
+        self.registry.close()
+        self.server.stop()
+        shutil.rmtree(os.path.dirname(self.certificate[0]))
+
+    def test_eviction_does_not_wait_for_a_stalled_gateway(self):
+        service = self.registry.get('a')
+        gateway = service._gateway_connection = GatewayConnection(server='127.0.0.1', port=self.server.port)
+        gateway.send_notification(TOKEN, DataPayload(alert=u"Hi").compile(), 1)
+        self.assertTrue(gateway.connection_alive)
+
+        start = time.time()
+        self.registry.gateway_server('b')  # evicts app a, whose gateway does not answer
+        self.assertLess(time.time() - start, 1)
+        lookup = threading.Thread(target=self.registry.get, args=('b',))
+        lookup.start()
+        lookup.join(1)
+        self.assertFalse(lookup.is_alive())
+        self.assertTrue(gateway.connection_alive)
+
+        self.server.release()
+        self.registry.close()
+        self.assertFalse(gateway.connection_alive)
+        self.assertIsNone(service._gateway_connection)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,132 @@
+# -*- coding: utf-8 -*-
+import threading
+import time
+import unittest
+
+from cuckoo.model.scheduler import SendScheduler, TokenBucket, PRIORITY_CONSERVE_POWER, PRIORITY_IMMEDIATE
+
+
+class RecordingFCMMessage(object):
+
+    def __init__(self, priority, time_to_live=None):
+        self.priority = priority
+        self.time_to_live = time_to_live
+        self.sent = []
+
+    def send(self, to):
+        self.sent.append(to)
+
+    def send_multicast(self, tokens):
+        self.sent.append(list(tokens))
+
+
+class TokenBucketTest(unittest.TestCase):
+
+    def test_burst_then_rate(self):
+        bucket = TokenBucket(10, burst=2)
+        self.assertEqual(bucket.acquire(), 0)
+        self.assertEqual(bucket.acquire(), 0)
+        delay = bucket.acquire()
+        self.assertGreater(delay, 0)
+        self.assertLessEqual(delay, 0.1)
+        time.sleep(delay)
+        self.assertEqual(bucket.acquire(), 0)
+
+
+class SendSchedulerTest(unittest.TestCase):
+
+    def setUp(self):
+        self.scheduler = SendScheduler()
+        self.sent = []
+        self.lock = threading.Lock()
+
+    def tearDown(self):
+        self.scheduler.close(wait=False)
+
+    def record(self, name):
+        def send():
+            with self.lock:
+                self.sent.append((name, time.monotonic()))
+        return send
+
+    def names(self):
+        return [name for name, _ in self.sent]
+
+    def test_higher_priority_goes_first_and_equal_priorities_in_order(self):
+        for i in range(3):
+            self.scheduler.submit(self.record('background%d' % i), PRIORITY_CONSERVE_POWER)
+        self.scheduler.submit(self.record('alert0'), PRIORITY_IMMEDIATE)
+        self.scheduler.submit(self.record('alert1'), PRIORITY_IMMEDIATE)
+        self.assertEqual(len(self.scheduler), 5)
+        self.scheduler.start()
+        self.scheduler.close()
+        self.assertEqual(self.names(), ['alert0', 'alert1', 'background0', 'background1', 'background2'])
+        self.assertEqual(self.scheduler.sent, 5)
+
+    def test_expired_items_are_dropped(self):
+        self.scheduler.submit(self.record('expired'), expiry=time.time() - 1)
+        self.scheduler.submit(self.record('live'), expiry=time.time() + 60)
+        self.scheduler.start()
+        self.scheduler.close()
+        self.assertEqual(self.names(), ['live'])
+        self.assertEqual(self.scheduler.expired, 1)
+
+    def test_failed_send_does_not_stop_the_worker(self):
+        def fail():
+            raise IOError("gateway gone")
+        self.scheduler.submit(fail)
+        self.scheduler.submit(self.record('after'))
+        self.scheduler.start()
+        self.scheduler.close()
+        self.assertEqual(self.names(), ['after'])
+        self.assertEqual(self.scheduler.failed, 1)
+
+    def test_rate_limited_app_does_not_hold_back_others(self):
+        self.scheduler.set_rate_limit('limited', 10, burst=1)
+        start = time.monotonic()
+        for i in range(3):
+            self.scheduler.submit(self.record('limited%d' % i), app='limited')
+        for i in range(3):
+            self.scheduler.submit(self.record('free%d' % i), app='free')
+        self.scheduler.start()
+        self.scheduler.close()
+        self.assertEqual(self.names(), ['limited0', 'free0', 'free1', 'free2', 'limited1', 'limited2'])
+        times = dict(self.sent)
+        self.assertLess(times['free2'] - start, 0.05)
+        self.assertGreaterEqual(times['limited2'] - times['limited0'], 0.18)
+
+    def test_removing_a_rate_limit(self):
+        self.scheduler.set_rate_limit('app', 1, burst=1)
+        self.scheduler.set_rate_limit('app', None)
+        for i in range(5):
+            self.scheduler.submit(self.record(i), app='app')
+        start = time.monotonic()
+        self.scheduler.start()
+        self.scheduler.close()
+        self.assertEqual(len(self.sent), 5)
+        self.assertLess(time.monotonic() - start, 0.5)
+
+    def test_close_without_waiting_discards_the_queue(self):
+        self.scheduler.submit(self.record('queued'))
+        self.scheduler.close(wait=False)
+        self.assertEqual(self.sent, [])
+        self.assertEqual(len(self.scheduler), 0)
+        self.assertRaises(RuntimeError, self.scheduler.submit, self.record('late'))
+
+    def test_fcm_priority_and_time_to_live(self):
+        background = RecordingFCMMessage('normal')
+        alert = RecordingFCMMessage('high')
+        expired = RecordingFCMMessage('high', time_to_live=-1)
+        self.scheduler.send_fcm(background, 'topic')
+        self.scheduler.send_fcm(expired, 'token')
+        self.scheduler.send_fcm(alert, ['a', 'b'])
+        self.scheduler.start()
+        self.scheduler.close()
+        self.assertEqual(alert.sent, [['a', 'b']])
+        self.assertEqual(background.sent, ['topic'])
+        self.assertEqual(expired.sent, [])
+        self.assertEqual(self.scheduler.expired, 1)
+
+
+if __name__ == '__main__':
+    unittest.main()
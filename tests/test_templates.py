@@ -0,0 +1,67 @@
+# -*- coding: utf-8 -*-
+import json
+import unittest
+
+from cuckoo.model.messages import DataPayload, NotificationPayload, PayloadTooLargeError
+from cuckoo.model.templates import ELLIPSIS, PayloadTemplate, RawSlot, Slot
+
+
+class PayloadTemplateTest(unittest.TestCase):
+
+    def test_render_matches_the_payload_built_with_the_values(self):
+        template = PayloadTemplate(DataPayload(alert="Hi " + Slot("name") + "!", badge=RawSlot("badge"),
+                                               custom={'id': RawSlot("id")}))
+        self.assertEqual(template.slots, ('badge', 'id', 'name'))
+        rendered = template.render(name=u"Zoë", badge=3, id=[1, "x"])
+        expected = DataPayload(alert=u"Hi Zoë!", badge=3, custom={'id': [1, "x"]})
+        self.assertEqual(json.loads(rendered.data.decode('utf-8')), json.loads(expected.json().decode('utf-8')))
+        self.assertEqual(rendered.length, len(rendered.data))
+
+    def test_values_are_escaped(self):
+        template = PayloadTemplate(NotificationPayload(title=Slot("title"), body=Slot("body")))
+        values = dict(title=u'say "hi"\\', body=u"line\nbreak\t\x01 ☃")
+        rendered = json.loads(template.render(**values).data.decode('utf-8'))
+        self.assertEqual(rendered['title'], values['title'])
+        self.assertEqual(rendered['body'], values['body'])
+
+    def test_slot_used_twice_is_filled_twice(self):
+        template = PayloadTemplate(DataPayload(alert=Slot("name") + " and " + Slot("name")))
+        rendered = json.loads(template.render(name="Ann").data.decode('utf-8'))
+        self.assertEqual(rendered['aps']['alert'], "Ann and Ann")
+
+    def test_missing_value_raises(self):
+        template = PayloadTemplate(DataPayload(alert=Slot("name")))
+        self.assertRaises(KeyError, template.render)
+
+    def test_invalid_slot_names_are_rejected(self):
+        self.assertRaises(ValueError, Slot, "not a name")
+        self.assertRaises(ValueError, PayloadTemplate, DataPayload(badge=RawSlot("badge")), truncate="badge")
+        self.assertRaises(ValueError, PayloadTemplate, DataPayload(alert=Slot("name")), truncate="other")
+
+    def test_too_large_payload_raises(self):
+        template = PayloadTemplate(DataPayload(alert=Slot("text")), max_length=100)
+        self.assertRaises(PayloadTooLargeError, template.render, text="x" * 100)
+
+    def test_truncated_value_ends_with_an_ellipsis_and_fits(self):
+        template = PayloadTemplate(DataPayload(alert="Hi " + Slot("text")), truncate="text", max_length=100)
+        for text in (u"x" * 200, u"☃" * 200, u'"' * 200):
+            rendered = template.render(text=text)
+            self.assertLessEqual(rendered.length, 100)
+            self.assertGreater(rendered.length, 90)
+            alert = json.loads(rendered.data.decode('utf-8'))['aps']['alert']
+            self.assertTrue(alert.endswith(ELLIPSIS))
+            self.assertTrue(text.startswith(alert[3:-1]))
+
+    def test_value_which_fits_is_not_truncated(self):
+        template = PayloadTemplate(DataPayload(alert=Slot("text")), truncate="text", max_length=100)
+        alert = json.loads(template.render(text=u"short").data.decode('utf-8'))['aps']['alert']
+        self.assertEqual(alert, u"short")
+
+    def test_truncation_fails_if_even_the_ellipsis_does_not_fit(self):
+        template = PayloadTemplate(DataPayload(alert=Slot("text"), custom={'pad': "p" * 100}),
+                                   truncate="text", max_length=100)
+        self.assertRaises(PayloadTooLargeError, template.render, text="x" * 10)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,77 @@
+# -*- coding: utf-8 -*-
+import unittest
+from binascii import a2b_hex
+from datetime import datetime
+
+from cuckoo.model.feedback import FeedbackBatch
+from cuckoo.model.messages import DataPayload, Frame
+from cuckoo.model.tokens import TokenRegistry, ALIVE, DEAD_INVALID, DEAD_UNINSTALLED
+
+TOKENS = ['%064x' % (i * 0x1f2e3d4c5b6a7988) for i in range(1, 201)]
+
+
+class TokenRegistryTest(unittest.TestCase):
+
+    def test_add_and_lookup(self):
+        registry = TokenRegistry()
+        slots = [registry.add(token, 1000) for token in TOKENS]
+        self.assertEqual(slots, list(range(len(TOKENS))))
+        self.assertEqual(len(registry), len(TOKENS))
+        for slot, token in enumerate(TOKENS):
+            self.assertIn(token, registry)
+            self.assertIn(a2b_hex(token), registry)
+            self.assertEqual(registry.token(slot), a2b_hex(token))
+            self.assertEqual(registry.state(token), ALIVE)
+        self.assertNotIn('ff' * 32, registry)
+        self.assertIsNone(registry.state('ff' * 32))
+        self.assertEqual(registry.add(TOKENS[5]), 5)
+        self.assertEqual(len(registry), len(TOKENS))
+
+    def test_rejects_tokens_of_wrong_length(self):
+        self.assertRaises(ValueError, TokenRegistry().add, b'short')
+
+    def test_mark_dead_and_revive(self):
+        registry = TokenRegistry()
+        registry.add(TOKENS[0])
+        self.assertTrue(registry.mark_dead(TOKENS[0]))
+        self.assertTrue(registry.mark_dead(TOKENS[1], DEAD_UNINSTALLED))
+        self.assertTrue(registry.is_dead(TOKENS[0]))
+        self.assertEqual(registry.state(TOKENS[1]), DEAD_UNINSTALLED)
+        self.assertEqual(registry.dead_count(), 2)
+        registry.add(TOKENS[0])
+        self.assertFalse(registry.is_dead(TOKENS[0]))
+        self.assertEqual(list(registry.live_tokens()), [a2b_hex(TOKENS[0])])
+
+    def test_feedback_older_than_registration_is_ignored(self):
+        registry = TokenRegistry()
+        registry.add(TOKENS[0], registered_at=2000)
+        self.assertFalse(registry.mark_dead(TOKENS[0], DEAD_UNINSTALLED, failed_at=1000))
+        self.assertFalse(registry.is_dead(TOKENS[0]))
+        self.assertTrue(registry.mark_dead(TOKENS[0], DEAD_UNINSTALLED, failed_at=3000))
+
+    def test_apply_feedback(self):
+        registry = TokenRegistry()
+        registry.add(TOKENS[0], registered_at=2000)
+        batch = FeedbackBatch()
+        for token in TOKENS[1:4]:
+            batch.tokens += a2b_hex(token)
+            batch.timestamps.append(1000)
+        pairs = [(a2b_hex(TOKENS[0]), datetime(1970, 1, 1, 0, 16, 40))]  # 1000, before the registration
+        self.assertEqual(registry.apply_feedback([batch] + pairs), 3)
+        self.assertEqual([registry.is_dead(token) for token in TOKENS[:4]], [False, True, True, True])
+
+    def test_frame_skips_dead_tokens(self):
+        registry = TokenRegistry()
+        registry.mark_dead(TOKENS[3], DEAD_INVALID)
+        registry.mark_dead(TOKENS[10], DEAD_INVALID)
+        payload = DataPayload(alert=u"Hi").compile()
+        frame = Frame.from_tokens(TOKENS[:20], payload, token_registry=registry)
+        expected = Frame(registry)
+        added = [expected.add_item(token, payload, i, 0, 10) for i, token in enumerate(TOKENS[:20])]
+        self.assertEqual(added.count(False), 2)
+        self.assertEqual(bytes(frame.get_frame()), bytes(expected.get_frame()))
+        self.assertEqual(list(frame.item_identifiers), [i for i in range(20) if i not in (3, 10)])
+
+
+if __name__ == '__main__':
+    unittest.main()